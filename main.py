@@ -1,17 +1,33 @@
 # carts_management_flet.py
 import flet as ft
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
-import shutil
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 import threading
 import time
+import queue
+import atexit
 import json
+import gzip
+import lzma
+import bz2
+import sys
+import itertools
+import functools
+import glob
+import tempfile
+from abc import ABC, abstractmethod
+import hashlib
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
 from pathlib import Path
 import base64
 from dotenv import load_dotenv
 import random
+import secrets
+import shutil
 
 # تحميل المتغيرات البيئية
 load_dotenv()
@@ -35,6 +51,10 @@ except ImportError:
 try:
     from fpdf import FPDF
     FPDF_AVAILABLE = True
+    try:
+        from fpdf import set_global as fpdf_set_global
+    except ImportError:  # fpdf2 لا يدعم ذاكرة مقاييس الخطوط
+        fpdf_set_global = None
 except ImportError:
     FPDF_AVAILABLE = False
 
@@ -48,6 +68,74 @@ except ImportError:
 
 # إعدادات قاعدة البيانات
 DB_NAME = 'carts_management.db'
+DB_BUSY_TIMEOUT = 10  # ثوانٍ انتظار القفل قبل ظهور "database is locked"
+
+# التواريخ مخزنة بتوقيت UTC، والأيام في التقارير بتوقيت مكة المكرمة (Asia/Riyadh) الثابت بلا توقيت صيفي
+LOCAL_UTC_OFFSET_HOURS = 3
+LOCAL_TIME_MODIFIER = f'+{LOCAL_UTC_OFFSET_HOURS} hours'
+
+# إعدادات كتابة سجل النظام
+LOG_BATCH_SIZE = 100  # أقصى عدد قيود في الدفعة الواحدة
+LOG_FLUSH_INTERVAL_MS = 500  # أقصى مدة يبقى فيها القيد في الطابور قبل كتابته
+LOG_QUEUE_SIZE = 10000  # حد الطابور، بعده ينتظر المستدعي حتى يفرغ جزء منه
+
+# إعدادات أرشفة سجل النظام
+LOG_RETENTION_DAYS = 90  # القيود الأقدم تُنقل للأرشيف المضغوط (0 لتعطيل الأرشفة)
+LOG_ARCHIVE_DIR = 'logs_archive'
+LOG_ARCHIVE_BATCH = 1000  # عدد القيود المحذوفة في كل معاملة
+LOG_RETENTION_INTERVAL_HOURS = 6
+
+# إعدادات أرشفة الحركات
+MOVEMENT_ARCHIVE_MONTHS = 12  # الحركات الأقدم تُنقل لقواعد سنوية (0 لتعطيل الأرشفة)
+MOVEMENT_ARCHIVE_DIR = 'movements_archive'
+MOVEMENT_ARCHIVE_BATCH = 1000
+MOVEMENT_ARCHIVE_INTERVAL_HOURS = 24
+MOVEMENT_COLUMNS = ['id', 'cart_id', 'from_warehouse_id', 'to_warehouse_id', 'timestamp', 'user_id', 'notes']
+MOVEMENT_ROLLUPS_VERSION = '3'  # يُرفع عند تغيير طريقة التجميع لإعادة بناء الجداول التجميعية
+
+# إعدادات عرض الجداول الكبيرة
+TABLE_PAGE_SIZE = 50  # عدد الصفوف في كل صفحة تُجلب من قاعدة البيانات
+TABLE_WINDOW_PAGES = 3  # أقصى عدد صفحات معروضة في وقت واحد
+SEARCH_DEBOUNCE_MS = 200  # مهلة تجميع ضغطات المفاتيح قبل تنفيذ البحث
+REPORT_CACHE_MAX_BYTES = 8 * 1024 * 1024  # الحد الأقصى لذاكرة نتائج التقارير المشتركة
+EXPORT_FETCH_SIZE = 1000  # عدد الصفوف المقروءة من المؤشر في كل دفعة أثناء التصدير
+
+# إعدادات مهام التصدير
+ASSETS_DIR = 'assets'  # مجلد الملفات الثابتة التي يقدمها Flet للمتصفح
+EXPORTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ASSETS_DIR, 'exports')
+EXPORT_WORKERS = 2  # أقصى عدد تصديرات تعمل في نفس الوقت لكل جلسة
+EXPORT_PROGRESS_INTERVAL = 0.5  # ثوانٍ بين تحديثات شريط التقدم
+EXPORT_TTL = 15 * 60  # ثوانٍ يبقى فيها ملف التصدير متاحاً للتنزيل قبل حذفه
+
+# إعدادات تقارير PDF
+PDF_FONT_CACHE_DIR = 'font_cache'  # مقاييس الخطوط المحللة تُحفظ هنا حتى لا يُعاد تحليل ملف TTF
+PDF_WIDTH_SAMPLE_ROWS = 200  # عدد الصفوف الأولى المستخدمة لحساب عرض الأعمدة
+PDF_ROW_HEIGHT = 8
+PDF_CELL_PADDING = 4
+
+# إعدادات النسخ الاحتياطي
+BACKUP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backups")
+BACKUP_PAGES_PER_STEP = 1024  # صفحات تُنسخ في كل خطوة قبل إفساح المجال للكتّاب وتحديث التقدم
+BACKUP_CHUNK_SIZE = 64 * 1024  # حجم قطع النسخ التزايدي، من مضاعفات حجم صفحة SQLite
+BACKUP_CHUNKS_DIR = 'chunks'
+BACKUP_MANIFESTS_DIR = 'manifests'
+BACKUP_COMPRESSION_BUFFER = 1024 * 1024  # حجم الدفعة المقروءة أثناء الضغط، فتبقى الذاكرة محدودة
+BACKUP_UPLOAD_PART_SIZE = 8 * 1024 * 1024  # حجم الجزء الواحد في الرفع المجزأ
+BACKUP_UPLOAD_WORKERS = 3  # عدد الأجزاء المرفوعة في وقت واحد
+BACKUP_UPLOAD_RETRIES = 5  # محاولات رفع الجزء قبل إيقاف الرفع (يُستأنف لاحقاً من حيث توقف)
+BACKUP_UPLOAD_BACKOFF = 1.0  # ثوانٍ قبل أول إعادة محاولة، وتتضاعف بعد كل فشل
+BACKUP_STORAGE_DIR = 'remote_backups'  # مجلد المخزن المحلي البديل عن MEGA للعمل دون اتصال
+BACKUP_SCHEDULE = '0 * * * *'  # صيغة cron بالتوقيت المحلي: الدقيقة الساعة اليوم الشهر يوم-الأسبوع
+BACKUP_KEEP_HOURLY = 24  # عدد النسخ التلقائية المحتفظ بها: آخر نسخة من كل ساعة
+BACKUP_KEEP_DAILY = 7  # ومن كل يوم
+BACKUP_KEEP_WEEKLY = 4  # ومن كل أسبوع
+JOB_STOP_TIMEOUT = 30  # ثوانٍ انتظار انتهاء المهمة الخلفية الجارية قبل الاستعادة
+RESTORE_REQUIRED_TABLES = {'users', 'carts', 'warehouses', 'movements'}
+BACKUP_COMPRESSORS = {
+    'gzip': (gzip.open, '.gz'),
+    'lzma': (lzma.open, '.xz'),
+    'bz2': (bz2.open, '.bz2'),
+}
 DEFAULT_USER = 'سعود'
 DEFAULT_PASSWORD = '123456'
 APP_NAME = "نظام إدارة العربات اليدوية - الحرم المكي الشريف"
@@ -55,6 +143,7 @@ APP_NAME = "نظام إدارة العربات اليدوية - الحرم ال
 # إعدادات MEGA - من المتغيرات البيئية
 MEGA_EMAIL = os.getenv('MEGA_EMAIL', '')
 MEGA_PASSWORD = os.getenv('MEGA_PASSWORD', '')
+MEGA_SESSION_TTL = 30 * 60  # ثوانٍ قبل تجديد جلسة MEGA المحفوظة
 
 # قائمة المستودعات الأساسية
 WAREHOUSES = [
@@ -116,6 +205,339 @@ COLORS = {
     'teal': '#1abc9c'
 }
 
+# ================================ الفترات الزمنية ================================
+def local_today():
+    """تاريخ اليوم بالتوقيت المحلي"""
+    return (datetime.utcnow() + timedelta(hours=LOCAL_UTC_OFFSET_HOURS)).date()
+
+def local_period_range(period):
+    """حدود الفترة كنطاق نصف مفتوح [البداية، النهاية) من الأيام المحلية، أو None لكل الفترات"""
+    today = local_today()
+    if period == "اليوم":
+        start = today
+    elif period == "آخر 7 أيام":
+        start = today - timedelta(days=7)
+    elif period == "آخر 30 يوم":
+        start = today - timedelta(days=30)
+    elif period == "آخر سنة":
+        try:
+            start = today.replace(year=today.year - 1)
+        except ValueError:  # 29 فبراير
+            start = today.replace(year=today.year - 1, day=28)
+    else:
+        return None
+    return start.isoformat(), (today + timedelta(days=1)).isoformat()
+
+def utc_timestamp_range(period_range):
+    """تحويل نطاق الأيام المحلية إلى حدود طوابع UTC المخزنة، لاستخدام فهارس التوقيت مباشرة"""
+    bounds = []
+    for day in period_range:
+        moment = datetime.fromisoformat(day) - timedelta(hours=LOCAL_UTC_OFFSET_HOURS)
+        bounds.append(moment.strftime('%Y-%m-%d %H:%M:%S'))
+    return tuple(bounds)
+
+def iter_cursor(cursor, size=EXPORT_FETCH_SIZE):
+    """قراءة نتائج المؤشر على دفعات ثابتة الحجم حتى لا تُحمّل كلها في الذاكرة"""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+# ================================ ترحيلات مخطط قاعدة البيانات ================================
+def add_column_if_missing(cursor, table, column, definition):
+    """إضافة عمود إلى جدول إذا لم يكن موجوداً"""
+    # table_xinfo تشمل الأعمدة المولدة المخفية عن table_info
+    cursor.execute(f"PRAGMA table_xinfo({table})")
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def recount_warehouse_counters(cursor):
+    """إعادة حساب عدادات المستودعات من جدول العربات باستعلام تجميع واحد"""
+    cursor.execute("""
+        SELECT current_warehouse_id,
+               SUM(status IS 'sound') + SUM(status IS 'needs_maintenance'),
+               SUM(status IS 'sound'),
+               SUM(status IS 'needs_maintenance'),
+               SUM(status IS 'damaged')
+        FROM carts
+        WHERE current_warehouse_id IS NOT NULL
+        GROUP BY current_warehouse_id
+    """)
+    counts = cursor.fetchall()
+    
+    cursor.execute(
+        "UPDATE warehouses SET current_count = 0, sound_count = 0, maintenance_count = 0, damaged_count = 0"
+    )
+    cursor.executemany(
+        """UPDATE warehouses 
+           SET current_count = ?, sound_count = ?, maintenance_count = ?, damaged_count = ? 
+           WHERE id = ?""",
+        [(current, sound, maintenance, damaged, wid) for wid, current, sound, maintenance, damaged in counts]
+    )
+
+def rebuild_movement_rollups(cursor, sources):
+    """إعادة بناء جداول تجميع الحركات من مصادر الحركات المعطاة (الجدول الحالي والأرشيفات)"""
+    movements = " UNION ALL ".join(
+        f"SELECT cart_id, from_warehouse_id, to_warehouse_id, timestamp FROM {source} WHERE timestamp IS NOT NULL"
+        for source in sources
+    )
+    
+    for table in ('movement_day_carts', 'movement_daily', 'movement_hourly', 'movement_routes'):
+        cursor.execute(f"DELETE FROM {table}")
+    
+    # الأرشيفات لا تحوي العمود المولد local_day فيُحسب اليوم المحلي من التاريخ مباشرة
+    cursor.execute(f"""
+        INSERT INTO movement_day_carts (day, cart_id, movement_count)
+        SELECT DATE(timestamp, '{LOCAL_TIME_MODIFIER}'), cart_id, COUNT(*) FROM ({movements}) GROUP BY 1, 2
+    """)
+    cursor.execute("""
+        INSERT INTO movement_daily (day, movement_count, distinct_carts)
+        SELECT day, SUM(movement_count), COUNT(*) FROM movement_day_carts GROUP BY day
+    """)
+    cursor.execute(f"""
+        INSERT INTO movement_hourly (day, hour, movement_count)
+        SELECT DATE(timestamp, '{LOCAL_TIME_MODIFIER}'), CAST(strftime('%H', timestamp, '{LOCAL_TIME_MODIFIER}') AS INTEGER), COUNT(*)
+        FROM ({movements}) GROUP BY 1, 2
+    """)
+    cursor.execute(f"""
+        INSERT INTO movement_routes (day, from_warehouse_id, to_warehouse_id, movement_count)
+        SELECT DATE(timestamp, '{LOCAL_TIME_MODIFIER}'), COALESCE(from_warehouse_id, 0), to_warehouse_id, COUNT(*)
+        FROM ({movements}) GROUP BY 1, 2, 3
+    """)
+
+# كل ترحيل: (رقم الإصدار، الوصف، قائمة الخطوات)
+# الخطوة إما استعلام SQL أو دالة تستقبل المؤشر، ويجب أن تكون قابلة لإعادة التنفيذ بأمان
+SCHEMA_MIGRATIONS = [
+    (1, 'فهارس سجل الحركات', [
+        "CREATE INDEX IF NOT EXISTS idx_movements_timestamp ON movements (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_movements_cart_id ON movements (cart_id)",
+    ]),
+    (2, 'فهارس العربات حسب المستودع والحالة', [
+        "CREATE INDEX IF NOT EXISTS idx_carts_warehouse_status ON carts (current_warehouse_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_carts_status ON carts (status)",
+    ]),
+    (3, 'فهارس سجلات الصيانة', [
+        "CREATE INDEX IF NOT EXISTS idx_maintenance_status_entry ON maintenance_records (status, entry_date)",
+        "CREATE INDEX IF NOT EXISTS idx_maintenance_entry_date ON maintenance_records (entry_date)",
+    ]),
+    (4, 'عدادات إشغال المستودعات عبر المشغلات', [
+        lambda cursor: add_column_if_missing(cursor, 'warehouses', 'sound_count', 'INTEGER DEFAULT 0'),
+        lambda cursor: add_column_if_missing(cursor, 'warehouses', 'maintenance_count', 'INTEGER DEFAULT 0'),
+        lambda cursor: add_column_if_missing(cursor, 'warehouses', 'damaged_count', 'INTEGER DEFAULT 0'),
+        # العدد الحالي يستثني العربات التالفة كما في الحساب السابق
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_carts_counters_insert
+        AFTER INSERT ON carts
+        WHEN NEW.current_warehouse_id IS NOT NULL
+        BEGIN
+            UPDATE warehouses SET
+                current_count = current_count + (NEW.status IS 'sound') + (NEW.status IS 'needs_maintenance'),
+                sound_count = sound_count + (NEW.status IS 'sound'),
+                maintenance_count = maintenance_count + (NEW.status IS 'needs_maintenance'),
+                damaged_count = damaged_count + (NEW.status IS 'damaged')
+            WHERE id = NEW.current_warehouse_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_carts_counters_delete
+        AFTER DELETE ON carts
+        WHEN OLD.current_warehouse_id IS NOT NULL
+        BEGIN
+            UPDATE warehouses SET
+                current_count = current_count - (OLD.status IS 'sound') - (OLD.status IS 'needs_maintenance'),
+                sound_count = sound_count - (OLD.status IS 'sound'),
+                maintenance_count = maintenance_count - (OLD.status IS 'needs_maintenance'),
+                damaged_count = damaged_count - (OLD.status IS 'damaged')
+            WHERE id = OLD.current_warehouse_id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_carts_counters_update
+        AFTER UPDATE OF status, current_warehouse_id ON carts
+        WHEN OLD.status IS NOT NEW.status OR OLD.current_warehouse_id IS NOT NEW.current_warehouse_id
+        BEGIN
+            UPDATE warehouses SET
+                current_count = current_count - (OLD.status IS 'sound') - (OLD.status IS 'needs_maintenance'),
+                sound_count = sound_count - (OLD.status IS 'sound'),
+                maintenance_count = maintenance_count - (OLD.status IS 'needs_maintenance'),
+                damaged_count = damaged_count - (OLD.status IS 'damaged')
+            WHERE id = OLD.current_warehouse_id;
+            UPDATE warehouses SET
+                current_count = current_count + (NEW.status IS 'sound') + (NEW.status IS 'needs_maintenance'),
+                sound_count = sound_count + (NEW.status IS 'sound'),
+                maintenance_count = maintenance_count + (NEW.status IS 'needs_maintenance'),
+                damaged_count = damaged_count + (NEW.status IS 'damaged')
+            WHERE id = NEW.current_warehouse_id;
+        END
+        """,
+        recount_warehouse_counters,
+    ]),
+    (5, 'فهرس البحث بالرقم التسلسلي', [
+        # LIKE غير حساس لحالة الأحرف فلا يستفيد إلا من فهرس بترتيب NOCASE
+        "CREATE INDEX IF NOT EXISTS idx_carts_serial_nocase ON carts (serial_number COLLATE NOCASE)",
+    ]),
+    (6, 'فهرس تاريخ سجل النظام', [
+        "CREATE INDEX IF NOT EXISTS idx_system_logs_timestamp ON system_logs (timestamp)",
+    ]),
+    (7, 'جداول تجميع الحركات اليومية والساعية وحسب المسار', [
+        """
+        CREATE TABLE IF NOT EXISTS movement_daily (
+            day TEXT PRIMARY KEY,
+            movement_count INTEGER NOT NULL DEFAULT 0,
+            distinct_carts INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS movement_hourly (
+            day TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            movement_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, hour)
+        ) WITHOUT ROWID
+        """,
+        # المستودع المصدر غير المحدد يُخزن صفراً لأن المفتاح الأساسي لا يقبل NULL
+        """
+        CREATE TABLE IF NOT EXISTS movement_routes (
+            day TEXT NOT NULL,
+            from_warehouse_id INTEGER NOT NULL,
+            to_warehouse_id INTEGER NOT NULL,
+            movement_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, from_warehouse_id, to_warehouse_id)
+        ) WITHOUT ROWID
+        """,
+        # عدد حركات كل عربة في اليوم، ومنه يُحدّث عدد العربات المختلفة دون COUNT(DISTINCT)
+        """
+        CREATE TABLE IF NOT EXISTS movement_day_carts (
+            day TEXT NOT NULL,
+            cart_id INTEGER NOT NULL,
+            movement_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, cart_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS trg_movements_rollup_insert
+        AFTER INSERT ON movements
+        WHEN NEW.timestamp IS NOT NULL
+        BEGIN
+            INSERT INTO movement_day_carts (day, cart_id, movement_count)
+            VALUES (DATE(NEW.timestamp), NEW.cart_id, 1)
+            ON CONFLICT (day, cart_id) DO UPDATE SET movement_count = movement_count + 1;
+            
+            INSERT INTO movement_daily (day, movement_count, distinct_carts)
+            VALUES (DATE(NEW.timestamp), 1, 1)
+            ON CONFLICT (day) DO UPDATE SET
+                movement_count = movement_count + 1,
+                distinct_carts = distinct_carts + (
+                    SELECT movement_count = 1 FROM movement_day_carts
+                    WHERE day = DATE(NEW.timestamp) AND cart_id = NEW.cart_id
+                );
+            
+            INSERT INTO movement_hourly (day, hour, movement_count)
+            VALUES (DATE(NEW.timestamp), CAST(strftime('%H', NEW.timestamp) AS INTEGER), 1)
+            ON CONFLICT (day, hour) DO UPDATE SET movement_count = movement_count + 1;
+            
+            INSERT INTO movement_routes (day, from_warehouse_id, to_warehouse_id, movement_count)
+            VALUES (DATE(NEW.timestamp), COALESCE(NEW.from_warehouse_id, 0), NEW.to_warehouse_id, 1)
+            ON CONFLICT (day, from_warehouse_id, to_warehouse_id) DO UPDATE SET movement_count = movement_count + 1;
+        END
+        """,
+    ]),
+    (8, 'أعمدة اليوم المحلي المولدة وفهارسها', [
+        # ALTER TABLE لا يضيف إلا أعمدة مولدة افتراضية، والفهرس يخزن قيمتها فيكفي للبحث بالنطاق
+        lambda cursor: add_column_if_missing(
+            cursor, 'movements', 'local_day',
+            f"TEXT GENERATED ALWAYS AS (DATE(timestamp, '{LOCAL_TIME_MODIFIER}')) VIRTUAL"
+        ),
+        lambda cursor: add_column_if_missing(
+            cursor, 'maintenance_records', 'local_day',
+            f"TEXT GENERATED ALWAYS AS (DATE(entry_date, '{LOCAL_TIME_MODIFIER}')) VIRTUAL"
+        ),
+        "CREATE INDEX IF NOT EXISTS idx_movements_local_day ON movements (local_day)",
+        "CREATE INDEX IF NOT EXISTS idx_maintenance_local_day ON maintenance_records (local_day)",
+        # تجميع الحركات بالأيام المحلية، وإعادة البناء تتم عبر MOVEMENT_ROLLUPS_VERSION
+        "DROP TRIGGER IF EXISTS trg_movements_rollup_insert",
+        f"""
+        CREATE TRIGGER trg_movements_rollup_insert
+        AFTER INSERT ON movements
+        WHEN NEW.timestamp IS NOT NULL
+        BEGIN
+            INSERT INTO movement_day_carts (day, cart_id, movement_count)
+            VALUES (NEW.local_day, NEW.cart_id, 1)
+            ON CONFLICT (day, cart_id) DO UPDATE SET movement_count = movement_count + 1;
+            
+            INSERT INTO movement_daily (day, movement_count, distinct_carts)
+            VALUES (NEW.local_day, 1, 1)
+            ON CONFLICT (day) DO UPDATE SET
+                movement_count = movement_count + 1,
+                distinct_carts = distinct_carts + (
+                    SELECT movement_count = 1 FROM movement_day_carts
+                    WHERE day = NEW.local_day AND cart_id = NEW.cart_id
+                );
+            
+            INSERT INTO movement_hourly (day, hour, movement_count)
+            VALUES (NEW.local_day, CAST(strftime('%H', NEW.timestamp, '{LOCAL_TIME_MODIFIER}') AS INTEGER), 1)
+            ON CONFLICT (day, hour) DO UPDATE SET movement_count = movement_count + 1;
+            
+            INSERT INTO movement_routes (day, from_warehouse_id, to_warehouse_id, movement_count)
+            VALUES (NEW.local_day, COALESCE(NEW.from_warehouse_id, 0), NEW.to_warehouse_id, 1)
+            ON CONFLICT (day, from_warehouse_id, to_warehouse_id) DO UPDATE SET movement_count = movement_count + 1;
+        END
+        """,
+    ]),
+    (9, 'ربط النسخ التزايدية بملفات البيان', [
+        lambda cursor: add_column_if_missing(cursor, 'backups', 'manifest_path', 'TEXT'),
+    ]),
+    (10, 'حجم النسخ الأصلي ونوع ضغطها وبصمتها', [
+        lambda cursor: add_column_if_missing(cursor, 'backups', 'original_size', 'INTEGER'),
+        lambda cursor: add_column_if_missing(cursor, 'backups', 'compression', 'TEXT'),
+        lambda cursor: add_column_if_missing(cursor, 'backups', 'compression_ratio', 'REAL'),
+        lambda cursor: add_column_if_missing(cursor, 'backups', 'sha256', 'TEXT'),
+    ]),
+    (11, 'طرح الحركات المحذوفة من جداول التجميع عبر المشغلات', [
+        # صف وحيد يضعه مدير الأرشفة أثناء النقل لأن الحركة المؤرشفة تبقى محسوبة في التجميع
+        """
+        CREATE TABLE IF NOT EXISTS movement_rollup_hold (
+            id INTEGER PRIMARY KEY CHECK (id = 1)
+        )
+        """,
+        # يشمل الحذف المتتالي عند حذف عربة أو مستودع، والصفوف التي تصل للصفر تُحذف كما في إعادة البناء
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_movements_rollup_delete
+        AFTER DELETE ON movements
+        WHEN OLD.timestamp IS NOT NULL AND NOT EXISTS (SELECT 1 FROM movement_rollup_hold)
+        BEGIN
+            UPDATE movement_day_carts SET movement_count = movement_count - 1
+            WHERE day = OLD.local_day AND cart_id = OLD.cart_id;
+            
+            UPDATE movement_daily SET
+                movement_count = movement_count - 1,
+                distinct_carts = distinct_carts - (
+                    SELECT COUNT(*) FROM movement_day_carts
+                    WHERE day = OLD.local_day AND cart_id = OLD.cart_id AND movement_count <= 0
+                )
+            WHERE day = OLD.local_day;
+            DELETE FROM movement_day_carts
+            WHERE day = OLD.local_day AND cart_id = OLD.cart_id AND movement_count <= 0;
+            DELETE FROM movement_daily WHERE day = OLD.local_day AND movement_count <= 0;
+            
+            UPDATE movement_hourly SET movement_count = movement_count - 1
+            WHERE day = OLD.local_day AND hour = CAST(strftime('%H', OLD.timestamp, '{LOCAL_TIME_MODIFIER}') AS INTEGER);
+            DELETE FROM movement_hourly
+            WHERE day = OLD.local_day AND hour = CAST(strftime('%H', OLD.timestamp, '{LOCAL_TIME_MODIFIER}') AS INTEGER)
+                AND movement_count <= 0;
+            
+            UPDATE movement_routes SET movement_count = movement_count - 1
+            WHERE day = OLD.local_day AND from_warehouse_id = COALESCE(OLD.from_warehouse_id, 0)
+                AND to_warehouse_id = OLD.to_warehouse_id;
+            DELETE FROM movement_routes
+            WHERE day = OLD.local_day AND from_warehouse_id = COALESCE(OLD.from_warehouse_id, 0)
+                AND to_warehouse_id = OLD.to_warehouse_id AND movement_count <= 0;
+        END
+        """,
+    ]),
+]
+
 # ================================ إدارة قاعدة البيانات ================================
 class DatabaseManager:
     """مدير قاعدة البيانات - نمط Singleton"""
@@ -129,24 +551,294 @@ class DatabaseManager:
     
     def init_database(self):
         """تهيئة قاعدة البيانات وإنشاء الجداول"""
-        self.conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-        self.conn.execute("PRAGMA foreign_keys = ON")
+        # اتصال كتابة وحيد محمي بقفل، واتصالات قراءة مستقلة لكل خيط
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._tx_owner = None
+        self._write_version = 0
+        self._reader_generation = 0
+        # يزيد مع كل استعادة، والجلسات التي سجلت الدخول قبلها تُعاد لشاشة الدخول
+        self.restore_generation = 0
+        
+        self.conn = self._open_connection()
+        
+        # يحتاج مدير الأرشفة لقراءة الأرشيفات عند إعادة بناء جداول التجميع
+        self.movement_archiver = MovementArchiver(self)
+        self.prepare_schema()
+        
+        # خدمات مشتركة بين جميع الجلسات
+        self.stats = StatsSnapshot(self)
+        self.reports = ReportEngine(self)
+        self.log_writer = LogWriter(self)
+        self.log_retention = LogRetention(self)
+        self.search = SearchDebouncer(on_error=self.log_error)
+        self.mega_session = MegaSession()
+        purge_stale_exports()
+        self.backup_engine = BackupEngine(self)
+        self.backup_scheduler = BackupScheduler(self)
+        
+        # مهام الصيانة الدورية
+        self.jobs = [
+            PeriodicJob("log-retention", LOG_RETENTION_INTERVAL_HOURS * 3600, self.log_retention.run,
+                        on_error=self.log_error),
+            PeriodicJob("movement-archive", MOVEMENT_ARCHIVE_INTERVAL_HOURS * 3600, self.movement_archiver.run,
+                        on_error=self.log_error),
+            self.backup_scheduler,
+        ]
+        for job in self.jobs:
+            job.start()
+    
+    def _open_connection(self, read_only=False):
+        """فتح اتصال جديد بإعدادات الأداء الموحدة"""
+        conn = sqlite3.connect(DB_NAME, check_same_thread=False, timeout=DB_BUSY_TIMEOUT)
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT * 1000)}")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+    
+    def prepare_schema(self):
+        """تجهيز المخطط والبيانات الأساسية، عند البدء وبعد استعادة نسخة قد تكون أقدم"""
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.enable_incremental_vacuum()
         self.create_tables()
+        self.apply_migrations()
         self.init_default_data()
+        if self.get_app_setting('movement_rollups_version') != MOVEMENT_ROLLUPS_VERSION:
+            self.rebuild_movement_rollups()
+    
+    def get_reader(self):
+        """الحصول على اتصال القراءة الخاص بالخيط الحالي"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.generation != self._reader_generation:
+            # اتصال فُتح قبل استعادة نسخة، فيُغلق ويُفتح من جديد
+            with self._readers_lock:
+                self._readers = [(t, c) for t, c in self._readers if c is not conn]
+            conn.close()
+            conn = None
+        
+        if conn is None:
+            conn = self._open_connection(read_only=True)
+            self._local.conn = conn
+            self._local.generation = self._reader_generation
+            with self._readers_lock:
+                # إغلاق اتصالات الخيوط المنتهية حتى لا تتراكم
+                for thread, reader in self._readers:
+                    if not thread.is_alive():
+                        reader.close()
+                self._readers = [(t, c) for t, c in self._readers if t.is_alive()]
+                self._readers.append((threading.current_thread(), conn))
+        return conn
+    
+    @contextmanager
+    def get_cursor(self, log_only=False):
+        """إنشاء مؤشر قاعدة البيانات مع الإغلاق التلقائي
+        log_only: الكتابة في سجل النظام وحده لا تغير رقم الإصدار فلا تُسقط الذاكرات المؤقتة"""
+        with self._write_lock:
+            cursor = self.conn.cursor()
+            if self.in_transaction():
+                # داخل وحدة عمل مفتوحة: الالتزام أو التراجع مسؤولية transaction()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+                return
+            
+            try:
+                yield cursor
+                self.conn.commit()
+                if not log_only:
+                    self._write_version += 1
+            except Exception as e:
+                self.conn.rollback()
+                raise e
+            finally:
+                cursor.close()
+    
+    def in_transaction(self):
+        """هل الخيط الحالي داخل وحدة عمل مفتوحة"""
+        return self._tx_owner == threading.get_ident()
     
     @contextmanager
-    def get_cursor(self):
-        """إنشاء مؤشر قاعدة البيانات مع الإغلاق التلقائي"""
-        cursor = self.conn.cursor()
+    def transaction(self):
+        """تنفيذ عدة عمليات كوحدة عمل واحدة بالتزام واحد أو تراجع كامل"""
+        with self._write_lock:
+            if self.in_transaction():
+                # المعاملات المتداخلة تنضم إلى المعاملة الخارجية
+                cursor = self.conn.cursor()
+                try:
+                    yield cursor
+                finally:
+                    cursor.close()
+                return
+            
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            self._tx_owner = threading.get_ident()
+            try:
+                yield cursor
+                self.conn.commit()
+                self._write_version += 1
+            except Exception as e:
+                self.conn.rollback()
+                raise e
+            finally:
+                self._tx_owner = None
+                cursor.close()
+    
+    @contextmanager
+    def read_cursor(self):
+        """إنشاء مؤشر قراءة من اتصال الخيط الحالي دون انتظار قفل الكتابة"""
+        cursor = self.get_reader().cursor()
         try:
             yield cursor
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise e
         finally:
             cursor.close()
     
+    @contextmanager
+    def attached(self, path, alias):
+        """إرفاق قاعدة بيانات أخرى باتصال الكتابة طوال الكتلة"""
+        with self._write_lock:
+            self.conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+            try:
+                yield
+            finally:
+                self.conn.execute(f"DETACH DATABASE {alias}")
+    
+    @contextmanager
+    def movement_history(self):
+        """قراءة الحركات الحالية والمؤرشفة معاً من خلال العرض المؤقت movements_all"""
+        conn = self.get_reader()
+        columns = ', '.join(MOVEMENT_COLUMNS)
+        selects = [f"SELECT {columns} FROM main.movements"]
+        aliases = []
+        cursor = conn.cursor()
+        try:
+            for year, path in self.movement_archiver.archive_files():
+                alias = f"archive_{year}"
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+                aliases.append(alias)
+                selects.append(f"SELECT {columns} FROM {alias}.movements")
+            
+            # العرض المؤقت يُكتب في قاعدة temp فيُرفع وضع القراءة فقط لحظة إنشائه وحذفه
+            self._execute_temp_ddl(conn, "DROP VIEW IF EXISTS temp.movements_all")
+            self._execute_temp_ddl(conn, f"CREATE TEMP VIEW movements_all AS {' UNION ALL '.join(selects)}")
+            yield cursor
+        finally:
+            cursor.close()
+            self._execute_temp_ddl(conn, "DROP VIEW IF EXISTS temp.movements_all")
+            for alias in aliases:
+                conn.execute(f"DETACH DATABASE {alias}")
+    
+    @staticmethod
+    def _execute_temp_ddl(conn, query):
+        conn.execute("PRAGMA query_only = OFF")
+        try:
+            conn.execute(query)
+        finally:
+            conn.execute("PRAGMA query_only = ON")
+    
+    @staticmethod
+    def _is_read_query(query):
+        """هل الاستعلام للقراءة فقط"""
+        words = query.lstrip().split(None, 1)
+        return bool(words) and words[0].upper() in ('SELECT', 'WITH')
+    
+    @contextmanager
+    def paused_jobs(self):
+        """إيقاف المهام الخلفية وانتظار انتهاء الجاري منها، ثم إعادة تشغيلها"""
+        for job in self.jobs:
+            job.stop()
+        try:
+            still_running = [job.name for job in self.jobs if not job.stop(wait=True)]
+            if still_running:
+                # الاستمرار يعني أن تعمل المهمة على القاعدة أثناء استبدالها
+                raise RuntimeError(f"مهام خلفية لم تنتهِ بعد: {', '.join(still_running)}، حاول مرة أخرى لاحقاً")
+            yield
+        finally:
+            for job in self.jobs:
+                job.start()
+    
+    def restore_from(self, path, progress=None):
+        """استبدال محتوى قاعدة البيانات الحية بنسخة محققة دون إعادة تشغيل التطبيق"""
+        # سجل النسخ نفسه يُحفظ حتى لا تختفي من القائمة النسخ الأحدث من النسخة المستعادة
+        catalog = self.execute_query("SELECT * FROM backups")
+        catalog_columns = [row[1] for row in self.execute_query("PRAGMA table_info(backups)")]
+        self.log_writer.flush()
+        
+        with self.paused_jobs():
+            source = sqlite3.connect(path)
+            try:
+                # كاتب السجل وبقية الجلسات ينتظرون قفل الكتابة طوال النسخ
+                with self._write_lock:
+                    def on_step(status, remaining, total):
+                        if progress and total:
+                            progress((total - remaining) / total)
+                    
+                    source.backup(self.conn, pages=BACKUP_PAGES_PER_STEP, progress=on_step)
+                    self._write_version += 1
+                    self._reader_generation += 1
+                    self.restore_generation += 1
+                    
+                    # النسخة قد تسبق ترحيلات المخطط الحالية
+                    self.prepare_schema()
+                    self._merge_backups_catalog(catalog_columns, catalog)
+                    
+                    # الأرشيفات السنوية لا تُستعاد، فتُزال من الجدول الحالي الحركات المؤرشفة بعد أخذ النسخة
+                    # ويُعاد بناء التجميع ليطابق الحركات الحالية والمؤرشفة معاً قبل عودة المهام
+                    if self.movement_archiver.archive_files():
+                        self.movement_archiver.drop_archived()
+                        self.rebuild_movement_rollups()
+            finally:
+                source.close()
+        
+        self.stats.invalidate()
+        self.reports.invalidate()
+    
+    def _merge_backups_catalog(self, columns, rows):
+        with self.transaction() as cursor:
+            cursor.execute("SELECT file_name FROM backups")
+            existing = {row[0] for row in cursor.fetchall()}
+            cursor.execute("PRAGMA table_info(backups)")
+            current_columns = {row[1] for row in cursor.fetchall()}
+            
+            kept = [column for column in columns if column != 'id' and column in current_columns]
+            for row in rows:
+                record = dict(zip(columns, row))
+                if record['file_name'] in existing:
+                    continue
+                # المستخدم قد لا يكون موجوداً في النسخة المستعادة
+                cursor.execute("SELECT 1 FROM users WHERE id = ?", (record['user_id'],))
+                if not cursor.fetchone():
+                    record['user_id'] = None
+                cursor.execute(
+                    f"INSERT INTO backups ({', '.join(kept)}) VALUES ({', '.join('?' * len(kept))})",
+                    [record[column] for column in kept]
+                )
+    
+    def data_version(self):
+        """مفتاح يتغير مع كل التزام من هذا التطبيق أو من أي اتصال آخر، عدا دفعات كاتب السجل"""
+        with self._write_lock:
+            external = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            return (external, self._write_version)
+    
+    def enable_incremental_vacuum(self):
+        """تفعيل التفريغ التدريجي حتى تعود المساحة المحررة للنظام دون VACUUM كامل"""
+        with self._write_lock:
+            if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # تغيير الوضع في قاعدة موجودة يتطلب VACUUM كاملاً مرة واحدة فقط
+                self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self.conn.execute("VACUUM")
+    
+    def incremental_vacuum(self):
+        """إعادة الصفحات الفارغة إلى نظام الملفات"""
+        with self._write_lock:
+            # executescript تنفذ الأمر حتى نهايته، بينما execute تحرر صفحة واحدة فقط
+            self.conn.executescript("PRAGMA incremental_vacuum")
+    
     def create_tables(self):
         """إنشاء جداول قاعدة البيانات"""
         queries = [
@@ -290,6 +982,39 @@ class DatabaseManager:
             for query in queries:
                 cursor.execute(query)
     
+    def get_schema_version(self):
+        """الحصول على إصدار مخطط قاعدة البيانات"""
+        with self._write_lock:
+            return self.conn.execute("PRAGMA user_version").fetchone()[0]
+    
+    def apply_migrations(self):
+        """تطبيق ترحيلات المخطط المعلقة بالترتيب حسب PRAGMA user_version"""
+        with self._write_lock:
+            current_version = self.get_schema_version()
+            
+            for version, description, steps in sorted(SCHEMA_MIGRATIONS, key=lambda m: m[0]):
+                if version <= current_version:
+                    continue
+                
+                # كل ترحيل في معاملة واحدة مع رقم إصداره حتى لا يُطبق جزئياً
+                cursor = self.conn.cursor()
+                try:
+                    cursor.execute("BEGIN")
+                    for step in steps:
+                        if callable(step):
+                            step(cursor)
+                        else:
+                            cursor.execute(step)
+                    cursor.execute(f"PRAGMA user_version = {int(version)}")
+                    self.conn.commit()
+                except Exception as e:
+                    self.conn.rollback()
+                    raise RuntimeError(f"فشل تطبيق الترحيل {version} ({description}): {e}") from e
+                finally:
+                    cursor.close()
+                
+                current_version = version
+    
     def init_default_data(self):
         """إدخال البيانات الافتراضية"""
         with self.get_cursor() as cursor:
@@ -349,6 +1074,50 @@ class DatabaseManager:
                     ('mega_password', MEGA_PASSWORD, 'كلمة مرور MEGA للنسخ الاحتياطي السحابي')
                 )
             
+            cursor.execute("SELECT * FROM app_settings WHERE setting_key = 'backup_storage'")
+            if not cursor.fetchone():
+                cursor.execute(
+                    "INSERT INTO app_settings (setting_key, setting_value, description) VALUES (?, ?, ?)",
+                    ('backup_storage', 'mega', 'مخزن النسخ السحابية: mega أو local')
+                )
+            
+            cursor.execute("SELECT * FROM app_settings WHERE setting_key = 'backup_storage_dir'")
+            if not cursor.fetchone():
+                cursor.execute(
+                    "INSERT INTO app_settings (setting_key, setting_value, description) VALUES (?, ?, ?)",
+                    ('backup_storage_dir', BACKUP_STORAGE_DIR, 'مجلد المخزن المحلي للنسخ عند اختيار local')
+                )
+            
+            # إعدادات النسخ التلقائي
+            backup_schedule_settings = [
+                ('backup_schedule_enabled', '1', 'تفعيل النسخ الاحتياطي التلقائي'),
+                ('backup_schedule', BACKUP_SCHEDULE, 'جدول النسخ التلقائي بصيغة cron'),
+                ('backup_keep_hourly', str(BACKUP_KEEP_HOURLY), 'عدد النسخ الساعية المحتفظ بها'),
+                ('backup_keep_daily', str(BACKUP_KEEP_DAILY), 'عدد النسخ اليومية المحتفظ بها'),
+                ('backup_keep_weekly', str(BACKUP_KEEP_WEEKLY), 'عدد النسخ الأسبوعية المحتفظ بها'),
+            ]
+            for key, value, description in backup_schedule_settings:
+                cursor.execute("SELECT * FROM app_settings WHERE setting_key = ?", (key,))
+                if not cursor.fetchone():
+                    cursor.execute(
+                        "INSERT INTO app_settings (setting_key, setting_value, description) VALUES (?, ?, ?)",
+                        (key, value, description)
+                    )
+            
+            cursor.execute("SELECT * FROM app_settings WHERE setting_key = 'log_retention_days'")
+            if not cursor.fetchone():
+                cursor.execute(
+                    "INSERT INTO app_settings (setting_key, setting_value, description) VALUES (?, ?, ?)",
+                    ('log_retention_days', str(LOG_RETENTION_DAYS), 'مدة الاحتفاظ بسجل النظام بالأيام')
+                )
+            
+            cursor.execute("SELECT * FROM app_settings WHERE setting_key = 'movement_archive_months'")
+            if not cursor.fetchone():
+                cursor.execute(
+                    "INSERT INTO app_settings (setting_key, setting_value, description) VALUES (?, ?, ?)",
+                    ('movement_archive_months', str(MOVEMENT_ARCHIVE_MONTHS), 'عمر الحركات المنقولة للأرشيف بالأشهر')
+                )
+            
             # إضافة المستودعات الأساسية
             for wh in WAREHOUSES:
                 cursor.execute("SELECT * FROM warehouses WHERE name = ?", (wh['name'],))
@@ -380,6 +1149,12 @@ class DatabaseManager:
     
     def execute_query(self, query, params=()):
         """تنفيذ استعلام مع إرجاع النتائج"""
+        # القراءة داخل وحدة عمل تتم على اتصال الكتابة لترى التغييرات غير الملتزمة
+        if self._is_read_query(query) and not self.in_transaction():
+            with self.read_cursor() as cursor:
+                cursor.execute(query, params)
+                return cursor.fetchall()
+        
         with self.get_cursor() as cursor:
             cursor.execute(query, params)
             return cursor.fetchall()
@@ -390,22 +1165,36 @@ class DatabaseManager:
             cursor.execute(query, params)
             return cursor.lastrowid
     
+    def rebuild_movement_rollups(self):
+        """إعادة بناء جداول تجميع الحركات كاملة من الجدول الحالي والأرشيفات"""
+        with self._write_lock, ExitStack() as stack:
+            sources = ['main.movements']
+            for year, path in self.movement_archiver.archive_files():
+                alias = f"archive_{year}"
+                stack.enter_context(self.attached(path, alias))
+                sources.append(f"{alias}.movements")
+            
+            with self.transaction() as cursor:
+                rebuild_movement_rollups(cursor, sources)
+                cursor.execute(
+                    """INSERT INTO app_settings (setting_key, setting_value, description) VALUES (?, ?, ?)
+                       ON CONFLICT (setting_key) DO UPDATE SET
+                           setting_value = excluded.setting_value, updated_at = CURRENT_TIMESTAMP""",
+                    ('movement_rollups_version', MOVEMENT_ROLLUPS_VERSION, 'إصدار جداول تجميع الحركات')
+                )
+    
     def get_warehouse_count(self, warehouse_id):
-        """الحصول على عدد العربات في مستودع معين"""
+        """الحصول على عدد العربات في مستودع معين (تحدّثه المشغلات تلقائياً)"""
         result = self.execute_query(
-            "SELECT COUNT(*) FROM carts WHERE current_warehouse_id = ? AND status != 'damaged'",
+            "SELECT current_count FROM warehouses WHERE id = ?",
             (warehouse_id,)
         )
         return result[0][0] if result else 0
     
-    def update_warehouse_count(self, warehouse_id):
-        """تحديث عدد العربات في المستودع"""
-        count = self.get_warehouse_count(warehouse_id)
-        with self.get_cursor() as cursor:
-            cursor.execute(
-                "UPDATE warehouses SET current_count = ? WHERE id = ?",
-                (count, warehouse_id)
-            )
+    def recount_all(self):
+        """إصلاح عدادات جميع المستودعات من جدول العربات دفعة واحدة"""
+        with self.transaction() as cursor:
+            recount_warehouse_counters(cursor)
     
     def get_all_warehouses(self):
         """الحصول على جميع المستودعات النشطة"""
@@ -428,53 +1217,2140 @@ class DatabaseManager:
                       'can_view_reports', 'can_export_reports', 'can_manage_users',
                       'can_manage_backup', 'can_change_own_password', 'updated_at']
             
-            permissions = {}
-            for i, col in enumerate(columns):
-                permissions[col] = result[0][i]
-            return permissions
-        else:
-            permissions = DEFAULT_PERMISSIONS.copy()
-            permissions['user_id'] = user_id
-            return permissions
+            permissions = {}
+            for i, col in enumerate(columns):
+                permissions[col] = result[0][i]
+            return permissions
+        else:
+            permissions = DEFAULT_PERMISSIONS.copy()
+            permissions['user_id'] = user_id
+            return permissions
+    
+    def update_user_permissions(self, user_id, permissions):
+        """تحديث صلاحيات المستخدم"""
+        with self.get_cursor() as cursor:
+            cursor.execute("SELECT * FROM user_permissions WHERE user_id = ?", (user_id,))
+            if cursor.fetchone():
+                set_clause = ','.join([f"{key}=?" for key in permissions.keys()])
+                values = list(permissions.values()) + [user_id]
+                cursor.execute(
+                    f"UPDATE user_permissions SET {set_clause}, updated_at=CURRENT_TIMESTAMP WHERE user_id=?",
+                    values
+                )
+            else:
+                columns = ['user_id'] + list(permissions.keys())
+                values = [user_id] + list(permissions.values())
+                placeholders = ','.join(['?' for _ in columns])
+                cursor.execute(
+                    f"INSERT INTO user_permissions ({','.join(columns)}) VALUES ({placeholders})",
+                    values
+                )
+    
+    def log_action(self, user_id, action, description):
+        """تسجيل إجراء في سجل النظام"""
+        if not self.in_transaction():
+            self.log_writer.write(user_id, action, description)
+            return
+        
+        # داخل وحدة عمل يُكتب القيد مع التزامها فلا يكلف مزامنة إضافية ولا يبقى إن تراجعت
+        try:
+            with self.get_cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO system_logs (user_id, action, description) VALUES (?, ?, ?)",
+                    (user_id, action, description)
+                )
+        except sqlite3.Error:
+            # القيد لا يضيع: يُكتب بعد المعاملة عبر كاتب السجل الذي يسجل خطأه إن تكرر
+            self.log_writer.write(user_id, action, description)
+    
+    def log_error(self, action, description):
+        """تسجيل خطأ من خيط خلفي في سجل النظام حتى يصل للمدير بدلاً من مخرجات الخادم"""
+        self.log_writer.write(None, action, description)
+
+# ================================ كاتب سجل النظام ================================
+class LogWriter:
+    """كتابة سجل النظام على دفعات في خيط خلفي بدلاً من التزام مستقل لكل إجراء"""
+    _STOP = object()
+    
+    def __init__(self, db, batch_size=LOG_BATCH_SIZE, flush_interval_ms=LOG_FLUSH_INTERVAL_MS,
+                 max_queue=LOG_QUEUE_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self.queue = queue.Queue(maxsize=max_queue)
+        # آخر فشل في الكتابة، يظهر للمدير في إعدادات النظام لأن السجل نفسه هو ما تعذرت الكتابة فيه
+        self.last_error = None
+        
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def write(self, user_id, action, description):
+        """إضافة قيد للطابور، وينتظر المستدعي إذا امتلأ الطابور"""
+        # الوقت يُسجل لحظة الإجراء لا لحظة الكتابة، بتوقيت UTC مثل CURRENT_TIMESTAMP
+        timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        self.queue.put((user_id, action, description, timestamp))
+    
+    def flush(self):
+        """الانتظار حتى تُكتب كل القيود الموجودة في الطابور"""
+        if self._thread.is_alive():
+            self.queue.join()
+    
+    def close(self):
+        """كتابة ما تبقى وإيقاف الخيط عند إغلاق التطبيق"""
+        if self._thread.is_alive():
+            self.queue.put(self._STOP)
+            self._thread.join(timeout=10)
+    
+    def _run(self):
+        batch = []
+        deadline = 0
+        while True:
+            timeout = max(0, deadline - time.monotonic()) if batch else None
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            
+            if item is self._STOP:
+                self._write(batch)
+                self.queue.task_done()
+                return
+            
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+            
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch = []
+    
+    def _write(self, batch):
+        """كتابة دفعة واحدة بالتزام واحد"""
+        if not batch:
+            return
+        
+        try:
+            with self.db.get_cursor(log_only=True) as cursor:
+                cursor.executemany(
+                    "INSERT INTO system_logs (user_id, action, description, timestamp) VALUES (?, ?, ?, ?)",
+                    batch
+                )
+        except sqlite3.Error as e:
+            self.last_error = f"{batch[-1][3]} UTC: تعذرت كتابة {len(batch)} قيد: {e}"
+        finally:
+            for _ in batch:
+                self.queue.task_done()
+
+# ================================ المهام الدورية ================================
+class BackgroundJob(ABC):
+    """دورة حياة خيط خلفي يمكن إيقافه مؤقتاً وإعادة تشغيله؛ الحلقة نفسها في _run"""
+    
+    def __init__(self, name):
+        self.name = name
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+    
+    def start(self):
+        with self._lock:
+            # خيط لم يخرج بعد يرى إلغاء الإيقاف ويكمل دورته بدلاً من أن ينتهي
+            self._stop.clear()
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+    
+    def stop(self, wait=False):
+        """طلب الإيقاف؛ مع wait تُرجع False إذا بقيت المهمة تعمل بعد مهلة الانتظار"""
+        self._stop.set()
+        thread = self._thread
+        if wait and thread:
+            thread.join(timeout=JOB_STOP_TIMEOUT)
+        return thread is None or not thread.is_alive()
+    
+    def _stopped(self):
+        """قرار الخروج تحت القفل حتى لا يضيع start() يصل بين فحص الإيقاف وانتهاء الخيط"""
+        with self._lock:
+            if self._stop.is_set():
+                self._thread = None
+                return True
+            return False
+    
+    @abstractmethod
+    def _run(self):
+        """حلقة الخيط؛ تخرج فقط عندما تُرجع _stopped() قيمة True"""
+
+
+class PeriodicJob(BackgroundJob):
+    """تشغيل مهمة صيانة بشكل دوري في خيط خلفي"""
+    
+    def __init__(self, name, interval, func, initial_delay=60, on_error=None):
+        super().__init__(name)
+        self.interval = interval
+        self.func = func
+        self.initial_delay = initial_delay
+        self.on_error = on_error
+    
+    def _run(self):
+        delay = self.initial_delay
+        while True:
+            if self._stop.wait(delay):
+                if self._stopped():
+                    return
+                continue  # أُعيد التشغيل قبل الخروج فتستمر الدورة
+            try:
+                self.func()
+            except Exception as e:
+                if self.on_error:
+                    self.on_error('job_error', f'خطأ في المهمة الدورية {self.name}: {e}')
+            delay = self.interval
+
+# ================================ أرشفة سجل النظام ================================
+class LogRetention:
+    """نقل قيود سجل النظام القديمة إلى ملفات شهرية مضغوطة وحذفها من القاعدة"""
+    COLUMNS = ['id', 'user_id', 'action', 'description', 'timestamp']
+    
+    def __init__(self, db, archive_dir=LOG_ARCHIVE_DIR, batch_size=LOG_ARCHIVE_BATCH):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+    
+    def cutoff(self):
+        """حد الأرشفة بتوقيت UTC مثل أعمدة CURRENT_TIMESTAMP، أو None إذا كانت معطلة"""
+        try:
+            days = int(self.db.get_app_setting('log_retention_days', LOG_RETENTION_DAYS))
+        except (TypeError, ValueError):
+            days = LOG_RETENTION_DAYS
+        if days <= 0:
+            return None
+        return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - days * 86400))
+    
+    def run(self):
+        """أرشفة القيود الأقدم من مدة الاحتفاظ على دفعات، وإرجاع عددها"""
+        cutoff = self.cutoff()
+        if cutoff is None:
+            return 0
+        
+        with self._lock:
+            archived = 0
+            while True:
+                rows = self.db.execute_query(f"""
+                    SELECT {', '.join(self.COLUMNS)} FROM system_logs
+                    WHERE timestamp < ?
+                    ORDER BY timestamp
+                    LIMIT ?
+                """, (cutoff, self.batch_size))
+                if not rows:
+                    break
+                
+                # الكتابة في الأرشيف تسبق الحذف حتى لا يضيع قيد إذا توقف التطبيق بينهما
+                self._archive(rows)
+                with self.db.transaction() as cursor:
+                    cursor.executemany("DELETE FROM system_logs WHERE id = ?", [(row[0],) for row in rows])
+                archived += len(rows)
+            
+            if archived:
+                self.db.incremental_vacuum()
+            return archived
+    
+    def archive_path(self, month):
+        return os.path.join(self.archive_dir, f"system_logs_{month}.jsonl.gz")
+    
+    def _archive(self, rows):
+        """إلحاق القيود بملف الشهر الخاص بكل منها"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        
+        by_month = {}
+        for row in rows:
+            month = (row[4] or '')[:7] or 'unknown'
+            by_month.setdefault(month, []).append(row)
+        
+        for month, month_rows in by_month.items():
+            # الإلحاق بملف gzip يضيف مقطعاً جديداً، وgzip.open يقرأ المقاطع كلها كملف واحد
+            with gzip.open(self.archive_path(month), 'at', encoding='utf-8') as f:
+                for row in month_rows:
+                    f.write(json.dumps(dict(zip(self.COLUMNS, row)), ensure_ascii=False) + '\n')
+
+# ================================ أرشفة الحركات ================================
+class MovementArchiver:
+    """نقل الحركات القديمة إلى قواعد بيانات سنوية تُرفق عند الحاجة فقط"""
+    
+    def __init__(self, db, archive_dir=MOVEMENT_ARCHIVE_DIR, batch_size=MOVEMENT_ARCHIVE_BATCH):
+        self.db = db
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+    
+    def archive_path(self, year):
+        return os.path.join(self.archive_dir, f"movements_{year}.db")
+    
+    def archive_files(self):
+        """قائمة (السنة، المسار) لملفات الأرشيف الموجودة"""
+        if not os.path.isdir(self.archive_dir):
+            return []
+        
+        files = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            year = name[len('movements_'):-len('.db')]
+            if name.startswith('movements_') and name.endswith('.db') and year.isdigit():
+                files.append((year, os.path.join(self.archive_dir, name)))
+        return files
+    
+    def cutoff(self):
+        """حد الأرشفة بتوقيت UTC، أو None إذا كانت معطلة"""
+        try:
+            months = int(self.db.get_app_setting('movement_archive_months', MOVEMENT_ARCHIVE_MONTHS))
+        except (TypeError, ValueError):
+            months = MOVEMENT_ARCHIVE_MONTHS
+        if months <= 0:
+            return None
+        return self.db.execute_query("SELECT datetime('now', ?)", (f'-{months} months',))[0][0]
+    
+    def run(self):
+        """نقل الحركات الأقدم من حد الأرشفة على دفعات، وإرجاع عددها"""
+        cutoff = self.cutoff()
+        if cutoff is None:
+            return 0
+        
+        with self._lock:
+            moved = 0
+            while True:
+                rows = self.db.execute_query("""
+                    SELECT id, timestamp FROM movements
+                    WHERE timestamp < ?
+                    ORDER BY timestamp
+                    LIMIT ?
+                """, (cutoff, self.batch_size))
+                if not rows:
+                    break
+                
+                # كل دفعة تذهب لملف سنة واحدة
+                year = rows[0][1][:4]
+                ids = [(movement_id,) for movement_id, timestamp in rows if timestamp[:4] == year]
+                self._move(year, ids)
+                moved += len(ids)
+            
+            if moved:
+                self.db.incremental_vacuum()
+            return moved
+    
+    def drop_archived(self):
+        """حذف الحركات الموجودة في الأرشيفات من الجدول الحالي بعد استعادة نسخة أقدم من آخر أرشفة، وإرجاع عددها"""
+        removed = 0
+        with self._lock:
+            for year, path in self.archive_files():
+                alias = f"archive_{year}"
+                with self.db.attached(path, alias), self.db.transaction() as cursor:
+                    # جداول التجميع يعاد بناؤها بعد الاستعادة فلا حاجة لمشغل الطرح هنا
+                    cursor.execute("INSERT OR IGNORE INTO main.movement_rollup_hold (id) VALUES (1)")
+                    cursor.execute(f"DELETE FROM main.movements WHERE id IN (SELECT id FROM {alias}.movements)")
+                    removed += cursor.rowcount
+                    cursor.execute("DELETE FROM main.movement_rollup_hold")
+                    # العداد المستعاد قد يعيد إعطاء معرفات مؤرشفة لحركات جديدة فتُسقطها الأرشفة القادمة بـ OR IGNORE
+                    cursor.execute(f"""
+                        UPDATE main.sqlite_sequence
+                        SET seq = MAX(seq, COALESCE((SELECT MAX(id) FROM {alias}.movements), 0))
+                        WHERE name = 'movements'
+                    """)
+        return removed
+    
+    def _move(self, year, ids):
+        """نسخ دفعة إلى قاعدة السنة ثم حذفها من الجدول الحالي"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        alias = f"archive_{year}"
+        columns = ', '.join(MOVEMENT_COLUMNS)
+        
+        with self.db.attached(self.archive_path(year), alias):
+            with self.db.transaction() as cursor:
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {alias}.movements (
+                        id INTEGER PRIMARY KEY,
+                        cart_id INTEGER NOT NULL,
+                        from_warehouse_id INTEGER,
+                        to_warehouse_id INTEGER NOT NULL,
+                        timestamp DATETIME,
+                        user_id INTEGER,
+                        notes TEXT
+                    )
+                """)
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {alias}.idx_movements_timestamp ON movements (timestamp)")
+                
+                # في وضع WAL لا تكون المعاملة ذرية عبر الملفين، وOR IGNORE يجعل إعادة الدفعة بعد انقطاع آمنة
+                cursor.executemany(
+                    f"INSERT OR IGNORE INTO {alias}.movements ({columns}) SELECT {columns} FROM main.movements WHERE id = ?",
+                    ids
+                )
+                # الحركات المنقولة تبقى محسوبة في جداول التجميع فيُعلّق مشغل الطرح طوال الحذف
+                cursor.execute("INSERT OR IGNORE INTO main.movement_rollup_hold (id) VALUES (1)")
+                cursor.executemany("DELETE FROM main.movements WHERE id = ?", ids)
+                cursor.execute("DELETE FROM main.movement_rollup_hold")
+
+# ================================ لقطة الإحصائيات ================================
+class StatsSnapshot:
+    """الإحصائيات الرئيسية باستعلام تجميع واحد مع تخزين مؤقت حتى تتغير البيانات"""
+    FIELDS = [
+        'total_carts', 'sound_carts', 'maintenance_carts', 'damaged_carts',
+        'total_warehouses', 'total_movements', 'today_movements', 'total_users',
+        'pending_maintenance', 'in_progress_maintenance', 'completed_maintenance',
+        'total_maintenance', 'total_cost'
+    ]
+    
+    QUERY = """
+        SELECT
+            (SELECT COUNT(*) FROM carts),
+            (SELECT COUNT(*) FROM carts WHERE status = 'sound'),
+            (SELECT COUNT(*) FROM carts WHERE status = 'needs_maintenance'),
+            (SELECT COUNT(*) FROM carts WHERE status = 'damaged'),
+            (SELECT COUNT(*) FROM warehouses WHERE is_active = 1),
+            (SELECT SUM(movement_count) FROM movement_daily),
+            (SELECT movement_count FROM movement_daily WHERE day = :today),
+            (SELECT COUNT(*) FROM users WHERE is_active = 1),
+            (SELECT COUNT(*) FROM maintenance_records WHERE status = 'pending'),
+            (SELECT COUNT(*) FROM maintenance_records WHERE status = 'in_progress'),
+            (SELECT COUNT(*) FROM maintenance_records WHERE status = 'completed'),
+            (SELECT COUNT(*) FROM maintenance_records),
+            (SELECT SUM(cost) FROM maintenance_records WHERE status = 'completed')
+    """
+    
+    def __init__(self, db):
+        self.db = db
+        self._lock = threading.Lock()
+        self._version = None
+        self._snapshot = None
+    
+    def get(self):
+        """الحصول على الإحصائيات، وإعادة حسابها فقط عند تغير البيانات أو اليوم"""
+        today = local_today().isoformat()
+        version = (self.db.data_version(), today)
+        with self._lock:
+            if self._snapshot is not None and self._version == version:
+                return self._snapshot
+        
+        with self.db.read_cursor() as cursor:
+            cursor.execute(self.QUERY, {'today': today})
+            row = cursor.fetchone()
+        
+        snapshot = {field: (value or 0) for field, value in zip(self.FIELDS, row)}
+        with self._lock:
+            self._snapshot = snapshot
+            self._version = version
+        return snapshot
+    
+    def invalidate(self):
+        """إسقاط اللقطة المحفوظة"""
+        with self._lock:
+            self._snapshot = None
+            self._version = None
+
+# ================================ محرك التقارير ================================
+ReportResult = namedtuple('ReportResult', ['columns', 'rows'])
+
+
+class ReportEngine:
+    """بناء بيانات التقارير بمعزل عن عرضها، مع ذاكرة LRU مشتركة بين الجلسات حتى تتغير البيانات"""
+    PERIOD_REPORTS = ("تقرير حركة العربات", "تقرير الصيانة")
+    
+    def __init__(self, db, max_bytes=REPORT_CACHE_MAX_BYTES):
+        self.db = db
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()  # المفتاح -> (النتيجة، الحجم التقريبي)
+        self._size = 0
+        self._lock = threading.Lock()
+        self.builders = {
+            "تقرير حالة العربات": self.cart_status_report,
+            "تقرير حركة العربات": self.movement_report,
+            "تقرير الصيانة": self.maintenance_report,
+            "تقرير المستودعات": self.warehouse_report,
+            "تقرير شامل": self.summary_report,
+        }
+    
+    def get(self, report_type, period=None):
+        """نتيجة التقرير من الذاكرة، أو بناؤها إذا تغيرت البيانات منذ آخر مرة"""
+        builder = self.builders.get(report_type)
+        if builder is None:
+            raise ValueError(f"نوع تقرير غير معروف: {report_type}")
+        
+        # الفترة تدخل في المفتاح بحدودها الفعلية حتى يتجدد تقرير "اليوم" مع تغير التاريخ
+        period_range = local_period_range(period) if report_type in self.PERIOD_REPORTS else None
+        key = (report_type, period_range, self.db.data_version())
+        
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                return entry[0]
+        
+        result = builder(period_range)
+        self._store(key, result)
+        return result
+    
+    def invalidate(self):
+        """مسح الذاكرة بالكامل"""
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+    
+    def _store(self, key, result):
+        size = self._estimate_size(result)
+        if size > self.max_bytes:
+            return
+        
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = (result, size)
+            self._size += size
+            # إخراج الأقدم استخداماً حتى يعود الحجم تحت الحد
+            while self._size > self.max_bytes:
+                _, (_, old_size) = self._cache.popitem(last=False)
+                self._size -= old_size
+    
+    @staticmethod
+    def _estimate_size(result):
+        return sum(sys.getsizeof(cell) for row in result.rows for cell in row) + 64 * len(result.rows)
+    
+    @staticmethod
+    def _result(columns, rows):
+        return ReportResult(tuple(columns), tuple(tuple(row) for row in rows))
+    
+    def cart_status_report(self, period_range):
+        data = self.db.execute_query("""
+            SELECT 
+                status,
+                COUNT(*) as count,
+                ROUND(COUNT(*) * 100.0 / (SELECT COUNT(*) FROM carts), 2) as percentage
+            FROM carts
+            GROUP BY status
+            UNION
+            SELECT 'الإجمالي', COUNT(*), 100.0 FROM carts
+        """)
+        
+        rows = []
+        for status, count, percentage in data:
+            status_text = CART_STATUS.get(status, status) if status != 'الإجمالي' else status
+            rows.append((status_text, str(count), f"{percentage}%"))
+        return self._result(["الحالة", "العدد", "النسبة المئوية"], rows)
+    
+    def movement_report(self, period_range):
+        # نطاق نصف مفتوح على مفتاح اليوم المحلي يستفيد من المفتاح الأساسي لجدول التجميع
+        limit = ""
+        params = ()
+        if period_range:
+            limit = "AND day >= ? AND day < ?"
+            params = period_range
+        
+        # جدول التجميع اليومي يشمل الحركات المؤرشفة أيضاً
+        data = self.db.execute_query(f"""
+            SELECT day, movement_count, distinct_carts
+            FROM movement_daily
+            WHERE movement_count > 0 {limit}
+            ORDER BY day DESC
+            LIMIT 10
+        """, params)
+        
+        rows = [(day or "", str(count), str(carts)) for day, count, carts in data]
+        return self._result(["التاريخ", "عدد الحركات", "عربات مختلفة"], rows)
+    
+    def maintenance_report(self, period_range):
+        limit = ""
+        params = ()
+        if period_range:
+            limit = "AND local_day >= ? AND local_day < ?"
+            params = period_range
+        
+        data = self.db.execute_query(f"""
+            SELECT 
+                status,
+                COUNT(*) as count,
+                SUM(cost) as total_cost
+            FROM maintenance_records
+            WHERE 1=1 {limit}
+            GROUP BY status
+        """, params)
+        
+        rows = []
+        for status, count, total_cost in data:
+            status_text = MAINTENANCE_STATUS.get(status, status)
+            rows.append((status_text, str(count), f"{total_cost or 0:.0f} ر.س"))
+        return self._result(["حالة الصيانة", "العدد", "التكلفة الإجمالية"], rows)
+    
+    def warehouse_report(self, period_range):
+        data = self.db.execute_query("""
+            SELECT 
+                name,
+                capacity,
+                current_count,
+                ROUND(current_count * 100.0 / capacity, 2) as occupancy
+            FROM warehouses
+            WHERE is_active = 1
+            ORDER BY occupancy DESC
+        """)
+        
+        rows = [(name, str(capacity), str(current), f"{occupancy}%") for name, capacity, current, occupancy in data]
+        return self._result(["المستودع", "السعة", "العدد الحالي", "نسبة الإشغال"], rows)
+    
+    @contextmanager
+    def detail_rows(self, report_type, period=None):
+        """بث صفوف التفاصيل الكاملة لتقارير الحركة والصيانة مباشرة من المؤشر"""
+        period_range = local_period_range(period)
+        if report_type == "تقرير حركة العربات":
+            with self.db.movement_history() as cursor:
+                yield self._movement_rows(cursor, period_range)
+        elif report_type == "تقرير الصيانة":
+            with self.db.read_cursor() as cursor:
+                yield self._maintenance_rows(cursor, period_range)
+        else:
+            yield self.get(report_type, period)
+    
+    def _movement_rows(self, cursor, period_range):
+        limit = ""
+        params = ()
+        if period_range:
+            # مقارنة الطابع الخام بحدود UTC تستفيد من فهرس التوقيت في كل أرشيف
+            limit = "WHERE m.timestamp >= ? AND m.timestamp < ?"
+            params = utc_timestamp_range(period_range)
+        
+        cursor.execute(f"""
+            SELECT 
+                m.id,
+                DATETIME(m.timestamp, '{LOCAL_TIME_MODIFIER}'),
+                c.serial_number,
+                w1.name,
+                w2.name,
+                u.username,
+                m.notes
+            FROM movements_all m
+            LEFT JOIN carts c ON m.cart_id = c.id
+            LEFT JOIN warehouses w1 ON m.from_warehouse_id = w1.id
+            LEFT JOIN warehouses w2 ON m.to_warehouse_id = w2.id
+            LEFT JOIN users u ON m.user_id = u.id
+            {limit}
+            ORDER BY m.timestamp
+        """, params)
+        columns = ("رقم الحركة", "التاريخ", "رقم العربة", "من", "إلى", "المستخدم", "ملاحظات")
+        return ReportResult(columns, iter_cursor(cursor))
+    
+    def _maintenance_rows(self, cursor, period_range):
+        limit = ""
+        params = ()
+        if period_range:
+            limit = "WHERE m.local_day >= ? AND m.local_day < ?"
+            params = period_range
+        
+        cursor.execute(f"""
+            SELECT 
+                m.id,
+                DATETIME(m.entry_date, '{LOCAL_TIME_MODIFIER}'),
+                c.serial_number,
+                m.maintenance_type,
+                m.status,
+                m.description,
+                DATETIME(m.completion_date, '{LOCAL_TIME_MODIFIER}'),
+                u.username,
+                m.cost
+            FROM maintenance_records m
+            LEFT JOIN carts c ON m.cart_id = c.id
+            LEFT JOIN users u ON m.user_id = u.id
+            {limit}
+            ORDER BY m.entry_date
+        """, params)
+        columns = ("رقم السجل", "تاريخ الدخول", "رقم العربة", "نوع الصيانة", "الحالة",
+                   "الوصف", "تاريخ الإكمال", "المستخدم", "التكلفة")
+        rows = (row[:4] + (MAINTENANCE_STATUS.get(row[4], row[4]),) + row[5:] for row in iter_cursor(cursor))
+        return ReportResult(columns, rows)
+    
+    def summary_report(self, period_range):
+        stats = self.db.stats.get()
+        total_carts = stats['total_carts']
+        sound_carts = stats['sound_carts']
+        maintenance_carts = stats['maintenance_carts']
+        damaged_carts = stats['damaged_carts']
+        total_warehouses = stats['total_warehouses']
+        total_movements = stats['total_movements']
+        total_maintenance = stats['total_maintenance']
+        total_cost = stats['total_cost']
+        total_users = stats['total_users']
+        
+        # بيانات الجلسة (المستخدم والتاريخ) تضاف عند العرض حتى تبقى النتيجة قابلة للمشاركة
+        rows = [
+            ("إجمالي العربات", f"{total_carts} عربة"),
+            ("عربات سليمة", f"{sound_carts} عربة ({sound_carts/total_carts*100:.1f}%)" if total_carts > 0 else "0"),
+            ("تحتاج صيانة", f"{maintenance_carts} عربة ({maintenance_carts/total_carts*100:.1f}%)" if total_carts > 0 else "0"),
+            ("عربات تالفة", f"{damaged_carts} عربة ({damaged_carts/total_carts*100:.1f}%)" if total_carts > 0 else "0"),
+            ("عدد المستودعات", f"{total_warehouses} مستودع"),
+            ("إجمالي الحركات", f"{total_movements} حركة"),
+            ("عمليات الصيانة", f"{total_maintenance} عملية"),
+            ("تكاليف الصيانة", f"{total_cost:.0f} ر.س"),
+            ("المستخدمين النشطين", f"{total_users} مستخدم"),
+        ]
+        return self._result(["المؤشر", "القيمة"], rows)
+
+# ================================ الجداول المجزأة ================================
+def escape_like(text):
+    """تهريب الرموز الخاصة في LIKE (تُستخدم مع ESCAPE '\\')"""
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def like_prefix(text):
+    """نمط LIKE للبحث بالبادئة"""
+    return f"{escape_like(text)}%"
+
+
+def like_contains(text):
+    """نمط LIKE للبحث عن النص في أي موضع"""
+    return f"%{escape_like(text)}%"
+
+
+class TableRows:
+    """صفوف جدول مفهرسة بالمفتاح الأساسي لتعديل صف واحد دون إعادة بناء الجدول"""
+    
+    def __init__(self, page, table, build_row):
+        # build_row(record) تبني صف الجدول والمفتاح الأساسي أول عمود في السجل
+        self.page = page
+        self.table = table
+        self.build_row = build_row
+        self.rows_by_key = {}
+    
+    def load(self, records):
+        """عرض مجموعة كاملة من السجلات بدلاً من الصفوف الحالية"""
+        self.rows_by_key = {}
+        self.table.rows = [self._add_row(record) for record in records]
+        self.page.update()
+    
+    def insert_row(self, record, index=0):
+        """إضافة صف جديد (أعلى الجدول افتراضياً)"""
+        self.table.rows.insert(index, self._add_row(record))
+        self.page.update()
+    
+    def replace_row(self, record):
+        """تحديث صف موجود في مكانه، وتُرجع False إذا لم يكن معروضاً"""
+        row = self.rows_by_key.get(record[0])
+        if row is None:
+            return False
+        
+        new_row = self.build_row(record)
+        row.cells = new_row.cells
+        row.color = new_row.color
+        self.page.update()
+        return True
+    
+    def remove_row(self, key):
+        """حذف صف بمفتاحه، وتُرجع False إذا لم يكن معروضاً"""
+        row = self.rows_by_key.pop(key, None)
+        if row is None:
+            return False
+        
+        self.table.rows.remove(row)
+        self.page.update()
+        return True
+    
+    def _add_row(self, record):
+        row = self.build_row(record)
+        self.rows_by_key[record[0]] = row
+        return row
+
+
+class PagedTable(TableRows):
+    """جدول يُحمّل صفوفه بترقيم المفاتيح عند التمرير ويُبقي نافذة محدودة منها فقط"""
+    
+    def __init__(self, page, table, fetch_page, build_row, height=550,
+                 page_size=TABLE_PAGE_SIZE, window_pages=TABLE_WINDOW_PAGES, row_height=50):
+        # fetch_page(after_key, before_key, limit) تُرجع السجلات بترتيب العرض والمفتاح أول عمود
+        super().__init__(page, table, build_row)
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.window_pages = window_pages
+        self.row_height = row_height
+        
+        self.pages = []  # كل صفحة قائمة بمفاتيح صفوفها
+        self.has_more_after = False
+        self.has_more_before = False
+        self._loading = threading.Lock()
+        
+        self.view = ft.Column(
+            [table],
+            scroll=ft.ScrollMode.AUTO,
+            height=height,
+            on_scroll=self._on_scroll,
+            on_scroll_interval=100
+        )
+    
+    def reset(self):
+        """إعادة تحميل الجدول من الصفحة الأولى"""
+        self.show_first_page(self.fetch_page(None, None, self.page_size))
+    
+    def show_first_page(self, records):
+        """استبدال النافذة الحالية بصفحة أولى جاهزة (مثل نتيجة بحث)"""
+        with self._loading:
+            self.rows_by_key = {}
+            self.pages = [self._build_page(records)] if records else []
+            self.has_more_after = len(records) == self.page_size
+            self.has_more_before = False
+            self._render()
+            self.view.scroll_to(offset=0, duration=0)
+    
+    def load_next(self):
+        """جلب الصفحة التالية وإسقاط أقدم صفحة إذا امتلأت النافذة"""
+        if not self.has_more_after or not self.pages or not self._loading.acquire(blocking=False):
+            return
+        try:
+            last_key = self.pages[-1][-1]
+            records = self.fetch_page(last_key, None, self.page_size)
+            self.has_more_after = len(records) == self.page_size
+            if not records:
+                return
+            
+            self.pages.append(self._build_page(records))
+            dropped = 0
+            if len(self.pages) > self.window_pages:
+                dropped = self._drop_page(0)
+                self.has_more_before = True
+            
+            self._render()
+            if dropped:
+                # الحفاظ على موضع القراءة بعد إزالة الصفوف العلوية
+                self.view.scroll_to(delta=-dropped * self.row_height, duration=0)
+        finally:
+            self._loading.release()
+    
+    def load_previous(self):
+        """جلب الصفحة السابقة عند الرجوع للأعلى وإسقاط آخر صفحة"""
+        if not self.has_more_before or not self.pages or not self._loading.acquire(blocking=False):
+            return
+        try:
+            first_key = self.pages[0][0]
+            records = self.fetch_page(None, first_key, self.page_size)
+            self.has_more_before = len(records) == self.page_size
+            if not records:
+                return
+            
+            self.pages.insert(0, self._build_page(records))
+            if len(self.pages) > self.window_pages:
+                self._drop_page(-1)
+                self.has_more_after = True
+            
+            self._render()
+            self.view.scroll_to(delta=len(records) * self.row_height, duration=0)
+        finally:
+            self._loading.release()
+    
+    def insert_row(self, record, index=0):
+        """إضافة صف جديد أعلى الجدول إذا كانت الصفحة الأولى معروضة"""
+        with self._loading:
+            # إذا كانت أعلى الصفحات خارج النافذة سيظهر الصف عند الرجوع إليها
+            if self.has_more_before:
+                return False
+            
+            if not self.pages:
+                self.pages.append([])
+            self.pages[0].insert(0, record[0])
+            super().insert_row(record, 0)
+            return True
+    
+    def replace_row(self, record):
+        with self._loading:
+            return super().replace_row(record)
+    
+    def remove_row(self, key):
+        with self._loading:
+            if not super().remove_row(key):
+                return False
+            
+            for page_keys in self.pages:
+                if key in page_keys:
+                    page_keys.remove(key)
+                    break
+            self.pages = [page_keys for page_keys in self.pages if page_keys]
+            return True
+    
+    def _build_page(self, records):
+        """تحويل سجلات صفحة إلى صفوف جدول وإرجاع مفاتيحها"""
+        keys = []
+        for record in records:
+            self._add_row(record)
+            keys.append(record[0])
+        return keys
+    
+    def _drop_page(self, index):
+        """إخراج صفحة من النافذة وتحرير صفوفها، وتُرجع عدد الصفوف المحذوفة"""
+        page_keys = self.pages.pop(index)
+        for key in page_keys:
+            self.rows_by_key.pop(key, None)
+        return len(page_keys)
+    
+    def _render(self):
+        """عرض صفوف النافذة الحالية فقط"""
+        self.table.rows = [self.rows_by_key[key] for page_keys in self.pages for key in page_keys]
+        self.page.update()
+    
+    def _on_scroll(self, e):
+        """تحميل الصفحات عند الاقتراب من حافتي التمرير"""
+        threshold = self.row_height * 5
+        if e.pixels >= e.max_scroll_extent - threshold:
+            self.load_next()
+        elif e.pixels <= e.min_scroll_extent + threshold:
+            self.load_previous()
+
+# ================================ البحث المؤجل ================================
+class SearchDebouncer:
+    """تجميع ضغطات المفاتيح وتنفيذ البحث في خيط خلفي واحد مشترك بين الجلسات مع إسقاط النتائج المتجاوزة"""
+    
+    def __init__(self, delay_ms=SEARCH_DEBOUNCE_MS, on_error=None):
+        self.delay = delay_ms / 1000
+        self.on_error = on_error
+        self._pending = {}  # المفتاح -> (موعد التنفيذ، الجيل، دالة الجلب، دالة العرض)
+        self._generations = {}
+        self._cond = threading.Condition()
+        
+        # خيط دائم واحد يعيد استخدام اتصال القراءة الخاص به بين عمليات البحث
+        self._thread = threading.Thread(target=self._run, name="search-worker", daemon=True)
+        self._thread.start()
+    
+    def submit(self, key, fetch, apply, delay_ms=None):
+        """جدولة بحث يحل محل أي بحث سابق بنفس المفتاح"""
+        delay = self.delay if delay_ms is None else delay_ms / 1000
+        with self._cond:
+            generation = self._generations.get(key, 0) + 1
+            self._generations[key] = generation
+            self._pending[key] = (time.monotonic() + delay, generation, fetch, apply)
+            self._cond.notify()
+    
+    def session(self):
+        """واجهة بحث خاصة بجلسة واحدة تعزل مفاتيحها عن بقية الجلسات"""
+        return SearchSession(self)
+    
+    def cancel_all(self, owner):
+        """إلغاء كل عمليات البحث المعلقة أو الجارية لجلسة واحدة (عند تغيير الصفحة)"""
+        with self._cond:
+            for key in self._generations:
+                if key[0] is owner:
+                    self._generations[key] += 1
+            for key in [key for key in self._pending if key[0] is owner]:
+                del self._pending[key]
+    
+    def forget(self, owner):
+        """إزالة كل ما يخص جلسة أُغلقت، فتسقط نتائج بحثها الجاري أيضاً"""
+        with self._cond:
+            for table in (self._generations, self._pending):
+                for key in [key for key in table if key[0] is owner]:
+                    del table[key]
+    
+    def _is_current(self, key, generation):
+        with self._cond:
+            return self._generations.get(key) == generation
+    
+    def _next_due(self):
+        """انتظار أول طلب حان موعده وإخراجه من قائمة الانتظار"""
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                
+                key, (due, generation, fetch, apply) = min(self._pending.items(), key=lambda item: item[1][0])
+                remaining = due - time.monotonic()
+                if remaining <= 0:
+                    del self._pending[key]
+                    return key, generation, fetch, apply
+                self._cond.wait(remaining)
+    
+    def _run(self):
+        while True:
+            key, generation, fetch, apply = self._next_due()
+            try:
+                result = fetch()
+                # نتيجة بحث تجاوزه المستخدم لا تُعرض
+                if self._is_current(key, generation):
+                    apply(result)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error('search_error', f'خطأ في البحث: {e}')
+
+
+class SearchSession:
+    """مفاتيح البحث الخاصة بجلسة متصفح واحدة على العامل المشترك"""
+    
+    def __init__(self, debouncer):
+        self.debouncer = debouncer
+    
+    def submit(self, key, fetch, apply, delay_ms=None):
+        self.debouncer.submit((self, key), fetch, apply, delay_ms)
+    
+    def cancel_all(self):
+        self.debouncer.cancel_all(self)
+    
+    def close(self):
+        self.debouncer.forget(self)
+
+# ================================ مهام التصدير ================================
+class ExportCancelled(Exception):
+    """إلغاء مهمة تصدير من قبل المستخدم"""
+
+
+def purge_stale_exports(max_age=EXPORT_TTL):
+    """حذف مجلدات التصدير المتبقية من تشغيل سابق توقف فجأة.
+    تُستدعى مرة واحدة عند بدء العملية، لأن تاريخ المجلد لا يتغير أثناء كتابة ملف تصدير طويل فيه"""
+    if not os.path.isdir(EXPORTS_DIR):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(EXPORTS_DIR):
+        path = os.path.join(EXPORTS_DIR, name)
+        try:
+            if os.path.getmtime(path) >= cutoff:
+                continue
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class ExportJob:
+    """مهمة تصدير واحدة وحالتها كما تظهر في منطقة التنزيلات"""
+    _ids = itertools.count(1)
+    
+    def __init__(self, title, filename, on_progress=None):
+        self.id = next(self._ids)
+        self.title = title
+        self.filename = filename
+        # مجلد التصدير يُقدَّم للمتصفح دون تسجيل دخول، فكل مهمة في مجلد باسم عشوائي لا يمكن تخمينه
+        self.token = secrets.token_urlsafe(24)
+        self.dir = os.path.join(EXPORTS_DIR, self.token)
+        self.path = os.path.join(self.dir, filename)
+        self.status = 'pending'  # pending, running, done, failed, cancelled, expired
+        self.rows_written = 0
+        self.total_rows = None
+        self.error = None
+        self._cancel = threading.Event()
+        self._on_progress = on_progress
+        self._last_notify = 0
+    
+    @property
+    def progress(self):
+        """نسبة الإنجاز، أو None إذا كان العدد الكلي غير معروف"""
+        if self.status == 'done':
+            return 1
+        if not self.total_rows:
+            return None
+        return min(self.rows_written / self.total_rows, 1)
+    
+    @property
+    def is_active(self):
+        return self.status in ('pending', 'running')
+    
+    @property
+    def url(self):
+        """مسار التنزيل في نسخة الويب"""
+        return f"/exports/{self.token}/{quote(self.filename)}"
+    
+    def cancel(self):
+        self._cancel.set()
+    
+    def advance(self, count=1):
+        """تسجيل تقدم الكتابة، ويُستدعى بين الصفوف ليتوقف التصدير فور طلب الإلغاء"""
+        if self._cancel.is_set():
+            raise ExportCancelled()
+        self.rows_written += count
+        now = time.monotonic()
+        if self._on_progress and now - self._last_notify >= EXPORT_PROGRESS_INTERVAL:
+            self._last_notify = now
+            self._on_progress(self)
+
+
+class ExportJobRunner:
+    """تشغيل التصديرات في مجمع خيوط خلفي حتى لا تتوقف واجهة المستخدم"""
+    
+    def __init__(self, on_change=None, max_workers=EXPORT_WORKERS, ttl=EXPORT_TTL, on_error=None):
+        self.on_change = on_change
+        self.on_error = on_error
+        self.ttl = ttl
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._timers = {}  # المهمة -> مؤقت حذف ملفها بعد انتهاء المهلة
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="export")
+        os.makedirs(EXPORTS_DIR, exist_ok=True)
+    
+    def submit(self, title, filename, write):
+        """جدولة تصدير؛ الدالة write(job, path) تكتب الملف وتستدعي job.advance() أثناء الكتابة"""
+        job = ExportJob(title, filename, on_progress=self._notify)
+        with self._lock:
+            self.jobs.insert(0, job)
+        self._executor.submit(self._run, job, write)
+        self._notify(job)
+        return job
+    
+    def cancel(self, job):
+        job.cancel()
+        if job.status == 'pending':
+            job.status = 'cancelled'
+            self._notify(job)
+    
+    def remove(self, job):
+        """إزالة مهمة منتهية من القائمة وحذف ملفها"""
+        if job.is_active:
+            return
+        with self._lock:
+            if job in self.jobs:
+                self.jobs.remove(job)
+        self._discard(job)
+    
+    def expire(self, job):
+        """حذف ملف مهمة انتهت مهلة تنزيلها مع إبقائها في القائمة"""
+        if job.status != 'done':
+            return
+        self._discard(job)
+        job.status = 'expired'
+        self._notify(job)
+    
+    def close(self):
+        """إلغاء كل المهام وحذف ملفاتها عند إغلاق الجلسة"""
+        with self._lock:
+            jobs = list(self.jobs)
+            self.jobs.clear()
+        for job in jobs:
+            job.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        # المهام الجارية تحذف ملفاتها بنفسها عند توقفها
+        for job in jobs:
+            if not job.is_active:
+                self._discard(job)
+    
+    def _discard(self, job):
+        with self._lock:
+            timer = self._timers.pop(job, None)
+        if timer:
+            timer.cancel()
+        shutil.rmtree(job.dir, ignore_errors=True)
+    
+    def _run(self, job, write):
+        if job.status == 'cancelled':
+            return
+        
+        job.status = 'running'
+        self._notify(job)
+        
+        # الكتابة في ملف مؤقت حتى لا يظهر في التنزيلات ملف ناقص
+        temp_path = job.path + '.part'
+        try:
+            os.makedirs(job.dir, exist_ok=True)
+            write(job, temp_path)
+            os.replace(temp_path, job.path)
+            job.status = 'done'
+        except ExportCancelled:
+            job.status = 'cancelled'
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        
+        if job.status == 'done':
+            timer = threading.Timer(self.ttl, self.expire, (job,))
+            timer.daemon = True
+            with self._lock:
+                self._timers[job] = timer
+            timer.start()
+        else:
+            shutil.rmtree(job.dir, ignore_errors=True)
+        self._notify(job)
+    
+    def _notify(self, job):
+        if self.on_change:
+            try:
+                self.on_change(job)
+            except Exception as e:
+                if self.on_error:
+                    self.on_error('export_error', f'خطأ في تحديث حالة التصدير {job.title}: {e}')
+
+# ================================ مخازن النسخ الاحتياطية ================================
+class BackupStorage(ABC):
+    """مخزن بعيد للنسخ: الملف يُرفع أجزاءً مستقلة مرقمة ثم بيان يجمعها تحت مفتاح النسخة"""
+    name = None
+    
+    @abstractmethod
+    def put_part(self, key, index, data):
+        """رفع جزء واحد؛ إعادة رفع نفس الجزء تستبدله"""
+    
+    @abstractmethod
+    def get_part(self, key, index):
+        """تنزيل جزء واحد"""
+    
+    @abstractmethod
+    def put_manifest(self, key, manifest):
+        """حفظ بيان النسخة بعد اكتمال أجزائها وإرجاع رابطها"""
+    
+    @abstractmethod
+    def get_manifest(self, key):
+        """قراءة بيان النسخة"""
+    
+    @staticmethod
+    def part_name(index):
+        return f"part_{index:05d}"
+
+
+class LocalDirectoryStorage(BackupStorage):
+    """مخزن في مجلد محلي أو مشترك، بديل عن MEGA للعمل دون اتصال"""
+    name = 'local'
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def _path(self, key, filename):
+        return os.path.join(self.root, key, filename)
+    
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    
+    def put_part(self, key, index, data):
+        self._write(self._path(key, self.part_name(index)), data)
+    
+    def get_part(self, key, index):
+        with open(self._path(key, self.part_name(index)), 'rb') as f:
+            return f.read()
+    
+    def put_manifest(self, key, manifest):
+        path = self._path(key, 'manifest.json')
+        self._write(path, json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+        return os.path.abspath(path)
+    
+    def get_manifest(self, key):
+        with open(self._path(key, 'manifest.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+
+class MegaSession:
+    """مجمع صغير من عملاء MEGA المسجلين مشترك بين الجلسات: يُسجل الدخول عند أول حاجة،
+    ويتجدد العميل بعد انتهاء مدته أو تغير بيانات الحساب أو خطأ أثناء استخدامه"""
+    
+    def __init__(self, ttl=MEGA_SESSION_TTL, size=BACKUP_UPLOAD_WORKERS):
+        self.ttl = ttl
+        self.size = size
+        self._idle = []  # (العميل، موعد انتهائه)
+        self._count = 0  # عدد العملاء المسجلين، الخاملين والمستخدمين
+        self._credentials = None
+        self._cond = threading.Condition()
+    
+    @contextmanager
+    def using(self, email, password):
+        """عميل لخيط واحد طوال الكتلة، لأن عميل mega.py يزيد رقم تسلسل طلباته ويشارك جلسة requests دون قفل"""
+        client, expires_at = self._acquire(email, password)
+        try:
+            yield client
+        except Exception:
+            # العميل بعد خطأ قد يحمل جلسة منتهية، فيُسقط ويُسجل الدخول بغيره عند الحاجة
+            self._release(None, None, None)
+            raise
+        self._release(client, expires_at, (email, password))
+    
+    def _acquire(self, email, password):
+        with self._cond:
+            if self._credentials != (email, password):
+                self._count -= len(self._idle)
+                self._idle.clear()
+                self._credentials = (email, password)
+            
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    client, expires_at = self._idle.pop()
+                    if now < expires_at:
+                        return client, expires_at
+                    self._count -= 1
+                if self._count < self.size:
+                    self._count += 1
+                    break
+                self._cond.wait()
+        
+        # تسجيل الدخول خارج القفل حتى لا ينتظره من يستخدم عميلاً جاهزاً
+        try:
+            return Mega().login(email, password), time.monotonic() + self.ttl
+        except Exception:
+            self._release(None, None, None)
+            raise
+    
+    def _release(self, client, expires_at, credentials):
+        with self._cond:
+            if client is not None and credentials == self._credentials:
+                self._idle.append((client, expires_at))
+            else:
+                self._count -= 1
+            self._cond.notify()
+
+
+class MegaStorage(BackupStorage):
+    """مخزن MEGA: مجلد لكل نسخة يحوي أجزاءها وبيانها، وكل خيط رفع يستخدم عميلاً من المجمع المشترك"""
+    name = 'mega'
+    
+    def __init__(self, session, email, password):
+        self.session = session
+        self.email = email
+        self.password = password
+        self._folders = {}
+        self._lock = threading.Lock()
+    
+    def client(self):
+        return self.session.using(self.email, self.password)
+    
+    def _folder(self, key):
+        with self._lock:
+            if key not in self._folders:
+                with self.client() as m:
+                    found = m.find(key)
+                    self._folders[key] = found[0] if found else m.create_folder(key)[key]
+            return self._folders[key]
+    
+    def _upload(self, key, filename, data):
+        folder = self._folder(key)
+        # mega.py يرفع من ملف، فيُكتب الجزء في ملف مؤقت يُحذف بعد الرفع
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, filename)
+            with open(path, 'wb') as f:
+                f.write(data)
+            with self.client() as m:
+                return m.upload(path, dest=folder, dest_filename=filename)
+    
+    def _download(self, key, filename):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.client() as m:
+                node = m.find(f"{key}/{filename}")
+                path = m.download(node, dest_path=temp_dir) if node else None
+            if not path:
+                raise FileNotFoundError(f"{key}/{filename}")
+            with open(path, 'rb') as f:
+                return f.read()
+    
+    def put_part(self, key, index, data):
+        self._upload(key, self.part_name(index), data)
+    
+    def get_part(self, key, index):
+        return self._download(key, self.part_name(index))
+    
+    def put_manifest(self, key, manifest):
+        file = self._upload(key, 'manifest.json', json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+        with self.client() as m:
+            try:
+                return m.export(key)
+            except Exception:
+                return m.get_upload_link(file)
+    
+    def get_manifest(self, key):
+        return json.loads(self._download(key, 'manifest.json').decode('utf-8'))
+
+
+class ChunkedUploader:
+    """رفع ملف إلى مخزن نسخ على أجزاء متوازية مع إعادة المحاولة والاستئناف من آخر جزء مؤكد"""
+    
+    def __init__(self, storage, part_size=BACKUP_UPLOAD_PART_SIZE, workers=BACKUP_UPLOAD_WORKERS,
+                 retries=BACKUP_UPLOAD_RETRIES, on_retry=None):
+        self.storage = storage
+        self.part_size = part_size
+        self.workers = workers
+        self.retries = retries
+        # on_retry(message) يُستدعى من خيط الرفع قبل كل إعادة محاولة ليعرضها المستدعي
+        self.on_retry = on_retry
+    
+    @staticmethod
+    def state_path(path):
+        return path + '.upload.json'
+    
+    @staticmethod
+    def pending(directory):
+        """ملفات حالة الرفع غير المكتملة في المجلد"""
+        return sorted(glob.glob(os.path.join(directory, '*.upload.json')))
+    
+    def upload(self, path, key, progress=None, meta=None):
+        """رفع الملف وإرجاع رابط بيانه؛ meta تُحفظ مع الحالة لاستخدامها عند الاستئناف"""
+        size = os.path.getsize(path)
+        state = {
+            'storage': self.storage.name,
+            'key': key,
+            'path': path,
+            'size': size,
+            'part_size': self.part_size,
+            'parts': max(1, -(-size // self.part_size)),
+            'done': {},
+            'meta': meta or {},
+        }
+        self._save_state(state)
+        return self._run(state, progress)
+    
+    def resume(self, state_path, progress=None):
+        """إكمال رفع متوقف؛ يُرجع (meta، الرابط)"""
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state['storage'] != self.storage.name:
+            raise ValueError(f"الرفع المتوقف يخص المخزن {state['storage']}")
+        if not os.path.exists(state['path']) or os.path.getsize(state['path']) != state['size']:
+            # الملف المحلي تغير أو حُذف، فلا يمكن الاستئناف
+            os.remove(state_path)
+            raise FileNotFoundError(state['path'])
+        return state['meta'], self._run(state, progress)
+    
+    def download(self, key, target_path, progress=None):
+        """إعادة تجميع ملف مرفوع من أجزائه مع التحقق من بصمة كل جزء"""
+        manifest = self.storage.get_manifest(key)
+        temp_path = target_path + '.part'
+        try:
+            with open(temp_path, 'wb') as f:
+                for number, part in enumerate(manifest['parts'], 1):
+                    data = self._with_retry(self.storage.get_part, key, part['index'])
+                    if hashlib.sha256(data).hexdigest() != part['sha256']:
+                        raise ValueError(f"الجزء {part['index']} من {key} تالف")
+                    f.write(data)
+                    if progress:
+                        progress(number / len(manifest['parts']))
+            os.replace(temp_path, target_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return target_path
+    
+    def _run(self, state, progress):
+        lock = threading.Lock()
+        remaining = [index for index in range(state['parts']) if str(index) not in state['done']]
+        
+        def send(index):
+            # كل جزء يُقرأ عند رفعه فقط، فلا يتجاوز المحمّل في الذاكرة عدد الخيوط × حجم الجزء
+            with open(state['path'], 'rb') as f:
+                f.seek(index * state['part_size'])
+                data = f.read(state['part_size'])
+            self._with_retry(self.storage.put_part, state['key'], index, data)
+            return index, hashlib.sha256(data).hexdigest(), len(data)
+        
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="backup-upload") as executor:
+            futures = [executor.submit(send, index) for index in remaining]
+            try:
+                for future in as_completed(futures):
+                    index, digest, length = future.result()
+                    with lock:
+                        state['done'][str(index)] = [digest, length]
+                        self._save_state(state)
+                        if progress:
+                            progress(len(state['done']) / state['parts'])
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+        
+        manifest = {
+            'file': os.path.basename(state['path']),
+            'size': state['size'],
+            'part_size': state['part_size'],
+            'parts': [
+                {'index': index, 'sha256': state['done'][str(index)][0], 'size': state['done'][str(index)][1]}
+                for index in range(state['parts'])
+            ],
+            'meta': state['meta'],
+        }
+        link = self.storage.put_manifest(state['key'], manifest)
+        os.remove(self.state_path(state['path']))
+        return link
+    
+    def _with_retry(self, func, *args):
+        """تنفيذ عملية شبكة مع إعادة المحاولة بتأخير متضاعف وعشوائية بسيطة"""
+        for attempt in range(self.retries):
+            try:
+                return func(*args)
+            except Exception as e:
+                if attempt == self.retries - 1:
+                    raise
+                delay = BACKUP_UPLOAD_BACKOFF * (2 ** attempt) * (1 + random.random() / 2)
+                if self.on_retry:
+                    self.on_retry(f"فشل {func.__name__} (محاولة {attempt + 1}): {e}، إعادة المحاولة بعد {delay:.1f} ث")
+                time.sleep(delay)
+    
+    def _save_state(self, state):
+        path = self.state_path(state['path'])
+        temp_path = path + '.part'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+# ================================ تقارير PDF ================================
+@functools.lru_cache(maxsize=None)
+def arabic_font_path():
+    """البحث عن خط عربي في النظام مرة واحدة لكل عملية"""
+    possible_paths = [
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVuSans.ttf"),
+        "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+        "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
+        "C:\\Windows\\Fonts\\arial.ttf",
+        "C:\\Windows\\Fonts\\tahoma.ttf",
+        "/System/Library/Fonts/Supplemental/Arial.ttf",
+    ]
+    for path in possible_paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+@functools.lru_cache(maxsize=None)
+def enable_pdf_font_cache():
+    """حفظ مقاييس الخطوط المحللة في مجلد قابل للكتابة بدلاً من مجلد الخط"""
+    if fpdf_set_global is None:
+        return
+    os.makedirs(PDF_FONT_CACHE_DIR, exist_ok=True)
+    fpdf_set_global("FPDF_CACHE_MODE", 2)
+    fpdf_set_global("FPDF_CACHE_DIR", PDF_FONT_CACHE_DIR)
+
+
+class PdfReportRenderer:
+    """رسم جدول تقرير في PDF على صفحات متتالية بعناوين أعمدة مكررة وصفوف مقروءة تدفقياً"""
+    
+    def __init__(self, title, subtitle_lines=(), on_error=None):
+        self.title = title
+        self.subtitle_lines = list(subtitle_lines)
+        self.font_family = "Arial"
+        self.on_error = on_error
+    
+    def render(self, path, columns, rows, job=None):
+        """كتابة الجدول إلى path؛ الصفوف تُقرأ مرة واحدة دون تحميلها كلها"""
+        columns = [str(column) for column in columns]
+        pdf = FPDF(orientation='L' if len(columns) > 5 else 'P')
+        self._set_font(pdf)
+        pdf.set_auto_page_break(True, margin=15)
+        
+        # عرض الأعمدة من عينة الصفوف الأولى، ثم تُكمل بقية الصفوف من نفس المصدر
+        rows = iter(rows)
+        sample = [self._cells(row) for row in itertools.islice(rows, PDF_WIDTH_SAMPLE_ROWS)]
+        widths = self._column_widths(pdf, columns, sample)
+        
+        # FPDF يستدعي header() عند كل صفحة جديدة، بما فيها الفواصل التلقائية
+        pdf.header = lambda: self._draw_header(pdf, columns, widths)
+        pdf.add_page()
+        
+        for cells in itertools.chain(sample, (self._cells(row) for row in rows)):
+            for text, width in zip(cells, widths):
+                pdf.cell(width, PDF_ROW_HEIGHT, self._fit(pdf, text, width), 1, 0, 'C')
+            pdf.ln()
+            if job:
+                job.advance()
+        
+        self._compact_font_subset(pdf)
+        pdf.output(path)
+    
+    def _set_font(self, pdf):
+        font_path = arabic_font_path()
+        if font_path:
+            try:
+                enable_pdf_font_cache()
+                pdf.add_font("Arabic", "", font_path, uni=True)
+                self.font_family = "Arabic"
+            except Exception as e:
+                # يستمر التصدير بالخط الافتراضي، لكن النص العربي سيظهر مشوهاً فيجب أن يعرف المدير السبب
+                if self.on_error:
+                    self.on_error('export_error', f'تعذر تحميل الخط العربي للتقرير {self.title}: {e}')
+        pdf.set_font(self.font_family, "", 10)
+    
+    @staticmethod
+    def _cells(row):
+        return ["" if value is None else str(value) for value in row]
+    
+    def _column_widths(self, pdf, columns, sample):
+        """عرض كل عمود حسب العنوان والنسبة المئوية 90 من أطوال العينة، ثم تحجيمه لعرض الصفحة"""
+        available = pdf.w - pdf.l_margin - pdf.r_margin
+        natural = []
+        for index, column in enumerate(columns):
+            lengths = sorted(pdf.get_string_width(cells[index]) for cells in sample if index < len(cells))
+            # النسبة 90 بدلاً من الأقصى حتى لا يستحوذ نص طويل واحد على الصفحة
+            typical = lengths[int(len(lengths) * 0.9)] if lengths else 0
+            natural.append(max(pdf.get_string_width(column), typical) + PDF_CELL_PADDING)
+        
+        total = sum(natural) or 1
+        return [width * available / total for width in natural]
+    
+    @staticmethod
+    def _fit(pdf, text, width):
+        """قص النص الذي لا يتسع للخلية"""
+        limit = width - PDF_CELL_PADDING / 2
+        if pdf.get_string_width(text) <= limit:
+            return text
+        while text and pdf.get_string_width(text + "…") > limit:
+            # تقدير عدد الأحرف الزائدة مباشرة بدلاً من حذف حرف في كل مرة
+            excess = pdf.get_string_width(text + "…") - limit
+            average = pdf.get_string_width(text) / len(text) or 1
+            text = text[:-max(1, int(excess / average))]
+        return text + "…" if text else ""
+    
+    @staticmethod
+    def _compact_font_subset(pdf):
+        """fpdf 1.7 يضيف كل حرف مكتوب إلى قائمة المجموعة الجزئية للخط دون إزالة التكرار،
+        فتنمو الذاكرة مع عدد الأحرف ويتباطأ الحفظ؛ إزالة التكرار تبقيها بحجم الأحرف المختلفة فقط"""
+        font = getattr(pdf, 'current_font', None)
+        subset = font.get('subset') if isinstance(font, dict) else None
+        if isinstance(subset, list):
+            subset[:] = sorted(set(subset))
+    
+    def _draw_header(self, pdf, columns, widths):
+        self._compact_font_subset(pdf)
+        if pdf.page_no() == 1:
+            pdf.set_font_size(16)
+            pdf.cell(0, 10, self.title, 0, 1, 'C')
+            pdf.set_font_size(12)
+            for line in self.subtitle_lines:
+                pdf.cell(0, 8, line, 0, 1, 'C')
+            pdf.ln(5)
+        
+        pdf.set_font_size(10)
+        pdf.set_fill_color(236, 240, 241)
+        for column, width in zip(columns, widths):
+            pdf.cell(width, PDF_ROW_HEIGHT, self._fit(pdf, column, width), 1, 0, 'C', True)
+        pdf.ln()
+
+# ================================ النسخ الاحتياطي ================================
+class ChunkStore:
+    """مخزن قطع معنون بالمحتوى: كل قطعة تُحفظ مرة واحدة باسم بصمتها SHA-256"""
+    
+    def __init__(self, root):
+        self.root = root
+    
+    def path(self, digest):
+        # مجلد فرعي لكل بادئة حتى لا يتضخم مجلد واحد بآلاف الملفات
+        return os.path.join(self.root, digest[:2], digest)
+    
+    def put(self, data):
+        """حفظ القطعة إذا لم تكن موجودة، وإرجاع (البصمة، هل كانت جديدة)"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest, False
+        
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.part"
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        return digest, True
+    
+    def digests(self):
+        """بصمات كل القطع المخزنة"""
+        for path in glob.glob(os.path.join(self.root, '*', '*')):
+            name = os.path.basename(path)
+            if not name.endswith('.part'):
+                yield name
+    
+    def remove(self, digest):
+        path = self.path(digest)
+        if os.path.exists(path):
+            os.remove(path)
+    
+    def get(self, digest):
+        """قراءة القطعة مع التحقق من سلامتها"""
+        with open(self.path(digest), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError(f"القطعة {digest[:12]} تالفة")
+        return data
+
+
+BackupResult = namedtuple('BackupResult', ['path', 'file_size', 'original_size', 'compression', 'sha256'])
+
+
+class BackupEngine:
+    """نسخ احتياطي متسق أثناء عمل التطبيق باستخدام واجهة النسخ في SQLite"""
+    
+    def __init__(self, db, pages_per_step=BACKUP_PAGES_PER_STEP):
+        self.db = db
+        self.pages_per_step = pages_per_step
+        # النسخ التزايدي وتنظيف القطع لا يتداخلان حتى لا تُحذف قطعة تكتبها نسخة جارية
+        self._chunks_lock = threading.Lock()
+    
+    def backup(self, path, progress=None, compact=False):
+        """نسخ قاعدة البيانات إلى path وإرجاع حجم الملف؛ progress(نسبة) تُستدعى بعد كل خطوة"""
+        # كتابة القيود المعلقة أولاً حتى تشملها النسخة
+        self.db.log_writer.flush()
+        
+        temp_path = path + '.part'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            if compact:
+                self._vacuum_into(temp_path, progress)
+            else:
+                self._copy_pages(temp_path, progress)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return os.path.getsize(path)
+    
+    def backup_file(self, path, progress=None, compact=False, compression=None):
+        """نسخة كاملة مع ضغط اختياري (gzip أو lzma أو bz2) وملف بيان بالبصمة بجانبها"""
+        if not compression:
+            self.backup(path, progress, compact=compact)
+            original_size = os.path.getsize(path)
+            return self._write_manifest(path, original_size, None, self._file_sha256(path))
+        
+        opener, extension = BACKUP_COMPRESSORS[compression]
+        snapshot_path = path + '.snapshot'
+        target_path = path + extension
+        temp_path = target_path + '.part'
+        
+        # نصف التقدم للقطة ونصفه للضغط
+        self.backup(snapshot_path, lambda fraction: progress and progress(None if fraction is None else fraction / 2),
+                    compact=compact)
+        try:
+            original_size = os.path.getsize(snapshot_path)
+            original_hash = hashlib.sha256()
+            with open(snapshot_path, 'rb') as source, opener(temp_path, 'wb') as target:
+                while True:
+                    data = source.read(BACKUP_COMPRESSION_BUFFER)
+                    if not data:
+                        break
+                    original_hash.update(data)
+                    target.write(data)
+                    if progress and original_size:
+                        progress(0.5 + source.tell() / original_size / 2)
+            os.replace(temp_path, target_path)
+        finally:
+            for leftover in (snapshot_path, temp_path):
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        
+        return self._write_manifest(target_path, original_size, compression,
+                                    self._file_sha256(target_path), original_hash.hexdigest())
+    
+    @staticmethod
+    def _file_sha256(path):
+        file_hash = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(BACKUP_COMPRESSION_BUFFER), b''):
+                file_hash.update(data)
+        return file_hash.hexdigest()
+    
+    @staticmethod
+    def _write_manifest(path, original_size, compression, sha256, original_sha256=None):
+        """ملف path.sha256.json يسمح بالتحقق من النسخة بعد نقلها أو تنزيلها"""
+        file_size = os.path.getsize(path)
+        manifest = {
+            'file': os.path.basename(path),
+            'size': file_size,
+            'sha256': sha256,
+            'compression': compression,
+            'original_size': original_size,
+            'original_sha256': original_sha256 or sha256,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+        }
+        with open(path + '.sha256.json', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return BackupResult(path, file_size, original_size, compression, sha256)
+    
+    def incremental_backup(self, backup_dir, name, progress=None):
+        """نسخة تزايدية: لقطة متسقة تُقسم إلى قطع، ولا يُخزن منها إلا ما تغير منذ النسخ السابقة.
+        تُرجع (مسار البيان، حجم قاعدة البيانات، حجم القطع الجديدة)"""
+        with self._chunks_lock:
+            return self._incremental_backup(backup_dir, name, progress)
+    
+    def collect_chunks(self, backup_dir):
+        """حذف القطع التي لم يعد أي بيان يشير إليها، وإرجاع عددها"""
+        with self._chunks_lock:
+            referenced = set()
+            for manifest_path in glob.glob(os.path.join(backup_dir, BACKUP_MANIFESTS_DIR, '*.json')):
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    referenced.update(json.load(f)['chunks'])
+            
+            store = ChunkStore(os.path.join(backup_dir, BACKUP_CHUNKS_DIR))
+            removed = 0
+            for digest in list(store.digests()):
+                if digest not in referenced:
+                    store.remove(digest)
+                    removed += 1
+            return removed
+    
+    def _incremental_backup(self, backup_dir, name, progress=None):
+        store = ChunkStore(os.path.join(backup_dir, BACKUP_CHUNKS_DIR))
+        manifests_dir = os.path.join(backup_dir, BACKUP_MANIFESTS_DIR)
+        os.makedirs(manifests_dir, exist_ok=True)
+        if os.path.exists(os.path.join(manifests_dir, f"{name}.json")):
+            raise FileExistsError(f"توجد نسخة بالاسم {name}")
+        
+        # نصف التقدم للقطة ونصفه لتقسيمها
+        snapshot_path = os.path.join(backup_dir, f"{name}.snapshot")
+        self.backup(snapshot_path, lambda fraction: progress and progress(fraction / 2))
+        
+        try:
+            db_size = os.path.getsize(snapshot_path)
+            chunks = []
+            new_bytes = 0
+            file_hash = hashlib.sha256()
+            with open(snapshot_path, 'rb') as f:
+                while True:
+                    data = f.read(BACKUP_CHUNK_SIZE)
+                    if not data:
+                        break
+                    file_hash.update(data)
+                    digest, is_new = store.put(data)
+                    chunks.append(digest)
+                    if is_new:
+                        new_bytes += len(data)
+                    if progress and db_size:
+                        progress(0.5 + f.tell() / db_size / 2)
+        finally:
+            os.remove(snapshot_path)
+        
+        manifest = {
+            'version': 1,
+            'name': name,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'db_size': db_size,
+            'chunk_size': BACKUP_CHUNK_SIZE,
+            'sha256': file_hash.hexdigest(),
+            'chunks': chunks,
+        }
+        manifest_path = os.path.join(manifests_dir, f"{name}.json")
+        temp_path = manifest_path + '.part'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(temp_path, manifest_path)
+        return manifest_path, db_size, new_bytes
+    
+    def restore_manifest(self, manifest_path, target_path, progress=None):
+        """إعادة بناء ملف قاعدة البيانات كما كان لحظة النسخة من قطعها، مع التحقق من البصمة الكاملة"""
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        store = ChunkStore(os.path.join(os.path.dirname(os.path.dirname(manifest_path)), BACKUP_CHUNKS_DIR))
+        
+        temp_path = target_path + '.part'
+        file_hash = hashlib.sha256()
+        chunks = manifest['chunks']
+        try:
+            with open(temp_path, 'wb') as f:
+                for index, digest in enumerate(chunks, 1):
+                    data = store.get(digest)
+                    file_hash.update(data)
+                    f.write(data)
+                    if progress:
+                        progress(index / len(chunks))
+            
+            if file_hash.hexdigest() != manifest['sha256']:
+                raise ValueError("بصمة الملف المستعاد لا تطابق البيان")
+            os.replace(temp_path, target_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return target_path
+    
+    def prepare_restore(self, backup, target_path, progress=None):
+        """تجهيز ملف قاعدة بيانات مستقل من سجل نسخة (file_path وmanifest_path وcompression وsha256)
+        مع التحقق من البصمات وسلامة الملف قبل أي تعديل على قاعدة البيانات الحية"""
+        if backup.get('manifest_path'):
+            self.restore_manifest(backup['manifest_path'], target_path, progress)
+        else:
+            path = backup['file_path']
+            if not path or not os.path.exists(path):
+                raise FileNotFoundError(path)
+            
+            # بصمة الملف المخزن مسجلة في الجدول وفي ملف البيان المجاور
+            sidecar = {}
+            if os.path.exists(path + '.sha256.json'):
+                with open(path + '.sha256.json', 'r', encoding='utf-8') as f:
+                    sidecar = json.load(f)
+            expected = backup.get('sha256') or sidecar.get('sha256')
+            if expected and self._file_sha256(path) != expected:
+                raise ValueError("بصمة ملف النسخة لا تطابق المسجل")
+            
+            compression = backup.get('compression')
+            opener = BACKUP_COMPRESSORS[compression][0] if compression else open
+            temp_path = target_path + '.part'
+            original_hash = hashlib.sha256()
+            size = sidecar.get('original_size') or (None if compression else os.path.getsize(path))
+            written = 0
+            try:
+                with opener(path, 'rb') as source, open(temp_path, 'wb') as target:
+                    while True:
+                        data = source.read(BACKUP_COMPRESSION_BUFFER)
+                        if not data:
+                            break
+                        original_hash.update(data)
+                        target.write(data)
+                        written += len(data)
+                        if progress and size:
+                            progress(min(written / size, 1.0))
+                
+                original_expected = sidecar.get('original_sha256')
+                if original_expected and original_hash.hexdigest() != original_expected:
+                    raise ValueError("بصمة قاعدة البيانات بعد فك الضغط لا تطابق البيان")
+                os.replace(temp_path, target_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        
+        self.validate(target_path)
+        return target_path
+    
+    @staticmethod
+    def validate(path):
+        """فحص سلامة ملف قاعدة البيانات واحتوائه على جداول التطبيق"""
+        conn = sqlite3.connect(path)
+        try:
+            result = conn.execute("PRAGMA quick_check").fetchall()
+            if result != [('ok',)]:
+                raise ValueError(f"فشل فحص السلامة: {result[0][0]}")
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            missing = RESTORE_REQUIRED_TABLES - tables
+            if missing:
+                raise ValueError(f"النسخة لا تحتوي الجداول: {', '.join(sorted(missing))}")
+        finally:
+            conn.close()
+    
+    def _copy_pages(self, path, progress):
+        # اتصال مصدر مستقل بمعاملة قراءة مفتوحة يثبّت لقطة WAL واحدة طوال النسخ،
+        # فتبقى النسخة متسقة ولا تعيد البدء بينما يواصل الكتّاب الالتزام بين الخطوات
+        source = self.db._open_connection(read_only=True)
+        target = sqlite3.connect(path)
+        try:
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            
+            def on_step(status, remaining, total):
+                if progress and total:
+                    progress((total - remaining) / total)
+            
+            source.backup(target, pages=self.pages_per_step, progress=on_step)
+            source.rollback()
+        finally:
+            target.close()
+            source.close()
+    
+    def _vacuum_into(self, path, progress):
+        # VACUUM INTO يكتب نسخة مضغوطة بلا صفحات فارغة من لقطة قراءة واحدة، لكنه لا يبلغ عن تقدمه
+        if progress:
+            progress(None)
+        source = self.db._open_connection()
+        try:
+            source.execute("VACUUM INTO ?", (path,))
+        finally:
+            source.close()
+        if progress:
+            progress(1)
+
+# ================================ النسخ التلقائي ================================
+class CronSchedule:
+    """جدول بصيغة cron الخماسية: الدقيقة الساعة يوم-الشهر الشهر يوم-الأسبوع (0 = الأحد)"""
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+    
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError("جدول cron يجب أن يتكون من خمسة حقول")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self._parse(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)
+        ]
+        # كما في cron: إذا قُيّد اليوم والأسبوع معاً يكفي تطابق أحدهما
+        self.any_day = parts[2] == '*'
+        self.any_weekday = parts[4] == '*'
+    
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for item in field.split(','):
+            step = 1
+            if '/' in item:
+                item, step_text = item.split('/', 1)
+                step = int(step_text)
+            if item == '*':
+                start, end = low, high
+            elif '-' in item:
+                start, end = (int(value) for value in item.split('-', 1))
+            else:
+                start = end = int(item)
+            if step < 1 or start < low or end > high or start > end:
+                raise ValueError(f"قيمة غير صالحة في جدول cron: {field}")
+            values.update(range(start, end + 1, step))
+        return values
+    
+    def _day_matches(self, moment):
+        in_days = moment.day in self.days
+        in_weekdays = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return in_weekdays
+        if self.any_weekday:
+            return in_days
+        return in_days or in_weekdays
+    
+    def next_after(self, moment):
+        """أول موعد بعد moment؛ يتخطى الأشهر والأيام والساعات غير المطابقة دفعة واحدة"""
+        moment = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError("جدول cron لا ينتج أي موعد")
+
+
+def select_backups_to_keep(backups, keep_hourly, keep_daily, keep_weekly):
+    """الاحتفاظ بالجد والأب والابن: أحدث نسخة في كل ساعة ويوم وأسبوع حتى العدد المحدد لكل مستوى.
+    backups قائمة (المعرف، الوقت المحلي) مرتبة من الأحدث؛ تُرجع مجموعة المعرفات المحتفظ بها"""
+    # أحدث نسخة تبقى دائماً حتى لو كانت كل المستويات صفراً، فلا يحذف التنظيف النسخة التي أُخذت للتو
+    keep = {backups[0][0]} if backups else set()
+    tiers = [
+        (keep_hourly, lambda moment: (moment.date(), moment.hour)),
+        (keep_daily, lambda moment: moment.date()),
+        (keep_weekly, lambda moment: moment.isocalendar()[:2]),
+    ]
+    for limit, bucket_of in tiers:
+        seen = set()
+        for backup_id, moment in backups:
+            if len(seen) >= limit:
+                break
+            bucket = bucket_of(moment)
+            if bucket not in seen:
+                seen.add(bucket)
+                keep.add(backup_id)
+    return keep
+
+
+class BackupScheduler(BackgroundJob):
+    """خيط نسخ احتياطي تلقائي حسب جدول cron من إعدادات التطبيق، مع سياسة احتفاظ وتنظيف"""
+    
+    def __init__(self, db, backup_dir=BACKUP_DIR):
+        super().__init__("backup-scheduler")
+        self.db = db
+        self.backup_dir = backup_dir
+        self.last_data_version = None
+        self.next_run = None
+        self._wake = threading.Event()
+    
+    def stop(self, wait=False):
+        # الإيقاف يُطلب قبل الإيقاظ حتى يراه الخيط عند عودته لبداية الحلقة
+        self._stop.set()
+        self._wake.set()
+        return super().stop(wait)
+    
+    def reload(self):
+        """إعادة قراءة الإعدادات بعد تعديلها من الواجهة"""
+        self._wake.set()
+    
+    def schedule(self):
+        """الجدول الحالي، أو None إذا كان النسخ التلقائي معطلاً"""
+        if self.db.get_app_setting('backup_schedule_enabled', '1') != '1':
+            return None
+        return CronSchedule(self.db.get_app_setting('backup_schedule', BACKUP_SCHEDULE))
+    
+    def _run(self):
+        while not self._stopped():
+            self._wake.clear()
+            try:
+                schedule = self.schedule()
+            except ValueError as e:
+                self.db.log_error('backup_error', f'جدول النسخ التلقائي غير صالح: {e}')
+                schedule = None
+            
+            if schedule is None:
+                self.next_run = None
+                self._wake.wait()
+                continue
+            
+            now = datetime.utcnow() + timedelta(hours=LOCAL_UTC_OFFSET_HOURS)
+            self.next_run = schedule.next_after(now)
+            if self._wake.wait((self.next_run - now).total_seconds()):
+                continue  # تغيرت الإعدادات أو طُلب الإيقاف
+            
+            try:
+                self.run_once()
+            except Exception as e:
+                self.record_failure(e)
     
-    def update_user_permissions(self, user_id, permissions):
-        """تحديث صلاحيات المستخدم"""
-        with self.get_cursor() as cursor:
-            cursor.execute("SELECT * FROM user_permissions WHERE user_id = ?", (user_id,))
-            if cursor.fetchone():
-                set_clause = ','.join([f"{key}=?" for key in permissions.keys()])
-                values = list(permissions.values()) + [user_id]
-                cursor.execute(
-                    f"UPDATE user_permissions SET {set_clause}, updated_at=CURRENT_TIMESTAMP WHERE user_id=?",
-                    values
-                )
-            else:
-                columns = ['user_id'] + list(permissions.keys())
-                values = [user_id] + list(permissions.values())
-                placeholders = ','.join(['?' for _ in columns])
-                cursor.execute(
-                    f"INSERT INTO user_permissions ({','.join(columns)}) VALUES ({placeholders})",
-                    values
-                )
+    def run_once(self):
+        """نسخة تلقائية واحدة ثم تطبيق سياسة الاحتفاظ؛ تُرجع مسار البيان أو None إذا لم يتغير شيء"""
+        # كتابة القيود المعلقة أولاً حتى تشملها النسخة، ودفعات السجل وحدها لا تغير رقم الإصدار
+        self.db.log_writer.flush()
+        if self.db.data_version() == self.last_data_version:
+            return None
+        
+        name = f"backup_auto_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        manifest_path, db_size, new_bytes = self.db.backup_engine.incremental_backup(self.backup_dir, name)
+        self.db.execute_insert(
+            """INSERT INTO backups 
+               (file_name, backup_type, file_size, file_path, manifest_path, status, original_size) 
+               VALUES (?, 'auto', ?, ?, ?, 'completed', ?)""",
+            (name, new_bytes, manifest_path, manifest_path, db_size)
+        )
+        self.prune()
+        
+        # تسجيل الإصدار بعد كتابات النسخة نفسها حتى لا تُحسب تغييراً في الجولة القادمة
+        self.last_data_version = self.db.data_version()
+        return manifest_path
     
-    def log_action(self, user_id, action, description):
-        """تسجيل إجراء في سجل النظام"""
+    def record_failure(self, error):
+        """تسجيل النسخة الفاشلة في سجل النظام وقائمة النسخ ليراها المدير"""
+        self.db.log_error('backup_error', f'خطأ في النسخ الاحتياطي التلقائي: {error}')
         try:
-            self.execute_insert(
-                "INSERT INTO system_logs (user_id, action, description) VALUES (?, ?, ?)",
-                (user_id, action, description)
+            self.db.execute_insert(
+                "INSERT INTO backups (file_name, backup_type, status) VALUES (?, 'auto', 'failed')",
+                (f"backup_auto_{datetime.now().strftime('%Y%m%d_%H%M%S')}",)
             )
-        except:
-            pass
+        except sqlite3.Error:
+            pass  # الخطأ مسجل أعلاه، والقاعدة نفسها قد تكون سبب الفشل
+    
+    def prune(self):
+        """حذف النسخ التلقائية الخارجة عن سياسة الاحتفاظ وملفاتها وقطعها غير المستخدمة"""
+        keep_hourly = int(self.db.get_app_setting('backup_keep_hourly', BACKUP_KEEP_HOURLY))
+        keep_daily = int(self.db.get_app_setting('backup_keep_daily', BACKUP_KEEP_DAILY))
+        keep_weekly = int(self.db.get_app_setting('backup_keep_weekly', BACKUP_KEEP_WEEKLY))
+        
+        rows = self.db.execute_query(f"""
+            SELECT id, DATETIME(created_at, '{LOCAL_TIME_MODIFIER}'), manifest_path
+            FROM backups
+            WHERE backup_type = 'auto' AND status = 'completed'
+            ORDER BY created_at DESC, id DESC
+        """)
+        keep = select_backups_to_keep(
+            [(backup_id, datetime.fromisoformat(created_at)) for backup_id, created_at, _ in rows],
+            keep_hourly, keep_daily, keep_weekly
+        )
+        expired = [(backup_id, path) for backup_id, _, path in rows if backup_id not in keep]
+        
+        # الإخفاقات السابقة لآخر نسخة ناجحة لم تعد تحتاج انتباهاً، فلا تتراكم في القائمة
+        if rows:
+            expired += self.db.execute_query(
+                """SELECT id, NULL FROM backups
+                   WHERE backup_type = 'auto' AND status = 'failed' AND id < ?""",
+                (rows[0][0],)
+            )
+        if not expired:
+            return 0
+        
+        # حذف السجلات دفعة واحدة في معاملة واحدة، ثم الملفات
+        with self.db.transaction() as cursor:
+            cursor.executemany("DELETE FROM backups WHERE id = ?", [(backup_id,) for backup_id, _ in expired])
+        for _, path in expired:
+            if path and os.path.exists(path):
+                os.remove(path)
+        
+        self.db.backup_engine.collect_chunks(self.backup_dir)
+        return len(expired)
 
 # ================================ تطبيق Flet الرئيسي ================================
 class CartsManagementApp:
     def __init__(self, page: ft.Page):
         self.page = page
         self.db = DatabaseManager()
+        self.search = self.db.search.session()
+        self.mega_session = self.db.mega_session
+        self.exports = ExportJobRunner(on_change=self.on_export_changed, on_error=self.db.log_error)
+        self.export_list = None
         self.current_user = None
         self.current_permissions = None
-        self.backup_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backups")
+        self.session_generation = self.db.restore_generation
+        self.backup_dir = BACKUP_DIR
         
         # إنشاء مجلد النسخ الاحتياطي إذا لم يكن موجوداً
         if not os.path.exists(self.backup_dir):
@@ -499,10 +3375,14 @@ class CartsManagementApp:
         # متغيرات البحث والفلترة
         self.cart_search_field = None
         self.cart_table = None
+        self.cart_pager = None
+        self.cart_filters = {'search': '', 'status': None, 'warehouse_id': None}
         self.movement_search_field = None
         self.movement_table = None
+        self.movement_rows = None
         self.maintenance_search_field = None
         self.maintenance_table = None
+        self.maintenance_rows = None
         self.warehouse_search_field = None
         self.warehouse_table = None
         self.user_search_field = None
@@ -516,14 +3396,24 @@ class CartsManagementApp:
         # متغيرات النسخ الاحتياطي
         self.backup_progress = None
         self.backup_status = None
+        self.backup_compact = None
+        self.backup_compression = None
         self.backup_tree = None
         
         # متغيرات إعدادات MEGA
         self.mega_status_label = None
         
+        # إغلاق الجلسة يحرر ما يخصها من الخدمات المشتركة
+        self.page.on_close = self.on_page_close
+        
         # عرض شاشة تسجيل الدخول
         self.show_login_screen()
     
+    def on_page_close(self, e):
+        """تحرير موارد الجلسة عند انتهاء اتصال المتصفح"""
+        self.search.close()
+        self.exports.close()
+    
     # ================================ دوال مساعدة ================================
     def show_snack_bar(self, message, color=COLORS['success']):
         """عرض رسالة منبثقة"""
@@ -537,18 +3427,40 @@ class CartsManagementApp:
     
     def check_permission(self, permission):
         """التحقق من صلاحية المستخدم"""
-        if not self.current_permissions:
+        if not self.current_permissions or self.session_expired():
             return False
         if self.current_user and self.current_user['role'] == 'admin':
             return True
         return self.current_permissions.get(permission, 0) == 1
     
+    def session_expired(self):
+        """هل استُعيدت نسخة احتياطية بعد تسجيل دخول هذه الجلسة، فقد لا يكون مستخدمها أو صلاحياته موجودة"""
+        return self.current_user is not None and self.session_generation != self.db.restore_generation
+    
+    def navigate(self, handler):
+        """الانتقال إلى صفحة من القائمة، أو إعادة الجلسة المنتهية لشاشة الدخول"""
+        if self.session_expired():
+            self.current_user = None
+            self.current_permissions = None
+            self.show_login_screen()
+            self.show_snack_bar("تمت استعادة نسخة احتياطية، الرجاء تسجيل الدخول من جديد", COLORS['warning'])
+            return
+        handler()
+    
     def clear_content(self):
         """مسح منطقة المحتوى"""
+        self.search.cancel_all()
+        self.export_list = None
+        self.mega_status_label = None
         if self.content_column:
             self.content_column.controls.clear()
             self.page.update()
     
+    @staticmethod
+    def field_text(field):
+        """النص المدخل في حقل البحث بدون مسافات زائدة"""
+        return field.value.strip() if field and field.value else ""
+    
     def show_loading(self):
         """عرض مؤشر تحميل"""
         return ft.Container(
@@ -698,6 +3610,7 @@ class CartsManagementApp:
             )
             
             self.current_permissions = self.db.get_user_permissions(user_id)
+            self.session_generation = self.db.restore_generation
             self.db.log_action(user_id, 'login', f'تسجيل دخول المستخدم {username}')
             self.show_main_screen()
         else:
@@ -848,7 +3761,7 @@ class CartsManagementApp:
                     overlay_color=COLORS['primary'],
                     padding=ft.padding.symmetric(horizontal=15, vertical=10),
                 ),
-                on_click=lambda e: on_click()
+                on_click=lambda e: self.navigate(on_click)
             )
         )
     
@@ -904,14 +3817,15 @@ class CartsManagementApp:
         )
         
         # جلب الإحصائيات
-        total_carts = self.db.execute_query("SELECT COUNT(*) FROM carts")[0][0] or 0
-        sound_carts = self.db.execute_query("SELECT COUNT(*) FROM carts WHERE status = 'sound'")[0][0] or 0
-        maintenance_carts = self.db.execute_query("SELECT COUNT(*) FROM carts WHERE status = 'needs_maintenance'")[0][0] or 0
-        damaged_carts = self.db.execute_query("SELECT COUNT(*) FROM carts WHERE status = 'damaged'")[0][0] or 0
-        total_warehouses = self.db.execute_query("SELECT COUNT(*) FROM warehouses WHERE is_active = 1")[0][0] or 0
-        total_movements = self.db.execute_query("SELECT COUNT(*) FROM movements")[0][0] or 0
-        pending_maintenance = self.db.execute_query("SELECT COUNT(*) FROM maintenance_records WHERE status = 'pending'")[0][0] or 0
-        total_users = self.db.execute_query("SELECT COUNT(*) FROM users WHERE is_active = 1")[0][0] or 0
+        stats = self.db.stats.get()
+        total_carts = stats['total_carts']
+        sound_carts = stats['sound_carts']
+        maintenance_carts = stats['maintenance_carts']
+        damaged_carts = stats['damaged_carts']
+        total_warehouses = stats['total_warehouses']
+        today_movements = stats['today_movements']
+        pending_maintenance = stats['pending_maintenance']
+        total_users = stats['total_users']
         
         # بطاقات الإحصائيات - الصف الأول
         stats_row1 = ft.ResponsiveRow(
@@ -937,7 +3851,7 @@ class CartsManagementApp:
             controls=[
                 self.create_stat_card("🏢", "المستودعات", total_warehouses, COLORS['purple'], 
                                      "مستودع نشط", col={"sm": 6, "md": 3, "lg": 3}),
-                self.create_stat_card("🔄", "حركات اليوم", total_movements, COLORS['info'], 
+                self.create_stat_card("🔄", "حركات اليوم", today_movements, COLORS['info'], 
                                      "آخر 24 ساعة", col={"sm": 6, "md": 3, "lg": 3}),
                 self.create_stat_card("🔧", "بانتظار الصيانة", pending_maintenance, COLORS['orange'], 
                                      f"{pending_maintenance} عربة", col={"sm": 6, "md": 3, "lg": 3}),
@@ -1098,13 +4012,14 @@ class CartsManagementApp:
             return
         
         self.clear_content()
+        self.cart_filters = {'search': '', 'status': None, 'warehouse_id': None}
         
         # عنوان الصفحة
         title_row = ft.Row([
             ft.Text("إدارة العربات", size=24, weight=ft.FontWeight.BOLD, color=COLORS['dark']),
             ft.Row([
                 ft.TextField(
-                    hint_text="بحث...",
+                    hint_text="بحث بالرقم التسلسلي...",
                     width=250,
                     height=40,
                     border_radius=8,
@@ -1113,6 +4028,26 @@ class CartsManagementApp:
                     on_change=self.filter_carts,
                     ref=ft.Ref[ft.TextField]()
                 ),
+                ft.Dropdown(
+                    width=150,
+                    height=40,
+                    border_radius=8,
+                    content_padding=ft.padding.symmetric(horizontal=10),
+                    options=[ft.dropdown.Option('all', "كل الحالات")] +
+                            [ft.dropdown.Option(key, text) for key, text in CART_STATUS.items()],
+                    value='all',
+                    on_change=self.filter_carts_by_status
+                ),
+                ft.Dropdown(
+                    width=180,
+                    height=40,
+                    border_radius=8,
+                    content_padding=ft.padding.symmetric(horizontal=10),
+                    options=[ft.dropdown.Option('all', "كل المستودعات")] +
+                            [ft.dropdown.Option(str(wh_id), name) for wh_id, name in self.db.get_all_warehouses()],
+                    value='all',
+                    on_change=self.filter_carts_by_warehouse
+                ),
                 ft.ElevatedButton(
                     text="إضافة عربة جديدة",
                     icon=ft.icons.ADD,
@@ -1152,11 +4087,12 @@ class CartsManagementApp:
             expand=True
         )
         
+        # التمرير يجلب الصفحات تدريجياً بدلاً من بناء كل الصفوف دفعة واحدة
+        self.cart_pager = PagedTable(self.page, self.cart_table, self.fetch_carts_page, self.build_cart_row)
+        
         # حاوية الجدول مع التمرير
         table_container = ft.Container(
-            content=ft.Column([
-                self.cart_table
-            ], scroll=ft.ScrollMode.AUTO),
+            content=self.cart_pager.view,
             expand=True,
             bgcolor=COLORS['white'],
             border_radius=10,
@@ -1170,100 +4106,140 @@ class CartsManagementApp:
     
     def load_carts(self):
         """تحميل قائمة العربات"""
-        if not self.cart_table:
+        if not self.cart_pager:
             return
         
-        self.cart_table.rows.clear()
-        
-        carts = self.db.execute_query("""
+        self.cart_pager.reset()
+    
+    def fetch_carts_page(self, after_id=None, before_id=None, limit=TABLE_PAGE_SIZE, cart_id=None):
+        """جلب صفحة من العربات المطابقة للفلاتر بترقيم المفاتيح على المعرف (الأحدث أولاً)"""
+        conditions = []
+        params = []
+        
+        if cart_id is not None:
+            conditions.append("c.id = ?")
+            params.append(cart_id)
+        if self.cart_filters['search']:
+            conditions.append("c.serial_number LIKE ? ESCAPE '\\'")
+            params.append(like_prefix(self.cart_filters['search']))
+        if self.cart_filters['status']:
+            conditions.append("c.status = ?")
+            params.append(self.cart_filters['status'])
+        if self.cart_filters['warehouse_id']:
+            conditions.append("c.current_warehouse_id = ?")
+            params.append(self.cart_filters['warehouse_id'])
+        if after_id is not None:
+            conditions.append("c.id < ?")
+            params.append(after_id)
+        if before_id is not None:
+            conditions.append("c.id > ?")
+            params.append(before_id)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        order = "ASC" if before_id is not None else "DESC"
+        
+        carts = self.db.execute_query(f"""
             SELECT c.id, c.serial_number, c.status, w.name, c.last_updated
             FROM carts c
             LEFT JOIN warehouses w ON c.current_warehouse_id = w.id
-            ORDER BY c.id DESC
-        """)
-        
-        for cart in carts:
-            cart_id, serial, status, warehouse, updated = cart
-            status_text = CART_STATUS.get(status, status)
-            
-            # تحديد لون الصف حسب الحالة
-            row_color = None
-            if status == 'sound':
-                row_color = ft.colors.with_opacity(0.1, COLORS['success'])
-            elif status == 'needs_maintenance':
-                row_color = ft.colors.with_opacity(0.1, COLORS['warning'])
-            elif status == 'damaged':
-                row_color = ft.colors.with_opacity(0.1, COLORS['danger'])
-            
-            # أزرار الإجراءات
-            actions_row = ft.Row([
-                ft.IconButton(
-                    icon=ft.icons.EDIT,
-                    icon_size=18,
-                    icon_color=COLORS['primary'],
-                    tooltip="تعديل",
-                    on_click=lambda e, cid=cart_id, s=serial: self.edit_cart(cid, s),
-                    visible=self.check_permission('can_edit_cart')
-                ),
-                ft.IconButton(
-                    icon=ft.icons.DELETE,
-                    icon_size=18,
-                    icon_color=COLORS['danger'],
-                    tooltip="حذف",
-                    on_click=lambda e, cid=cart_id: self.delete_cart(cid),
-                    visible=self.check_permission('can_delete_cart')
-                ),
-            ], spacing=5)
-            
-            self.cart_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(str(cart_id), size=13)),
-                        ft.DataCell(ft.Text(serial, size=13)),
-                        ft.DataCell(ft.Container(
-                            content=ft.Text(status_text, size=13, color=COLORS['white']),
-                            bgcolor=COLORS['success'] if status == 'sound' else 
-                                   COLORS['warning'] if status == 'needs_maintenance' else 
-                                   COLORS['danger'],
-                            padding=ft.padding.symmetric(horizontal=8, vertical=4),
-                            border_radius=4
-                        )),
-                        ft.DataCell(ft.Text(warehouse or "غير محدد", size=13)),
-                        ft.DataCell(ft.Text(updated[:10] if updated else "", size=13)),
-                        ft.DataCell(actions_row),
-                    ],
-                    color=row_color
-                )
-            )
-        
-        self.page.update()
+            {where}
+            ORDER BY c.id {order}
+            LIMIT ?
+        """, params + [limit])
+        
+        # الصفحة السابقة تُجلب تصاعدياً ثم تُعكس لترتيب العرض
+        if before_id is not None:
+            carts.reverse()
+        return carts
     
-    def filter_carts(self, e):
-        """فلترة العربات حسب البحث"""
-        if not self.cart_table:
+    def refresh_cart_row(self, cart_id, is_new=False):
+        """تحديث صف عربة واحد في الجدول بعد إضافتها أو تعديلها"""
+        if not self.cart_pager:
             return
         
-        search_text = e.control.value.strip().lower() if e.control.value else ""
+        # العربة التي لم تعد تطابق الفلاتر الحالية تُزال من الجدول
+        carts = self.fetch_carts_page(cart_id=cart_id)
+        if not carts:
+            self.cart_pager.remove_row(cart_id)
+        elif is_new:
+            self.cart_pager.insert_row(carts[0])
+        else:
+            self.cart_pager.replace_row(carts[0])
+    
+    def build_cart_row(self, cart):
+        """بناء صف جدول لعربة"""
+        cart_id, serial, status, warehouse, updated = cart
+        status_text = CART_STATUS.get(status, status)
         
-        for row in self.cart_table.rows[:]:
-            values = []
-            for cell in row.cells[:4]:  # الأعمدة الأولى فقط
-                if isinstance(cell.content, ft.Text):
-                    values.append(cell.content.value.lower())
-                elif isinstance(cell.content, ft.Container):
-                    if isinstance(cell.content.content, ft.Text):
-                        values.append(cell.content.content.value.lower())
-            
-            if search_text:
-                if not any(search_text in val for val in values):
-                    self.cart_table.rows.remove(row)
-            else:
-                # إعادة تحميل الجدول بالكامل إذا كان البحث فارغاً
-                self.cart_table.rows.clear()
-                self.load_carts()
-                break
+        # تحديد لون الصف حسب الحالة
+        row_color = None
+        if status == 'sound':
+            row_color = ft.colors.with_opacity(0.1, COLORS['success'])
+        elif status == 'needs_maintenance':
+            row_color = ft.colors.with_opacity(0.1, COLORS['warning'])
+        elif status == 'damaged':
+            row_color = ft.colors.with_opacity(0.1, COLORS['danger'])
+        
+        # أزرار الإجراءات
+        actions_row = ft.Row([
+            ft.IconButton(
+                icon=ft.icons.EDIT,
+                icon_size=18,
+                icon_color=COLORS['primary'],
+                tooltip="تعديل",
+                on_click=lambda e, cid=cart_id, s=serial: self.edit_cart(cid, s),
+                visible=self.check_permission('can_edit_cart')
+            ),
+            ft.IconButton(
+                icon=ft.icons.DELETE,
+                icon_size=18,
+                icon_color=COLORS['danger'],
+                tooltip="حذف",
+                on_click=lambda e, cid=cart_id: self.delete_cart(cid),
+                visible=self.check_permission('can_delete_cart')
+            ),
+        ], spacing=5)
+        
+        return ft.DataRow(
+            cells=[
+                ft.DataCell(ft.Text(str(cart_id), size=13)),
+                ft.DataCell(ft.Text(serial, size=13)),
+                ft.DataCell(ft.Container(
+                    content=ft.Text(status_text, size=13, color=COLORS['white']),
+                    bgcolor=COLORS['success'] if status == 'sound' else 
+                           COLORS['warning'] if status == 'needs_maintenance' else 
+                           COLORS['danger'],
+                    padding=ft.padding.symmetric(horizontal=8, vertical=4),
+                    border_radius=4
+                )),
+                ft.DataCell(ft.Text(warehouse or "غير محدد", size=13)),
+                ft.DataCell(ft.Text(updated[:10] if updated else "", size=13)),
+                ft.DataCell(actions_row),
+            ],
+            color=row_color
+        )
+    
+    def search_carts(self, delay_ms=None):
+        """جلب الصفحة الأولى المطابقة لفلاتر العربات في الخلفية"""
+        if not self.cart_pager:
+            return
         
-        self.page.update()
+        self.search.submit('carts', self.fetch_carts_page, self.cart_pager.show_first_page, delay_ms)
+    
+    def filter_carts(self, e):
+        """فلترة العربات حسب بادئة الرقم التسلسلي"""
+        self.cart_filters['search'] = self.field_text(e.control)
+        self.search_carts()
+    
+    def filter_carts_by_status(self, e):
+        """فلترة العربات حسب الحالة"""
+        self.cart_filters['status'] = None if e.control.value == 'all' else e.control.value
+        self.search_carts(delay_ms=0)
+    
+    def filter_carts_by_warehouse(self, e):
+        """فلترة العربات حسب المستودع الحالي"""
+        self.cart_filters['warehouse_id'] = None if e.control.value == 'all' else int(e.control.value)
+        self.search_carts(delay_ms=0)
     
     def show_add_cart_dialog(self, e):
         """عرض نافذة إضافة عربة جديدة"""
@@ -1342,16 +4318,13 @@ class CartsManagementApp:
                     (serial, status, warehouse_id, self.current_user['id'], notes)
                 )
                 
-                if warehouse_id:
-                    self.db.update_warehouse_count(warehouse_id)
-                
                 self.db.log_action(self.current_user['id'], 'add_cart',
                                   f'إضافة عربة جديدة رقم {serial}')
                 
                 dialog.open = False
                 self.page.update()
                 self.show_snack_bar("تم إضافة العربة بنجاح", COLORS['success'])
-                self.load_carts()
+                self.refresh_cart_row(cart_id, is_new=True)
                 
             except sqlite3.IntegrityError:
                 self.show_snack_bar("الرقم التسلسلي موجود مسبقاً", COLORS['danger'])
@@ -1459,30 +4432,21 @@ class CartsManagementApp:
                     new_warehouse_id = w[0]
                     break
             
-            old_warehouse = self.db.execute_query(
-                "SELECT current_warehouse_id FROM carts WHERE id = ?",
-                (cart_id,)
-            )[0][0]
-            
-            self.db.execute_query(
-                """UPDATE carts 
-                   SET status = ?, current_warehouse_id = ?, last_updated = CURRENT_TIMESTAMP, notes = ? 
-                   WHERE id = ?""",
-                (new_status, new_warehouse_id, new_notes, cart_id)
-            )
-            
-            if old_warehouse:
-                self.db.update_warehouse_count(old_warehouse)
-            if new_warehouse_id:
-                self.db.update_warehouse_count(new_warehouse_id)
-            
-            self.db.log_action(self.current_user['id'], 'edit_cart',
-                              f'تعديل العربة رقم {serial}')
+            with self.db.transaction() as cursor:
+                cursor.execute(
+                    """UPDATE carts 
+                       SET status = ?, current_warehouse_id = ?, last_updated = CURRENT_TIMESTAMP, notes = ? 
+                       WHERE id = ?""",
+                    (new_status, new_warehouse_id, new_notes, cart_id)
+                )
+                
+                self.db.log_action(self.current_user['id'], 'edit_cart',
+                                  f'تعديل العربة رقم {serial}')
             
             dialog.open = False
             self.page.update()
             self.show_snack_bar("تم تعديل العربة بنجاح", COLORS['success'])
-            self.load_carts()
+            self.refresh_cart_row(cart_id)
         
         dialog = ft.AlertDialog(
             title=ft.Text(f"تعديل العربة: {serial}", size=18, weight=ft.FontWeight.BOLD),
@@ -1514,25 +4478,26 @@ class CartsManagementApp:
             return
         
         def confirm_delete(e):
-            result = self.db.execute_query(
-                "SELECT current_warehouse_id, serial_number FROM carts WHERE id = ?",
-                (cart_id,)
-            )
+            with self.db.transaction() as cursor:
+                cursor.execute(
+                    "SELECT serial_number FROM carts WHERE id = ?",
+                    (cart_id,)
+                )
+                result = cursor.fetchone()
+                
+                if result:
+                    serial = result[0]
+                    cursor.execute("DELETE FROM carts WHERE id = ?", (cart_id,))
+                    
+                    self.db.log_action(self.current_user['id'], 'delete_cart',
+                                      f'حذف العربة رقم {serial}')
             
             if result:
-                warehouse_id, serial = result[0]
-                self.db.execute_query("DELETE FROM carts WHERE id = ?", (cart_id,))
-                
-                if warehouse_id:
-                    self.db.update_warehouse_count(warehouse_id)
-                
-                self.db.log_action(self.current_user['id'], 'delete_cart',
-                                  f'حذف العربة رقم {serial}')
-                
                 dialog.open = False
                 self.page.update()
                 self.show_snack_bar("تم حذف العربة بنجاح", COLORS['success'])
-                self.load_carts()
+                if self.cart_pager:
+                    self.cart_pager.remove_row(cart_id)
         
         def cancel_delete(e):
             dialog.open = False
@@ -1655,33 +4620,35 @@ class CartsManagementApp:
                     self.show_snack_bar("العربة غير موجودة", COLORS['danger'])
                     return
                 
-                result = self.db.execute_query(
-                    "SELECT current_warehouse_id FROM carts WHERE id = ?",
-                    (cart_id,)
-                )
+                # التحقق والنقل والسجل في معاملة واحدة
+                with self.db.transaction() as cursor:
+                    cursor.execute(
+                        "SELECT current_warehouse_id FROM carts WHERE id = ?",
+                        (cart_id,)
+                    )
+                    result = cursor.fetchone()
+                    in_source = bool(result) and result[0] == from_id
+                    
+                    if in_source:
+                        cursor.execute(
+                            "UPDATE carts SET current_warehouse_id = ?, last_updated = CURRENT_TIMESTAMP WHERE id = ?",
+                            (to_id, cart_id)
+                        )
+                        
+                        cursor.execute(
+                            """INSERT INTO movements 
+                               (cart_id, from_warehouse_id, to_warehouse_id, user_id, notes) 
+                               VALUES (?, ?, ?, ?, ?)""",
+                            (cart_id, from_id, to_id, self.current_user['id'], notes)
+                        )
+                        
+                        self.db.log_action(self.current_user['id'], 'move_cart',
+                                          f'نقل العربة {cart_text} من {from_warehouse} إلى {to_warehouse}')
                 
-                if not result or result[0][0] != from_id:
+                if not in_source:
                     self.show_snack_bar("العربة ليست في المستودع المصدر المحدد", COLORS['danger'])
                     return
                 
-                self.db.execute_query(
-                    "UPDATE carts SET current_warehouse_id = ?, last_updated = CURRENT_TIMESTAMP WHERE id = ?",
-                    (to_id, cart_id)
-                )
-                
-                self.db.execute_insert(
-                    """INSERT INTO movements 
-                       (cart_id, from_warehouse_id, to_warehouse_id, user_id, notes) 
-                       VALUES (?, ?, ?, ?, ?)""",
-                    (cart_id, from_id, to_id, self.current_user['id'], notes)
-                )
-                
-                self.db.update_warehouse_count(from_id)
-                self.db.update_warehouse_count(to_id)
-                
-                self.db.log_action(self.current_user['id'], 'move_cart',
-                                  f'نقل العربة {cart_text} من {from_warehouse} إلى {to_warehouse}')
-                
                 self.show_snack_bar("تم نقل العربة بنجاح", COLORS['success'])
                 self.show_cart_movement()  # إعادة تحميل الصفحة
             
@@ -1778,6 +4745,7 @@ class CartsManagementApp:
             )
             
             self.movement_table = history_card.content.controls[2]
+            self.movement_rows = TableRows(self.page, self.movement_table, self.build_movement_row)
             self.movement_search_field = history_card.content.controls[0].controls[1]
             
             self.content_column.controls.append(history_card)
@@ -1797,14 +4765,17 @@ class CartsManagementApp:
                         self.page.update()
                     break
     
-    def load_movements(self):
-        """تحميل سجل الحركات"""
-        if not self.movement_table:
-            return
-        
-        self.movement_table.rows.clear()
+    def fetch_movements(self, search_text=""):
+        """جلب آخر الحركات المطابقة لنص البحث"""
+        where = ""
+        params = []
+        if search_text:
+            pattern = like_contains(search_text)
+            where = """WHERE m.timestamp LIKE ? ESCAPE '\\' OR c.serial_number LIKE ? ESCAPE '\\'
+                OR w1.name LIKE ? ESCAPE '\\' OR w2.name LIKE ? ESCAPE '\\' OR u.username LIKE ? ESCAPE '\\'"""
+            params = [pattern] * 5
         
-        movements = self.db.execute_query("""
+        return self.db.execute_query(f"""
             SELECT 
                 m.id,
                 m.timestamp,
@@ -1818,75 +4789,69 @@ class CartsManagementApp:
             LEFT JOIN warehouses w1 ON m.from_warehouse_id = w1.id
             JOIN warehouses w2 ON m.to_warehouse_id = w2.id
             LEFT JOIN users u ON m.user_id = u.id
+            {where}
             ORDER BY m.timestamp DESC
             LIMIT 200
-        """)
+        """, params)
+    
+    def load_movements(self, movements=None):
+        """تحميل سجل الحركات"""
+        if not self.movement_table:
+            return
         
-        for m in movements:
-            movement_id, timestamp, serial, from_wh, to_wh, username, notes = m
-            
-            actions_row = ft.Row([
-                ft.IconButton(
-                    icon=ft.icons.DELETE,
-                    icon_size=18,
-                    icon_color=COLORS['danger'],
-                    tooltip="حذف",
-                    on_click=lambda e, mid=movement_id: self.delete_movement(mid),
-                    visible=self.check_permission('can_delete_cart')
-                ),
-            ], spacing=5)
-            
-            self.movement_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(timestamp[:16] if timestamp else "", size=12)),
-                        ft.DataCell(ft.Text(serial, size=12)),
-                        ft.DataCell(ft.Text(from_wh or "-", size=12)),
-                        ft.DataCell(ft.Text(to_wh, size=12)),
-                        ft.DataCell(ft.Text(username or "", size=12)),
-                        ft.DataCell(ft.Text((notes[:20] + '...') if notes and len(notes) > 20 else (notes or ""), size=12)),
-                        ft.DataCell(actions_row),
-                    ]
-                )
-            )
+        if movements is None:
+            movements = self.fetch_movements(self.field_text(self.movement_search_field))
         
-        self.page.update()
+        self.movement_rows.load(movements)
+    
+    def build_movement_row(self, m):
+        """بناء صف جدول لحركة"""
+        movement_id, timestamp, serial, from_wh, to_wh, username, notes = m
+        
+        actions_row = ft.Row([
+            ft.IconButton(
+                icon=ft.icons.DELETE,
+                icon_size=18,
+                icon_color=COLORS['danger'],
+                tooltip="حذف",
+                on_click=lambda e, mid=movement_id: self.delete_movement(mid),
+                visible=self.check_permission('can_delete_cart')
+            ),
+        ], spacing=5)
+        
+        return ft.DataRow(
+            cells=[
+                ft.DataCell(ft.Text(timestamp[:16] if timestamp else "", size=12)),
+                ft.DataCell(ft.Text(serial, size=12)),
+                ft.DataCell(ft.Text(from_wh or "-", size=12)),
+                ft.DataCell(ft.Text(to_wh, size=12)),
+                ft.DataCell(ft.Text(username or "", size=12)),
+                ft.DataCell(ft.Text((notes[:20] + '...') if notes and len(notes) > 20 else (notes or ""), size=12)),
+                ft.DataCell(actions_row),
+            ]
+        )
     
     def filter_movements(self, e):
         """فلترة سجل الحركات"""
         if not self.movement_table:
             return
         
-        search_text = e.control.value.strip().lower() if e.control.value else ""
-        
-        # إعادة تحميل البيانات
-        self.load_movements()
-        
-        if search_text:
-            for row in self.movement_table.rows[:]:
-                match = False
-                for i, cell in enumerate(row.cells[:5]):  # الأعمدة الأولى
-                    if isinstance(cell.content, ft.Text):
-                        if search_text in cell.content.value.lower():
-                            match = True
-                            break
-                
-                if not match:
-                    self.movement_table.rows.remove(row)
-        
-        self.page.update()
+        search_text = self.field_text(e.control)
+        self.search.submit('movements', lambda: self.fetch_movements(search_text), self.load_movements)
     
     def delete_movement(self, movement_id):
         """حذف حركة"""
         def confirm_delete(e):
-            self.db.execute_query("DELETE FROM movements WHERE id = ?", (movement_id,))
-            self.db.log_action(self.current_user['id'], 'delete_movement',
-                              f'حذف حركة رقم {movement_id}')
+            with self.db.transaction() as cursor:
+                cursor.execute("DELETE FROM movements WHERE id = ?", (movement_id,))
+                self.db.log_action(self.current_user['id'], 'delete_movement',
+                                  f'حذف حركة رقم {movement_id}')
             
             dialog.open = False
             self.page.update()
             self.show_snack_bar("تم حذف الحركة بنجاح", COLORS['success'])
-            self.load_movements()
+            if self.movement_rows:
+                self.movement_rows.remove_row(movement_id)
         
         def cancel_delete(e):
             dialog.open = False
@@ -1933,21 +4898,11 @@ class CartsManagementApp:
         cart_options = [f"{c[1]} - ({c[2] or 'غير محدد'})" for c in carts]
         
         # ===== إحصائيات الصيانة =====
-        pending = self.db.execute_query(
-            "SELECT COUNT(*) FROM maintenance_records WHERE status = 'pending'"
-        )[0][0] or 0
-        
-        in_progress = self.db.execute_query(
-            "SELECT COUNT(*) FROM maintenance_records WHERE status = 'in_progress'"
-        )[0][0] or 0
-        
-        completed = self.db.execute_query(
-            "SELECT COUNT(*) FROM maintenance_records WHERE status = 'completed'"
-        )[0][0] or 0
-        
-        total_cost = self.db.execute_query(
-            "SELECT SUM(cost) FROM maintenance_records WHERE status = 'completed'"
-        )[0][0] or 0
+        stats = self.db.stats.get()
+        pending = stats['pending_maintenance']
+        in_progress = stats['in_progress_maintenance']
+        completed = stats['completed_maintenance']
+        total_cost = stats['total_cost']
         
         # بطاقات الإحصائيات
         stats_row = ft.ResponsiveRow(
@@ -2113,6 +5068,7 @@ class CartsManagementApp:
         )
         
         self.maintenance_table = records_card.content.controls[2]
+        self.maintenance_rows = TableRows(self.page, self.maintenance_table, self.build_maintenance_row)
         self.maintenance_search_field = records_card.content.controls[0].controls[1]
         
         self.content_column.controls.append(records_card)
@@ -2153,20 +5109,21 @@ class CartsManagementApp:
         new_status = status_map.get(status_text, "needs_maintenance")
         
         try:
-            self.db.execute_query(
-                "UPDATE carts SET status = ?, last_updated = CURRENT_TIMESTAMP WHERE id = ?",
-                (new_status, cart_id)
-            )
-            
-            self.db.execute_insert(
-                """INSERT INTO maintenance_records 
-                   (cart_id, maintenance_type, status, description, user_id, cost) 
-                   VALUES (?, ?, 'pending', ?, ?, ?)""",
-                (cart_id, maint_type, description, self.current_user['id'], cost)
-            )
-            
-            self.db.log_action(self.current_user['id'], 'add_maintenance',
-                              f'إدخال العربة {cart_text} للصيانة')
+            with self.db.transaction() as cursor:
+                cursor.execute(
+                    "UPDATE carts SET status = ?, last_updated = CURRENT_TIMESTAMP WHERE id = ?",
+                    (new_status, cart_id)
+                )
+                
+                cursor.execute(
+                    """INSERT INTO maintenance_records 
+                       (cart_id, maintenance_type, status, description, user_id, cost) 
+                       VALUES (?, ?, 'pending', ?, ?, ?)""",
+                    (cart_id, maint_type, description, self.current_user['id'], cost)
+                )
+                
+                self.db.log_action(self.current_user['id'], 'add_maintenance',
+                                  f'إدخال العربة {cart_text} للصيانة')
             
             self.show_snack_bar("تم إدخال العربة للصيانة", COLORS['success'])
             self.show_maintenance()  # إعادة تحميل الصفحة
@@ -2174,14 +5131,34 @@ class CartsManagementApp:
         except Exception as e:
             self.show_snack_bar(f"حدث خطأ: {str(e)}", COLORS['danger'])
     
-    def load_maintenance_records(self):
-        """تحميل سجل الصيانة"""
-        if not self.maintenance_table:
-            return
+    def fetch_maintenance_records(self, search_text="", record_id=None):
+        """جلب آخر سجلات الصيانة المطابقة لنص البحث"""
+        where = ""
+        params = []
+        if record_id is not None:
+            where = "WHERE m.id = ?"
+            params = [record_id]
         
-        self.maintenance_table.rows.clear()
+        if search_text:
+            pattern = like_contains(search_text)
+            conditions = [
+                "m.entry_date LIKE ? ESCAPE '\\'",
+                "c.serial_number LIKE ? ESCAPE '\\'",
+                "m.maintenance_type LIKE ? ESCAPE '\\'",
+                "m.description LIKE ? ESCAPE '\\'",
+            ]
+            params += [pattern] * len(conditions)
+            
+            # الحالة مخزنة برمزها بينما يبحث المستخدم بالاسم المعروض
+            statuses = [key for key, text in MAINTENANCE_STATUS.items() if search_text in text]
+            if statuses:
+                conditions.append(f"m.status IN ({', '.join('?' * len(statuses))})")
+                params.extend(statuses)
+            
+            search_clause = f"({' OR '.join(conditions)})"
+            where = f"{where} AND {search_clause}" if where else f"WHERE {search_clause}"
         
-        records = self.db.execute_query("""
+        return self.db.execute_query(f"""
             SELECT 
                 m.id,
                 m.entry_date,
@@ -2193,76 +5170,95 @@ class CartsManagementApp:
                 m.completion_date
             FROM maintenance_records m
             JOIN carts c ON m.cart_id = c.id
+            {where}
             ORDER BY m.entry_date DESC
             LIMIT 200
-        """)
+        """, params)
+    
+    def load_maintenance_records(self, records=None):
+        """تحميل سجل الصيانة"""
+        if not self.maintenance_table:
+            return
         
-        for record in records:
-            rec_id, entry_date, serial, maint_type, status, desc, cost, comp_date = record
-            status_text = MAINTENANCE_STATUS.get(status, status)
-            
-            # تحديد لون الحالة
-            status_color = COLORS['warning'] if status == 'pending' else \
-                          COLORS['primary'] if status == 'in_progress' else \
-                          COLORS['success']
-            
-            # أزرار الإجراءات
-            actions_row = ft.Row(spacing=5)
-            
-            if status == 'pending' and self.check_permission('can_complete_maintenance'):
-                actions_row.controls.append(
-                    ft.IconButton(
-                        icon=ft.icons.CHECK_CIRCLE,
-                        icon_size=18,
-                        icon_color=COLORS['success'],
-                        tooltip="إتمام الصيانة",
-                        on_click=lambda e, rid=rec_id: self.complete_maintenance(rid)
-                    )
-                )
-            
-            if self.check_permission('can_edit_cart'):
-                actions_row.controls.append(
-                    ft.IconButton(
-                        icon=ft.icons.EDIT,
-                        icon_size=18,
-                        icon_color=COLORS['primary'],
-                        tooltip="تعديل",
-                        on_click=lambda e, rid=rec_id: self.edit_maintenance_record(rid)
-                    )
+        if records is None:
+            records = self.fetch_maintenance_records(self.field_text(self.maintenance_search_field))
+        
+        self.maintenance_rows.load(records)
+    
+    def refresh_maintenance_row(self, record_id):
+        """تحديث صف سجل صيانة واحد بعد تعديله"""
+        if not self.maintenance_rows:
+            return
+        
+        records = self.fetch_maintenance_records(self.field_text(self.maintenance_search_field), record_id)
+        if records:
+            self.maintenance_rows.replace_row(records[0])
+        else:
+            self.maintenance_rows.remove_row(record_id)
+    
+    def build_maintenance_row(self, record):
+        """بناء صف جدول لسجل صيانة"""
+        rec_id, entry_date, serial, maint_type, status, desc, cost, comp_date = record
+        status_text = MAINTENANCE_STATUS.get(status, status)
+        
+        # تحديد لون الحالة
+        status_color = COLORS['warning'] if status == 'pending' else \
+                      COLORS['primary'] if status == 'in_progress' else \
+                      COLORS['success']
+        
+        # أزرار الإجراءات
+        actions_row = ft.Row(spacing=5)
+        
+        if status == 'pending' and self.check_permission('can_complete_maintenance'):
+            actions_row.controls.append(
+                ft.IconButton(
+                    icon=ft.icons.CHECK_CIRCLE,
+                    icon_size=18,
+                    icon_color=COLORS['success'],
+                    tooltip="إتمام الصيانة",
+                    on_click=lambda e, rid=rec_id: self.complete_maintenance(rid)
                 )
-            
-            if self.check_permission('can_delete_cart'):
-                actions_row.controls.append(
-                    ft.IconButton(
-                        icon=ft.icons.DELETE,
-                        icon_size=18,
-                        icon_color=COLORS['danger'],
-                        tooltip="حذف",
-                        on_click=lambda e, rid=rec_id: self.delete_maintenance_record(rid)
-                    )
+            )
+        
+        if self.check_permission('can_edit_cart'):
+            actions_row.controls.append(
+                ft.IconButton(
+                    icon=ft.icons.EDIT,
+                    icon_size=18,
+                    icon_color=COLORS['primary'],
+                    tooltip="تعديل",
+                    on_click=lambda e, rid=rec_id: self.edit_maintenance_record(rid)
                 )
-            
-            self.maintenance_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(entry_date[:16] if entry_date else "", size=12)),
-                        ft.DataCell(ft.Text(serial, size=12)),
-                        ft.DataCell(ft.Text(maint_type, size=12)),
-                        ft.DataCell(ft.Container(
-                            content=ft.Text(status_text, size=12, color=COLORS['white']),
-                            bgcolor=status_color,
-                            padding=ft.padding.symmetric(horizontal=8, vertical=2),
-                            border_radius=4
-                        )),
-                        ft.DataCell(ft.Text((desc[:30] + '...') if desc and len(desc) > 30 else (desc or ""), size=12)),
-                        ft.DataCell(ft.Text(f"{cost:.0f} ر.س", size=12)),
-                        ft.DataCell(ft.Text(comp_date[:10] if comp_date else "", size=12)),
-                        ft.DataCell(actions_row),
-                    ]
+            )
+        
+        if self.check_permission('can_delete_cart'):
+            actions_row.controls.append(
+                ft.IconButton(
+                    icon=ft.icons.DELETE,
+                    icon_size=18,
+                    icon_color=COLORS['danger'],
+                    tooltip="حذف",
+                    on_click=lambda e, rid=rec_id: self.delete_maintenance_record(rid)
                 )
             )
         
-        self.page.update()
+        return ft.DataRow(
+            cells=[
+                ft.DataCell(ft.Text(entry_date[:16] if entry_date else "", size=12)),
+                ft.DataCell(ft.Text(serial, size=12)),
+                ft.DataCell(ft.Text(maint_type, size=12)),
+                ft.DataCell(ft.Container(
+                    content=ft.Text(status_text, size=12, color=COLORS['white']),
+                    bgcolor=status_color,
+                    padding=ft.padding.symmetric(horizontal=8, vertical=2),
+                    border_radius=4
+                )),
+                ft.DataCell(ft.Text((desc[:30] + '...') if desc and len(desc) > 30 else (desc or ""), size=12)),
+                ft.DataCell(ft.Text(f"{cost:.0f} ر.س", size=12)),
+                ft.DataCell(ft.Text(comp_date[:10] if comp_date else "", size=12)),
+                ft.DataCell(actions_row),
+            ]
+        )
     
     def complete_maintenance(self, record_id):
         """إتمام الصيانة"""
@@ -2271,32 +5267,34 @@ class CartsManagementApp:
             return
         
         def confirm_complete(e):
-            self.db.execute_query(
-                """UPDATE maintenance_records 
-                   SET status = 'completed', completion_date = CURRENT_TIMESTAMP, completed_by = ? 
-                   WHERE id = ?""",
-                (self.current_user['id'], record_id)
-            )
-            
-            result = self.db.execute_query(
-                "SELECT cart_id FROM maintenance_records WHERE id = ?",
-                (record_id,)
-            )
-            
-            if result:
-                cart_id = result[0][0]
-                self.db.execute_query(
-                    "UPDATE carts SET status = 'sound', last_updated = CURRENT_TIMESTAMP WHERE id = ?",
-                    (cart_id,)
+            with self.db.transaction() as cursor:
+                cursor.execute(
+                    """UPDATE maintenance_records 
+                       SET status = 'completed', completion_date = CURRENT_TIMESTAMP, completed_by = ? 
+                       WHERE id = ?""",
+                    (self.current_user['id'], record_id)
                 )
-            
-            self.db.log_action(self.current_user['id'], 'complete_maintenance',
-                              f'إتمام صيانة للسجل رقم {record_id}')
+                
+                cursor.execute(
+                    "SELECT cart_id FROM maintenance_records WHERE id = ?",
+                    (record_id,)
+                )
+                result = cursor.fetchone()
+                
+                if result:
+                    cart_id = result[0]
+                    cursor.execute(
+                        "UPDATE carts SET status = 'sound', last_updated = CURRENT_TIMESTAMP WHERE id = ?",
+                        (cart_id,)
+                    )
+                
+                self.db.log_action(self.current_user['id'], 'complete_maintenance',
+                                  f'إتمام صيانة للسجل رقم {record_id}')
             
             dialog.open = False
             self.page.update()
             self.show_snack_bar("تم إتمام الصيانة", COLORS['success'])
-            self.load_maintenance_records()
+            self.refresh_maintenance_row(record_id)
         
         def cancel_complete(e):
             dialog.open = False
@@ -2394,30 +5392,31 @@ class CartsManagementApp:
             }
             new_status = status_map.get(new_status_text, "pending")
             
-            self.db.execute_query(
-                """UPDATE maintenance_records 
-                   SET maintenance_type = ?, status = ?, description = ?, cost = ? 
-                   WHERE id = ?""",
-                (new_maint_type, new_status, new_description, new_cost, record_id)
-            )
-            
-            if new_status == 'completed' and status != 'completed':
-                self.db.execute_query(
-                    "UPDATE carts SET status = 'sound', last_updated = CURRENT_TIMESTAMP WHERE id = ?",
-                    (cart_id,)
-                )
-                self.db.execute_query(
-                    "UPDATE maintenance_records SET completion_date = CURRENT_TIMESTAMP WHERE id = ?",
-                    (record_id,)
+            with self.db.transaction() as cursor:
+                cursor.execute(
+                    """UPDATE maintenance_records 
+                       SET maintenance_type = ?, status = ?, description = ?, cost = ? 
+                       WHERE id = ?""",
+                    (new_maint_type, new_status, new_description, new_cost, record_id)
                 )
-            
-            self.db.log_action(self.current_user['id'], 'edit_maintenance',
-                              f'تعديل سجل صيانة رقم {record_id}')
+                
+                if new_status == 'completed' and status != 'completed':
+                    cursor.execute(
+                        "UPDATE carts SET status = 'sound', last_updated = CURRENT_TIMESTAMP WHERE id = ?",
+                        (cart_id,)
+                    )
+                    cursor.execute(
+                        "UPDATE maintenance_records SET completion_date = CURRENT_TIMESTAMP WHERE id = ?",
+                        (record_id,)
+                    )
+                
+                self.db.log_action(self.current_user['id'], 'edit_maintenance',
+                                  f'تعديل سجل صيانة رقم {record_id}')
             
             dialog.open = False
             self.page.update()
             self.show_snack_bar("تم تحديث سجل الصيانة بنجاح", COLORS['success'])
-            self.load_maintenance_records()
+            self.refresh_maintenance_row(record_id)
         
         dialog = ft.AlertDialog(
             title=ft.Text(f"تعديل سجل الصيانة - {serial}", size=18, weight=ft.FontWeight.BOLD),
@@ -2452,7 +5451,8 @@ class CartsManagementApp:
             dialog.open = False
             self.page.update()
             self.show_snack_bar("تم حذف سجل الصيانة بنجاح", COLORS['success'])
-            self.load_maintenance_records()
+            if self.maintenance_rows:
+                self.maintenance_rows.remove_row(record_id)
         
         def cancel_delete(e):
             dialog.open = False
@@ -2477,29 +5477,9 @@ class CartsManagementApp:
         if not self.maintenance_table:
             return
         
-        search_text = e.control.value.strip().lower() if e.control.value else ""
-        
-        # إعادة تحميل البيانات
-        self.load_maintenance_records()
-        
-        if search_text:
-            for row in self.maintenance_table.rows[:]:
-                match = False
-                for i, cell in enumerate(row.cells[:5]):  # الأعمدة الأولى
-                    if isinstance(cell.content, ft.Text):
-                        if search_text in cell.content.value.lower():
-                            match = True
-                            break
-                    elif isinstance(cell.content, ft.Container):
-                        if isinstance(cell.content.content, ft.Text):
-                            if search_text in cell.content.content.value.lower():
-                                match = True
-                                break
-                
-                if not match:
-                    self.maintenance_table.rows.remove(row)
-        
-        self.page.update()
+        search_text = self.field_text(e.control)
+        self.search.submit('maintenance', lambda: self.fetch_maintenance_records(search_text),
+                           self.load_maintenance_records)
     
     # ================================ إدارة المستودعات ================================
     def show_warehouse_management(self):
@@ -2579,19 +5559,24 @@ class CartsManagementApp:
         self.load_warehouses()
         self.page.update()
     
-    def load_warehouses(self):
+    def fetch_warehouses(self, search_text=""):
+        """جلب المستودعات النشطة المطابقة لنص البحث"""
+        return self.db.execute_query("""
+            SELECT id, name, capacity, current_count 
+            FROM warehouses 
+            WHERE is_active = 1 AND name LIKE ? ESCAPE '\\'
+            ORDER BY id
+        """, (like_contains(search_text),))
+    
+    def load_warehouses(self, warehouses=None):
         """تحميل قائمة المستودعات"""
         if not self.warehouse_table:
             return
         
-        self.warehouse_table.rows.clear()
+        if warehouses is None:
+            warehouses = self.fetch_warehouses(self.field_text(self.warehouse_search_field))
         
-        warehouses = self.db.execute_query("""
-            SELECT id, name, capacity, current_count 
-            FROM warehouses 
-            WHERE is_active = 1
-            ORDER BY id
-        """)
+        self.warehouse_table.rows.clear()
         
         base_warehouse_names = [wh['name'] for wh in WAREHOUSES]
         
@@ -2662,15 +5647,8 @@ class CartsManagementApp:
         if not self.warehouse_table:
             return
         
-        search_text = e.control.value.strip().lower() if e.control.value else ""
-        
-        for row in self.warehouse_table.rows[:]:
-            name_cell = row.cells[1].content
-            if isinstance(name_cell, ft.Text):
-                if search_text and search_text not in name_cell.value.lower():
-                    self.warehouse_table.rows.remove(row)
-        
-        self.page.update()
+        search_text = self.field_text(e.control)
+        self.search.submit('warehouses', lambda: self.fetch_warehouses(search_text), self.load_warehouses)
     
     def show_add_warehouse_dialog(self, e):
         """عرض نافذة إضافة مستودع جديد"""
@@ -3025,6 +6003,25 @@ class CartsManagementApp:
         self.content_column.controls.append(options_card)
         self.content_column.controls.append(ft.Container(height=20))
         
+        # ===== التنزيلات =====
+        exports_card = ft.Container(
+            bgcolor=COLORS['white'],
+            border_radius=10,
+            border=ft.border.all(1, COLORS['gray']),
+            padding=20,
+            content=ft.Column([
+                ft.Text("التنزيلات", size=18, weight=ft.FontWeight.BOLD, color=COLORS['dark']),
+                ft.Divider(height=1, color=COLORS['light']),
+                ft.Column(spacing=5)
+            ]),
+            visible=self.check_permission('can_export_reports')
+        )
+        
+        self.export_list = exports_card.content.controls[2]
+        self.render_exports()
+        self.content_column.controls.append(exports_card)
+        self.content_column.controls.append(ft.Container(height=20))
+        
         # ===== معاينة التقرير =====
         preview_card = ft.Container(
             bgcolor=COLORS['white'],
@@ -3069,232 +6066,36 @@ class CartsManagementApp:
         period = self.period_dropdown.value if self.period_dropdown else "كل الفترات"
         
         try:
-            if report_type == "تقرير حالة العربات":
-                self.preview_cart_status_report()
-            elif report_type == "تقرير حركة العربات":
-                self.preview_movement_report(period)
-            elif report_type == "تقرير الصيانة":
-                self.preview_maintenance_report(period)
-            elif report_type == "تقرير المستودعات":
-                self.preview_warehouse_report()
-            elif report_type == "تقرير شامل":
-                self.preview_summary_report()
+            report = self.build_report(report_type, period)
         except Exception as ex:
             self.show_snack_bar(f"حدث خطأ أثناء إنشاء المعاينة: {str(ex)}", COLORS['danger'])
-    
-    def preview_cart_status_report(self):
-        """معاينة تقرير حالة العربات"""
-        self.preview_table.columns = [
-            ft.DataColumn(ft.Text("الحالة", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("العدد", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("النسبة المئوية", size=14, weight=ft.FontWeight.BOLD)),
-        ]
-        self.preview_table.rows.clear()
-        
-        data = self.db.execute_query("""
-            SELECT 
-                status,
-                COUNT(*) as count,
-                ROUND(COUNT(*) * 100.0 / (SELECT COUNT(*) FROM carts), 2) as percentage
-            FROM carts
-            GROUP BY status
-            UNION
-            SELECT 'الإجمالي', COUNT(*), 100.0 FROM carts
-        """)
-        
-        for row in data:
-            status, count, percentage = row
-            status_text = CART_STATUS.get(status, status) if status != 'الإجمالي' else status
-            
-            self.preview_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(status_text, size=13)),
-                        ft.DataCell(ft.Text(str(count), size=13)),
-                        ft.DataCell(ft.Text(f"{percentage}%", size=13)),
-                    ]
-                )
-            )
-        
-        self.page.update()
-    
-    def preview_movement_report(self, period):
-        """معاينة تقرير حركة العربات"""
-        self.preview_table.columns = [
-            ft.DataColumn(ft.Text("التاريخ", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("عدد الحركات", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("عربات مختلفة", size=14, weight=ft.FontWeight.BOLD)),
-        ]
-        self.preview_table.rows.clear()
-        
-        limit = ""
-        if period == "اليوم":
-            limit = "AND DATE(timestamp) = DATE('now')"
-        elif period == "آخر 7 أيام":
-            limit = "AND DATE(timestamp) >= DATE('now', '-7 days')"
-        elif period == "آخر 30 يوم":
-            limit = "AND DATE(timestamp) >= DATE('now', '-30 days')"
-        elif period == "آخر سنة":
-            limit = "AND DATE(timestamp) >= DATE('now', '-1 year')"
-        
-        query = f"""
-            SELECT 
-                DATE(timestamp) as date,
-                COUNT(*) as movements,
-                COUNT(DISTINCT cart_id) as carts_moved
-            FROM movements
-            WHERE 1=1 {limit}
-            GROUP BY DATE(timestamp)
-            ORDER BY date DESC
-            LIMIT 10
-        """
-        
-        data = self.db.execute_query(query)
-        
-        for row in data:
-            self.preview_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(row[0] or "", size=13)),
-                        ft.DataCell(ft.Text(str(row[1]), size=13)),
-                        ft.DataCell(ft.Text(str(row[2]), size=13)),
-                    ]
-                )
-            )
+            return
         
-        self.page.update()
-    
-    def preview_maintenance_report(self, period):
-        """معاينة تقرير الصيانة"""
         self.preview_table.columns = [
-            ft.DataColumn(ft.Text("حالة الصيانة", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("العدد", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("التكلفة الإجمالية", size=14, weight=ft.FontWeight.BOLD)),
+            ft.DataColumn(ft.Text(column, size=14, weight=ft.FontWeight.BOLD)) for column in report.columns
         ]
-        self.preview_table.rows.clear()
-        
-        limit = ""
-        if period == "اليوم":
-            limit = "AND DATE(entry_date) = DATE('now')"
-        elif period == "آخر 7 أيام":
-            limit = "AND DATE(entry_date) >= DATE('now', '-7 days')"
-        elif period == "آخر 30 يوم":
-            limit = "AND DATE(entry_date) >= DATE('now', '-30 days')"
-        elif period == "آخر سنة":
-            limit = "AND DATE(entry_date) >= DATE('now', '-1 year')"
-        
-        query = f"""
-            SELECT 
-                status,
-                COUNT(*) as count,
-                SUM(cost) as total_cost
-            FROM maintenance_records
-            WHERE 1=1 {limit}
-            GROUP BY status
-        """
-        
-        data = self.db.execute_query(query)
-        
-        for row in data:
-            status, count, total_cost = row
-            status_text = MAINTENANCE_STATUS.get(status, status)
-            
-            self.preview_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(status_text, size=13)),
-                        ft.DataCell(ft.Text(str(count), size=13)),
-                        ft.DataCell(ft.Text(f"{total_cost or 0:.0f} ر.س", size=13)),
-                    ]
-                )
-            )
-        
-        self.page.update()
-    
-    def preview_warehouse_report(self):
-        """معاينة تقرير المستودعات"""
-        self.preview_table.columns = [
-            ft.DataColumn(ft.Text("المستودع", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("السعة", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("العدد الحالي", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("نسبة الإشغال", size=14, weight=ft.FontWeight.BOLD)),
+        self.preview_table.rows = [
+            ft.DataRow(cells=[ft.DataCell(ft.Text(value, size=13)) for value in row])
+            for row in report.rows
         ]
-        self.preview_table.rows.clear()
-        
-        data = self.db.execute_query("""
-            SELECT 
-                name,
-                capacity,
-                current_count,
-                ROUND(current_count * 100.0 / capacity, 2) as occupancy
-            FROM warehouses
-            WHERE is_active = 1
-            ORDER BY occupancy DESC
-        """)
-        
-        for row in data:
-            name, capacity, current, occupancy = row
-            
-            self.preview_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(name, size=13)),
-                        ft.DataCell(ft.Text(str(capacity), size=13)),
-                        ft.DataCell(ft.Text(str(current), size=13)),
-                        ft.DataCell(ft.Text(f"{occupancy}%", size=13)),
-                    ]
-                )
-            )
-        
         self.page.update()
     
-    def preview_summary_report(self):
-        """معاينة التقرير الشامل"""
-        self.preview_table.columns = [
-            ft.DataColumn(ft.Text("المؤشر", size=14, weight=ft.FontWeight.BOLD)),
-            ft.DataColumn(ft.Text("القيمة", size=14, weight=ft.FontWeight.BOLD)),
-        ]
-        self.preview_table.rows.clear()
-        
-        total_carts = self.db.execute_query("SELECT COUNT(*) FROM carts")[0][0] or 0
-        sound_carts = self.db.execute_query("SELECT COUNT(*) FROM carts WHERE status = 'sound'")[0][0] or 0
-        maintenance_carts = self.db.execute_query("SELECT COUNT(*) FROM carts WHERE status = 'needs_maintenance'")[0][0] or 0
-        damaged_carts = self.db.execute_query("SELECT COUNT(*) FROM carts WHERE status = 'damaged'")[0][0] or 0
-        total_warehouses = self.db.execute_query("SELECT COUNT(*) FROM warehouses WHERE is_active = 1")[0][0] or 0
-        total_movements = self.db.execute_query("SELECT COUNT(*) FROM movements")[0][0] or 0
-        total_maintenance = self.db.execute_query("SELECT COUNT(*) FROM maintenance_records")[0][0] or 0
-        total_cost = self.db.execute_query("SELECT SUM(cost) FROM maintenance_records WHERE status = 'completed'")[0][0] or 0
-        total_users = self.db.execute_query("SELECT COUNT(*) FROM users WHERE is_active = 1")[0][0] or 0
-        
-        summary_data = [
-            ("إجمالي العربات", f"{total_carts} عربة"),
-            ("عربات سليمة", f"{sound_carts} عربة ({sound_carts/total_carts*100:.1f}%)" if total_carts > 0 else "0"),
-            ("تحتاج صيانة", f"{maintenance_carts} عربة ({maintenance_carts/total_carts*100:.1f}%)" if total_carts > 0 else "0"),
-            ("عربات تالفة", f"{damaged_carts} عربة ({damaged_carts/total_carts*100:.1f}%)" if total_carts > 0 else "0"),
-            ("عدد المستودعات", f"{total_warehouses} مستودع"),
-            ("إجمالي الحركات", f"{total_movements} حركة"),
-            ("عمليات الصيانة", f"{total_maintenance} عملية"),
-            ("تكاليف الصيانة", f"{total_cost:.0f} ر.س"),
-            ("المستخدمين النشطين", f"{total_users} مستخدم"),
-            ("اسم المستخدم", self.current_user['username']),
-            ("الدور", "مدير" if self.current_user['role'] == 'admin' else "مشغل"),
-            ("تاريخ التقرير", datetime.now().strftime('%Y-%m-%d %H:%M'))
-        ]
-        
-        for indicator, value in summary_data:
-            self.preview_table.rows.append(
-                ft.DataRow(
-                    cells=[
-                        ft.DataCell(ft.Text(indicator, size=13)),
-                        ft.DataCell(ft.Text(value, size=13)),
-                    ]
-                )
-            )
-        
-        self.page.update()
+    def build_report(self, report_type, period, user=None):
+        """بيانات التقرير من المحرك المشترك مع إضافة بيانات الجلسة إلى التقرير الشامل"""
+        report = self.db.reports.get(report_type, period)
+        if report_type != "تقرير شامل":
+            return report
+        
+        user = user or self.current_user
+        session_rows = (
+            ("اسم المستخدم", user['username']),
+            ("الدور", "مدير" if user['role'] == 'admin' else "مشغل"),
+            ("تاريخ التقرير", datetime.now().strftime('%Y-%m-%d %H:%M')),
+        )
+        return ReportResult(report.columns, report.rows + session_rows)
     
     def export_to_excel(self, e):
-        """تصدير التقرير إلى Excel"""
+        """تصدير التقرير إلى Excel في الخلفية"""
         if not self.check_permission('can_export_reports'):
             self.show_snack_bar("غير مصرح لك بتصدير التقارير", COLORS['danger'])
             return
@@ -3303,57 +6104,10 @@ class CartsManagementApp:
             self.show_snack_bar("مكتبة openpyxl غير مثبتة", COLORS['danger'])
             return
         
-        try:
-            from tkinter import filedialog, Tk
-            
-            root = Tk()
-            root.withdraw()
-            
-            filename = filedialog.asksaveasfilename(
-                defaultextension=".xlsx",
-                filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")],
-                initialfile=f"تقرير_{self.report_type_dropdown.value}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
-            )
-            
-            root.destroy()
-            
-            if filename:
-                wb = Workbook()
-                ws = wb.active
-                ws.title = "تقرير"
-                
-                ws['A1'] = f"تقرير: {self.report_type_dropdown.value}"
-                ws['A2'] = f"تاريخ التقرير: {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-                ws['A3'] = f"المستخدم: {self.current_user['username']}"
-                
-                # إضافة الرؤوس
-                headers = [col.label.value for col in self.preview_table.columns]
-                for col_num, header in enumerate(headers, 1):
-                    ws.cell(row=5, column=col_num, value=header)
-                
-                # إضافة البيانات
-                row_num = 6
-                for row in self.preview_table.rows:
-                    for col_num, cell in enumerate(row.cells, 1):
-                        if isinstance(cell.content, ft.Text):
-                            ws.cell(row=row_num, column=col_num, value=cell.content.value)
-                        elif isinstance(cell.content, ft.Container):
-                            if isinstance(cell.content.content, ft.Text):
-                                ws.cell(row=row_num, column=col_num, value=cell.content.content.value)
-                    row_num += 1
-                
-                wb.save(filename)
-                
-                self.db.log_action(self.current_user['id'], 'export_excel',
-                                  f'تصدير تقرير {self.report_type_dropdown.value} إلى Excel')
-                
-                self.show_snack_bar(f"تم حفظ التقرير بنجاح", COLORS['success'])
-                
-        except Exception as ex:
-            self.show_snack_bar(f"حدث خطأ أثناء حفظ الملف: {str(ex)}", COLORS['danger'])
+        self.submit_export('xlsx', 'export_excel', "Excel", self.write_excel_report)
     
     def export_to_pdf(self, e):
-        """تصدير التقرير إلى PDF"""
+        """تصدير التقرير إلى PDF في الخلفية"""
         if not self.check_permission('can_export_reports'):
             self.show_snack_bar("غير مصرح لك بتصدير التقارير", COLORS['danger'])
             return
@@ -3362,86 +6116,138 @@ class CartsManagementApp:
             self.show_snack_bar("مكتبة fpdf غير مثبتة", COLORS['danger'])
             return
         
-        try:
-            from tkinter import filedialog, Tk
-            
-            root = Tk()
-            root.withdraw()
-            
-            filename = filedialog.asksaveasfilename(
-                defaultextension=".pdf",
-                filetypes=[("PDF files", "*.pdf"), ("All files", "*.*")],
-                initialfile=f"تقرير_{self.report_type_dropdown.value}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-            )
-            
-            root.destroy()
-            
-            if filename:
-                pdf = FPDF()
-                pdf.add_page()
-                
-                # محاولة استخدام خط عربي
-                try:
-                    font_path = self.find_arabic_font()
-                    if font_path:
-                        pdf.add_font("Arabic", "", font_path, uni=True)
-                        pdf.set_font("Arabic", "", 16)
-                    else:
-                        pdf.set_font("Arial", "", 16)
-                except:
-                    pdf.set_font("Arial", "", 16)
-                
-                # عنوان التقرير
-                pdf.cell(200, 10, txt=self.report_type_dropdown.value, ln=1, align='C')
-                
-                pdf.set_font_size(12)
-                pdf.cell(200, 10, txt=f"تاريخ التقرير: {datetime.now().strftime('%Y-%m-%d %H:%M')}", ln=1, align='C')
-                pdf.cell(200, 10, txt=f"المستخدم: {self.current_user['username']}", ln=1, align='C')
-                pdf.ln(10)
-                
-                # جدول البيانات
-                col_width = pdf.w / (len(self.preview_table.columns) + 1)
-                pdf.set_font_size(10)
-                
-                # رؤوس الأعمدة
-                for col in self.preview_table.columns:
-                    pdf.cell(col_width, 10, col.label.value, border=1, align='C')
-                pdf.ln()
-                
-                # بيانات الجدول
-                for row in self.preview_table.rows:
-                    for cell in row.cells:
-                        if isinstance(cell.content, ft.Text):
-                            pdf.cell(col_width, 10, cell.content.value, border=1, align='C')
-                        elif isinstance(cell.content, ft.Container):
-                            if isinstance(cell.content.content, ft.Text):
-                                pdf.cell(col_width, 10, cell.content.content.value, border=1, align='C')
-                    pdf.ln()
-                
-                pdf.output(filename)
-                
-                self.db.log_action(self.current_user['id'], 'export_pdf',
-                                  f'تصدير تقرير {self.report_type_dropdown.value} إلى PDF')
-                
-                self.show_snack_bar(f"تم حفظ التقرير بنجاح", COLORS['success'])
-                
-        except Exception as ex:
-            self.show_snack_bar(f"حدث خطأ أثناء إنشاء ملف PDF: {str(ex)}", COLORS['danger'])
-    
-    def find_arabic_font(self):
-        """البحث عن خط عربي في النظام"""
-        possible_paths = [
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), "DejaVuSans.ttf"),
-            "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
-            "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf",
-            "C:\\Windows\\Fonts\\arial.ttf",
-            "C:\\Windows\\Fonts\\tahoma.ttf",
-            "/System/Library/Fonts/Supplemental/Arial.ttf",
-        ]
-        for path in possible_paths:
-            if os.path.exists(path):
-                return path
-        return None
+        self.submit_export('pdf', 'export_pdf', "PDF", self.write_pdf_report)
+    
+    def submit_export(self, extension, action, format_name, writer):
+        """إرسال التقرير المختار حالياً إلى مجمع التصدير"""
+        # قراءة الخيارات الآن حتى لا يتأثر التصدير بتغييرها أثناء التشغيل
+        report_type = self.report_type_dropdown.value if self.report_type_dropdown else "تقرير حالة العربات"
+        period = self.period_dropdown.value if self.period_dropdown else "كل الفترات"
+        user = dict(self.current_user)
+        filename = f"تقرير_{report_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+        
+        def write(job, path):
+            writer(path, report_type, period, user, job)
+            self.db.log_action(user['id'], action, f'تصدير تقرير {report_type} إلى {format_name}')
+        
+        self.exports.submit(f"{report_type} ({format_name})", filename, write)
+        self.show_snack_bar("بدأ التصدير، تابع التقدم في قائمة التنزيلات", COLORS['info'])
+    
+    def on_export_changed(self, job):
+        """تحديث منطقة التنزيلات عند تغير حالة أي مهمة (من خيط التصدير)"""
+        self.render_exports()
+        if job.status == 'done':
+            self.show_snack_bar(f"اكتمل تصدير {job.title}", COLORS['success'])
+        elif job.status == 'failed':
+            self.show_snack_bar(f"فشل تصدير {job.title}: {job.error}", COLORS['danger'])
+        else:
+            self.page.update()
+    
+    def render_exports(self):
+        """إعادة بناء قائمة مهام التصدير"""
+        if self.export_list is None:
+            return
+        
+        controls = [self.build_export_row(job) for job in list(self.exports.jobs)]
+        if not controls:
+            controls = [ft.Text("لا توجد تصديرات بعد", size=13, color=COLORS['gray'])]
+        self.export_list.controls = controls
+    
+    def build_export_row(self, job):
+        """صف مهمة تصدير: العنوان والتقدم وأزرار الإلغاء أو التنزيل"""
+        status_texts = {
+            'pending': "في الانتظار",
+            'running': f"جاري الكتابة ({job.rows_written} صف)",
+            'done': "جاهز للتنزيل",
+            'failed': f"فشل: {job.error}",
+            'cancelled': "أُلغي",
+            'expired': "انتهت مهلة التنزيل وحُذف الملف",
+        }
+        
+        actions = []
+        if job.is_active:
+            actions.append(ft.IconButton(
+                icon=ft.icons.CANCEL,
+                icon_color=COLORS['danger'],
+                tooltip="إلغاء",
+                on_click=lambda e, j=job: self.exports.cancel(j)
+            ))
+        else:
+            if job.status == 'done':
+                actions.append(ft.IconButton(
+                    icon=ft.icons.DOWNLOAD,
+                    icon_color=COLORS['success'],
+                    tooltip="تنزيل",
+                    on_click=lambda e, j=job: self.download_export(j)
+                ))
+            actions.append(ft.IconButton(
+                icon=ft.icons.DELETE,
+                icon_color=COLORS['gray'],
+                tooltip="إزالة",
+                on_click=lambda e, j=job: self.remove_export(j)
+            ))
+        
+        return ft.Row([
+            ft.Column([
+                ft.Text(job.title, size=14, weight=ft.FontWeight.BOLD),
+                ft.Text(status_texts.get(job.status, job.status), size=12, color=COLORS['gray']),
+                ft.ProgressBar(value=job.progress, width=300, visible=job.is_active),
+            ], spacing=3, expand=True),
+            ft.Row(actions, spacing=0),
+        ])
+    
+    def download_export(self, job):
+        """فتح الملف المصدر؛ في نسخة الويب يُقدَّم من مجلد المهمة العشوائي حتى تنتهي مهلته"""
+        if job.status != 'done':
+            return
+        if self.page.web:
+            self.page.launch_url(job.url)
+        else:
+            self.page.launch_url(Path(job.path).as_uri())
+    
+    def remove_export(self, job):
+        self.exports.remove(job)
+        self.render_exports()
+        self.page.update()
+    
+    @contextmanager
+    def export_rows(self, report_type, period, user, job):
+        """صفوف التقرير للتصدير: تفاصيل كاملة تدفقية لتقارير الفترات، والنتيجة المشتركة لغيرها"""
+        if report_type in ReportEngine.PERIOD_REPORTS:
+            with self.db.reports.detail_rows(report_type, period) as report:
+                yield report
+        else:
+            report = self.build_report(report_type, period, user)
+            job.total_rows = len(report.rows)
+            yield report
+    
+    def write_excel_report(self, filename, report_type, period, user, job):
+        """كتابة التقرير إلى ملف Excel صفاً صفاً في وضع الكتابة فقط"""
+        # وضع الكتابة فقط لا يحتفظ بالخلايا في الذاكرة، فيبقى الاستهلاك ثابتاً مهما كبر التقرير
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("تقرير")
+        
+        ws.append([f"تقرير: {report_type}"])
+        ws.append([f"تاريخ التقرير: {datetime.now().strftime('%Y-%m-%d %H:%M')}"])
+        ws.append([f"المستخدم: {user['username']}"])
+        ws.append([])
+        
+        with self.export_rows(report_type, period, user, job) as report:
+            ws.append(list(report.columns))
+            for row in report.rows:
+                ws.append(row)
+                job.advance()
+        
+        wb.save(filename)
+    
+    def write_pdf_report(self, filename, report_type, period, user, job):
+        """كتابة التقرير إلى ملف PDF"""
+        renderer = PdfReportRenderer(report_type, [
+            f"تاريخ التقرير: {datetime.now().strftime('%Y-%m-%d %H:%M')}",
+            f"المستخدم: {user['username']}",
+        ], on_error=self.db.log_error)
+        with self.export_rows(report_type, period, user, job) as report:
+            renderer.render(filename, report.columns, report.rows, job)
     
     # ================================ إدارة المستخدمين ================================
     def show_user_management(self):
@@ -3531,18 +6337,25 @@ class CartsManagementApp:
         self.load_users()
         self.page.update()
     
-    def load_users(self):
+    def fetch_users(self, search_text=""):
+        """جلب المستخدمين المطابقين لنص البحث في الاسم أو اسم المستخدم"""
+        pattern = like_contains(search_text)
+        return self.db.execute_query("""
+            SELECT id, username, full_name, role, is_active, last_login 
+            FROM users 
+            WHERE username LIKE ? ESCAPE '\\' OR full_name LIKE ? ESCAPE '\\'
+            ORDER BY id
+        """, (pattern, pattern))
+    
+    def load_users(self, users=None):
         """تحميل قائمة المستخدمين"""
         if not self.user_table:
             return
         
-        self.user_table.rows.clear()
+        if users is None:
+            users = self.fetch_users(self.field_text(self.user_search_field))
         
-        users = self.db.execute_query("""
-            SELECT id, username, full_name, role, is_active, last_login 
-            FROM users 
-            ORDER BY id
-        """)
+        self.user_table.rows.clear()
         
         for user in users:
             uid, username, full_name, role, is_active, last_login = user
@@ -3631,24 +6444,8 @@ class CartsManagementApp:
         if not self.user_table:
             return
         
-        search_text = e.control.value.strip().lower() if e.control.value else ""
-        
-        for row in self.user_table.rows[:]:
-            username_cell = row.cells[1].content
-            fullname_cell = row.cells[2].content
-            
-            match = False
-            if isinstance(username_cell, ft.Text):
-                if search_text in username_cell.value.lower():
-                    match = True
-            if isinstance(fullname_cell, ft.Text):
-                if search_text in fullname_cell.value.lower():
-                    match = True
-            
-            if search_text and not match:
-                self.user_table.rows.remove(row)
-        
-        self.page.update()
+        search_text = self.field_text(e.control)
+        self.search.submit('users', lambda: self.fetch_users(search_text), self.load_users)
     
     def show_add_user_dialog(self, e):
         """عرض نافذة إضافة مستخدم جديد"""
@@ -4257,6 +7054,66 @@ class CartsManagementApp:
                         ),
                     ]),
                     padding=10
+                ),
+                
+                ft.Divider(height=1, color=COLORS['light']),
+                
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text("مدة الاحتفاظ بسجل النظام (بالأيام، 0 لعدم الأرشفة):", size=14, weight=ft.FontWeight.BOLD),
+                        ft.TextField(
+                            value=self.db.get_app_setting('log_retention_days', str(LOG_RETENTION_DAYS)),
+                            width=400,
+                            border_radius=8,
+                            text_align=ft.TextAlign.RIGHT,
+                            keyboard_type=ft.KeyboardType.NUMBER,
+                            ref=ft.Ref[ft.TextField]()
+                        ),
+                        ft.ElevatedButton(
+                            text="حفظ مدة الاحتفاظ",
+                            icon=ft.icons.SAVE,
+                            bgcolor=COLORS['primary'],
+                            color=COLORS['white'],
+                            style=ft.ButtonStyle(
+                                shape=ft.RoundedRectangleBorder(radius=8),
+                            ),
+                            on_click=lambda e: self.save_log_retention(e, log_retention_field)
+                        ),
+                        ft.Text(
+                            f"⚠️ آخر خطأ في كتابة سجل النظام: {self.db.log_writer.last_error}",
+                            size=12,
+                            color=COLORS['danger'],
+                            visible=self.db.log_writer.last_error is not None
+                        ),
+                    ]),
+                    padding=10
+                ),
+                
+                ft.Divider(height=1, color=COLORS['light']),
+                
+                ft.Container(
+                    content=ft.Column([
+                        ft.Text("أرشفة الحركات الأقدم من (بالأشهر، 0 لعدم الأرشفة):", size=14, weight=ft.FontWeight.BOLD),
+                        ft.TextField(
+                            value=self.db.get_app_setting('movement_archive_months', str(MOVEMENT_ARCHIVE_MONTHS)),
+                            width=400,
+                            border_radius=8,
+                            text_align=ft.TextAlign.RIGHT,
+                            keyboard_type=ft.KeyboardType.NUMBER,
+                            ref=ft.Ref[ft.TextField]()
+                        ),
+                        ft.ElevatedButton(
+                            text="حفظ مدة أرشفة الحركات",
+                            icon=ft.icons.SAVE,
+                            bgcolor=COLORS['primary'],
+                            color=COLORS['white'],
+                            style=ft.ButtonStyle(
+                                shape=ft.RoundedRectangleBorder(radius=8),
+                            ),
+                            on_click=lambda e: self.save_movement_archive_months(e, movement_archive_field)
+                        ),
+                    ]),
+                    padding=10
                 )
             ])
         )
@@ -4264,6 +7121,8 @@ class CartsManagementApp:
         # تخزين المراجع
         app_name_field = app_settings_card.content.controls[2].content.controls[1]
         company_name_field = app_settings_card.content.controls[4].content.controls[1]
+        log_retention_field = app_settings_card.content.controls[6].content.controls[1]
+        movement_archive_field = app_settings_card.content.controls[8].content.controls[1]
         
         self.content_column.controls.append(app_settings_card)
         self.content_column.controls.append(ft.Container(height=20))
@@ -4387,6 +7246,30 @@ class CartsManagementApp:
                               f'تحديث اسم الجهة إلى: {new_name}')
             self.show_snack_bar("تم تحديث اسم الجهة بنجاح", COLORS['success'])
     
+    def save_log_retention(self, e, field):
+        """حفظ مدة الاحتفاظ بسجل النظام"""
+        value = field.value.strip() if field.value else ""
+        if not value.isdigit():
+            self.show_snack_bar("الرجاء إدخال عدد أيام صحيح", COLORS['danger'])
+            return
+        
+        self.db.update_app_setting('log_retention_days', value, self.current_user['id'])
+        self.db.log_action(self.current_user['id'], 'update_settings',
+                          f'تحديث مدة الاحتفاظ بسجل النظام إلى {value} يوم')
+        self.show_snack_bar("تم تحديث مدة الاحتفاظ بنجاح", COLORS['success'])
+    
+    def save_movement_archive_months(self, e, field):
+        """حفظ عمر الحركات المنقولة للأرشيف"""
+        value = field.value.strip() if field.value else ""
+        if not value.isdigit():
+            self.show_snack_bar("الرجاء إدخال عدد أشهر صحيح", COLORS['danger'])
+            return
+        
+        self.db.update_app_setting('movement_archive_months', value, self.current_user['id'])
+        self.db.log_action(self.current_user['id'], 'update_settings',
+                          f'تحديث مدة أرشفة الحركات إلى {value} شهر')
+        self.show_snack_bar("تم تحديث مدة أرشفة الحركات بنجاح", COLORS['success'])
+    
     def save_mega_settings(self, e, email_field, pass_field):
         """حفظ إعدادات MEGA"""
         new_email = email_field.value.strip()
@@ -4539,9 +7422,9 @@ class CartsManagementApp:
             return False, "❌ بيانات MEGA غير مكتملة. أضفها في ملف .env أو إعدادات النظام"
         
         try:
-            mega = Mega()
-            m = mega.login(mega_email, mega_password)
-            account = m.get_user()
+            # العميل الذي فشل يُسقط من المجمع تلقائياً
+            with self.mega_session.using(mega_email, mega_password) as m:
+                account = m.get_user()
             email = account.get('email', mega_email)
             return True, f"✅ متصل بحساب: {email}"
         except Exception as e:
@@ -4553,6 +7436,15 @@ class CartsManagementApp:
             else:
                 return False, f"❌ خطأ: {error_msg[:50]}..."
     
+    def probe_mega_status(self, label):
+        """تحديث حالة MEGA بعد انتهاء الفحص إن كانت الصفحة لا تزال معروضة"""
+        connected, message = self.test_mega_connection()
+        if label is not self.mega_status_label:
+            return
+        label.value = message
+        label.color = COLORS['success'] if connected else COLORS['danger']
+        self.page.update()
+    
     def show_backup(self):
         """عرض صفحة النسخ الاحتياطي"""
         if self.current_user['role'] != 'admin' or not self.check_permission('can_manage_backup'):
@@ -4568,6 +7460,8 @@ class CartsManagementApp:
         self.content_column.controls.append(ft.Container(height=20))
         
         # ===== إنشاء نسخة احتياطية =====
+        local_storage = self.db.get_app_setting('backup_storage', 'mega') == 'local'
+        cloud_available = MEGA_AVAILABLE or local_storage
         backup_card = ft.Container(
             bgcolor=COLORS['white'],
             border_radius=10,
@@ -4591,16 +7485,47 @@ class CartsManagementApp:
                     ),
                     
                     ft.ElevatedButton(
-                        text="☁️ نسخ احتياطي سحابي (MEGA)",
+                        text="🧩 نسخ احتياطي تزايدي",
+                        icon=ft.icons.DIFFERENCE,
+                        bgcolor=COLORS['teal'],
+                        color=COLORS['white'],
+                        style=ft.ButtonStyle(
+                            shape=ft.RoundedRectangleBorder(radius=8),
+                            padding=ft.padding.symmetric(horizontal=25, vertical=15)
+                        ),
+                        on_click=self.create_incremental_backup
+                    ),
+                    
+                    ft.ElevatedButton(
+                        text="☁️ نسخ احتياطي سحابي (MEGA)" if not local_storage else "☁️ نسخ احتياطي إلى المخزن المحلي",
                         icon=ft.icons.CLOUD_UPLOAD,
-                        bgcolor=COLORS['purple'] if MEGA_AVAILABLE else COLORS['gray'],
+                        bgcolor=COLORS['purple'] if cloud_available else COLORS['gray'],
                         color=COLORS['white'],
                         style=ft.ButtonStyle(
                             shape=ft.RoundedRectangleBorder(radius=8),
                             padding=ft.padding.symmetric(horizontal=25, vertical=15)
                         ),
-                        on_click=self.create_cloud_backup if MEGA_AVAILABLE else None,
-                        disabled=not MEGA_AVAILABLE
+                        on_click=self.create_cloud_backup if cloud_available else None,
+                        disabled=not cloud_available
+                    ),
+                    
+                    ft.Checkbox(
+                        label="نسخة مضغوطة (VACUUM INTO)",
+                        value=False,
+                        ref=ft.Ref[ft.Checkbox]()
+                    ),
+                    
+                    ft.Dropdown(
+                        label="ضغط الملف",
+                        options=[
+                            ft.dropdown.Option(key="none", text="بدون"),
+                            ft.dropdown.Option(key="gzip", text="gzip (سريع)"),
+                            ft.dropdown.Option(key="lzma", text="lzma (أصغر حجماً)"),
+                            ft.dropdown.Option(key="bz2", text="bz2"),
+                        ],
+                        value="gzip",
+                        width=180,
+                        ref=ft.Ref[ft.Dropdown]()
                     ),
                 ]),
                 
@@ -4623,15 +7548,16 @@ class CartsManagementApp:
         )
         
         # تخزين المراجع
-        self.backup_progress = backup_card.content.controls[3].controls[2]
-        self.backup_status = backup_card.content.controls[3].controls[4]
+        self.backup_compact = backup_card.content.controls[2].controls[3]
+        self.backup_compression = backup_card.content.controls[2].controls[4]
+        self.backup_progress = backup_card.content.controls[4]
+        self.backup_status = backup_card.content.controls[6]
         
         self.content_column.controls.append(backup_card)
         self.content_column.controls.append(ft.Container(height=20))
         
         # ===== حالة MEGA =====
         if MEGA_AVAILABLE:
-            mega_status = self.test_mega_connection()
             mega_status_card = ft.Container(
                 bgcolor=COLORS['white'],
                 border_radius=10,
@@ -4639,11 +7565,90 @@ class CartsManagementApp:
                 padding=20,
                 content=ft.Row([
                     ft.Text("حالة MEGA:", size=14, weight=ft.FontWeight.BOLD, color=COLORS['dark']),
-                    ft.Text(mega_status[1], size=14, color=COLORS['success'] if mega_status[0] else COLORS['danger']),
+                    ft.Text("⏳ جاري التحقق من الاتصال...", size=14, color=COLORS['gray']),
                 ])
             )
+            self.mega_status_label = mega_status_card.content.controls[1]
             self.content_column.controls.append(mega_status_card)
             self.content_column.controls.append(ft.Container(height=20))
+            
+            # الفحص يحتاج اتصالاً بالشبكة فيتم في الخلفية حتى تظهر الصفحة فوراً
+            threading.Thread(target=self.probe_mega_status, args=(self.mega_status_label,), daemon=True).start()
+        
+        # ===== النسخ التلقائي =====
+        next_run = self.db.backup_scheduler.next_run
+        schedule_card = ft.Container(
+            bgcolor=COLORS['white'],
+            border_radius=10,
+            border=ft.border.all(1, COLORS['gray']),
+            padding=20,
+            content=ft.Column([
+                ft.Text("النسخ الاحتياطي التلقائي", size=18, weight=ft.FontWeight.BOLD, color=COLORS['dark']),
+                ft.Divider(height=1, color=COLORS['light']),
+                
+                ft.ResponsiveRow([
+                    ft.Container(
+                        col={"sm": 12, "md": 4, "lg": 2},
+                        content=ft.Switch(
+                            label="تفعيل",
+                            value=self.db.get_app_setting('backup_schedule_enabled', '1') == '1'
+                        )
+                    ),
+                    ft.Container(
+                        col={"sm": 12, "md": 8, "lg": 4},
+                        content=ft.TextField(
+                            label="الجدول (cron)",
+                            value=self.db.get_app_setting('backup_schedule', BACKUP_SCHEDULE),
+                            hint_text="الدقيقة الساعة اليوم الشهر يوم-الأسبوع",
+                            border_radius=8
+                        )
+                    ),
+                    ft.Container(
+                        col={"sm": 4, "md": 4, "lg": 2},
+                        content=ft.TextField(
+                            label="ساعية",
+                            value=self.db.get_app_setting('backup_keep_hourly', str(BACKUP_KEEP_HOURLY)),
+                            keyboard_type=ft.KeyboardType.NUMBER,
+                            border_radius=8
+                        )
+                    ),
+                    ft.Container(
+                        col={"sm": 4, "md": 4, "lg": 2},
+                        content=ft.TextField(
+                            label="يومية",
+                            value=self.db.get_app_setting('backup_keep_daily', str(BACKUP_KEEP_DAILY)),
+                            keyboard_type=ft.KeyboardType.NUMBER,
+                            border_radius=8
+                        )
+                    ),
+                    ft.Container(
+                        col={"sm": 4, "md": 4, "lg": 2},
+                        content=ft.TextField(
+                            label="أسبوعية",
+                            value=self.db.get_app_setting('backup_keep_weekly', str(BACKUP_KEEP_WEEKLY)),
+                            keyboard_type=ft.KeyboardType.NUMBER,
+                            border_radius=8
+                        )
+                    ),
+                ]),
+                
+                ft.Row([
+                    ft.Text(
+                        f"النسخة القادمة: {next_run.strftime('%Y-%m-%d %H:%M')}" if next_run else "النسخ التلقائي متوقف",
+                        size=13, color=COLORS['gray']
+                    ),
+                    ft.ElevatedButton(
+                        text="حفظ",
+                        icon=ft.icons.SAVE,
+                        bgcolor=COLORS['primary'],
+                        color=COLORS['white'],
+                        on_click=lambda e: self.save_backup_schedule(e, schedule_card)
+                    ),
+                ], alignment=ft.MainAxisAlignment.SPACE_BETWEEN),
+            ])
+        )
+        self.content_column.controls.append(schedule_card)
+        self.content_column.controls.append(ft.Container(height=20))
         
         # ===== سجل النسخ الاحتياطي =====
         history_card = ft.Container(
@@ -4665,6 +7670,7 @@ class CartsManagementApp:
                         ft.DataColumn(ft.Text("رابط MEGA", size=13, weight=ft.FontWeight.BOLD)),
                         ft.DataColumn(ft.Text("الحالة", size=13, weight=ft.FontWeight.BOLD)),
                         ft.DataColumn(ft.Text("المستخدم", size=13, weight=ft.FontWeight.BOLD)),
+                        ft.DataColumn(ft.Text("الإجراءات", size=13, weight=ft.FontWeight.BOLD)),
                     ],
                     rows=[],
                     horizontal_margin=10,
@@ -4686,91 +7692,175 @@ class CartsManagementApp:
     
     def create_local_backup(self, e):
         """إنشاء نسخة احتياطية محلية"""
-        try:
-            self.backup_progress.value = 0
-            self.backup_status.value = "جاري إنشاء النسخة الاحتياطية..."
-            self.backup_status.color = COLORS['primary']
-            self.page.update()
-            
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_filename = f"backup_{timestamp}.db"
-            backup_path = os.path.join(self.backup_dir, backup_filename)
-            
-            self.update_progress(30, "جاري نسخ الملف...")
-            shutil.copy2(DB_NAME, backup_path)
-            
-            file_size = os.path.getsize(backup_path)
-            
-            self.update_progress(70, "جاري حفظ المعلومات...")
-            
-            self.db.execute_insert(
-                """INSERT INTO backups 
-                   (file_name, backup_type, user_id, file_size, file_path, status) 
-                   VALUES (?, 'local', ?, ?, ?, 'completed')""",
-                (backup_filename, self.current_user['id'], file_size, backup_path)
-            )
-            
-            self.update_progress(100, "✅ تم إنشاء النسخة الاحتياطية بنجاح", COLORS['success'])
-            
-            self.db.log_action(self.current_user['id'], 'backup_local',
-                              f'إنشاء نسخة احتياطية محلية {backup_filename}')
-            
-            self.show_snack_bar("تم إنشاء النسخة الاحتياطية المحلية بنجاح", COLORS['success'])
-            self.load_backups()
-            
-            time.sleep(3)
-            self.hide_progress()
-            
-        except Exception as ex:
-            self.update_progress(0, f"❌ فشل: {str(ex)}", COLORS['danger'])
-            self.show_snack_bar(f"فشل إنشاء النسخة الاحتياطية: {str(ex)}", COLORS['danger'])
+        self.backup_progress.value = 0
+        self.backup_status.value = "جاري إنشاء النسخة الاحتياطية..."
+        self.backup_status.color = COLORS['primary']
+        self.page.update()
+        
+        # النسخ في خيط منفصل حتى لا تتوقف الواجهة أثناء نسخ قاعدة كبيرة
+        def backup_thread():
+            try:
+                result = self.write_backup_file("backup", 0, 90)
+                
+                self.update_progress(95, "جاري حفظ المعلومات...")
+                self.record_backup(result, 'local')
+                
+                self.update_progress(100, "✅ تم إنشاء النسخة الاحتياطية بنجاح", COLORS['success'])
+                
+                self.db.log_action(self.current_user['id'], 'backup_local',
+                                  f'إنشاء نسخة احتياطية محلية {os.path.basename(result.path)}')
+                
+                self.show_snack_bar("تم إنشاء النسخة الاحتياطية المحلية بنجاح", COLORS['success'])
+                self.load_backups()
+                
+                time.sleep(3)
+                self.hide_progress()
+                
+            except Exception as ex:
+                self.update_progress(0, f"❌ فشل: {str(ex)}", COLORS['danger'])
+                self.show_snack_bar(f"فشل إنشاء النسخة الاحتياطية: {str(ex)}", COLORS['danger'])
+        
+        threading.Thread(target=backup_thread, daemon=True).start()
     
-    def create_cloud_backup(self, e):
-        """إنشاء نسخة احتياطية سحابية"""
-        if not MEGA_AVAILABLE:
-            self.show_snack_bar("مكتبة MEGA غير مثبتة", COLORS['danger'])
-            return
+    def create_incremental_backup(self, e):
+        """إنشاء نسخة تزايدية لا تخزن إلا القطع المتغيرة منذ النسخ السابقة"""
+        self.backup_progress.value = 0
+        self.backup_status.value = "جاري إنشاء النسخة التزايدية..."
+        self.backup_status.color = COLORS['primary']
+        self.page.update()
+        
+        def backup_thread():
+            try:
+                backup_name = f"backup_incremental_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+                
+                def on_progress(fraction):
+                    self.update_progress(fraction * 90, f"جاري النسخ التزايدي... {fraction * 100:.0f}%")
+                
+                manifest_path, db_size, new_bytes = self.db.backup_engine.incremental_backup(
+                    self.backup_dir, backup_name, on_progress
+                )
+                
+                self.update_progress(95, "جاري حفظ المعلومات...")
+                
+                # الحجم المسجل هو ما أضافته هذه النسخة فعلاً إلى المخزن
+                self.db.execute_insert(
+                    """INSERT INTO backups 
+                       (file_name, backup_type, user_id, file_size, file_path, manifest_path, status) 
+                       VALUES (?, 'incremental', ?, ?, ?, ?, 'completed')""",
+                    (backup_name, self.current_user['id'], new_bytes, manifest_path, manifest_path)
+                )
+                
+                self.update_progress(100, f"✅ تم إنشاء النسخة التزايدية ({new_bytes // 1024} KB جديدة من {db_size // 1024} KB)",
+                                     COLORS['success'])
+                
+                self.db.log_action(self.current_user['id'], 'backup_incremental',
+                                  f'إنشاء نسخة احتياطية تزايدية {backup_name}')
+                
+                self.load_backups()
+                
+                time.sleep(3)
+                self.hide_progress()
+                
+            except Exception as ex:
+                self.update_progress(0, f"❌ فشل: {str(ex)}", COLORS['danger'])
+                self.show_snack_bar(f"فشل إنشاء النسخة التزايدية: {str(ex)}", COLORS['danger'])
+        
+        threading.Thread(target=backup_thread, daemon=True).start()
+    
+    def write_backup_file(self, prefix, start, end):
+        """إنشاء ملف النسخة في مجلد النسخ مع ربط التقدم الفعلي بالمدى [start، end] من الشريط"""
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        backup_path = os.path.join(self.backup_dir, f"{prefix}_{timestamp}.db")
+        compact = bool(self.backup_compact and self.backup_compact.value)
+        compression = self.backup_compression.value if self.backup_compression else None
+        if compression not in BACKUP_COMPRESSORS:
+            compression = None
+        
+        def on_progress(fraction):
+            if fraction is None:
+                self.update_progress(None, "جاري ضغط النسخة...")
+            else:
+                self.update_progress(start + (end - start) * fraction, f"جاري نسخ قاعدة البيانات... {fraction * 100:.0f}%")
         
+        return self.db.backup_engine.backup_file(backup_path, on_progress, compact=compact, compression=compression)
+    
+    def record_backup(self, result, backup_type, mega_link=None):
+        """تسجيل النسخة في جدول backups مع الحجم الأصلي ونسبة الضغط والبصمة"""
+        ratio = result.file_size / result.original_size if result.original_size else None
+        self.db.execute_insert(
+            """INSERT INTO backups 
+               (file_name, backup_type, user_id, file_size, file_path, mega_link, status,
+                original_size, compression, compression_ratio, sha256) 
+               VALUES (?, ?, ?, ?, ?, ?, 'completed', ?, ?, ?, ?)""",
+            (os.path.basename(result.path), backup_type, self.current_user['id'], result.file_size,
+             result.path, mega_link, result.original_size, result.compression, ratio, result.sha256)
+        )
+    
+    def backup_storage(self):
+        """مخزن النسخ السحابية حسب الإعدادات: MEGA أو مجلد محلي بديل"""
+        if self.db.get_app_setting('backup_storage', 'mega') == 'local':
+            return LocalDirectoryStorage(self.db.get_app_setting('backup_storage_dir', BACKUP_STORAGE_DIR))
+        
+        if not MEGA_AVAILABLE:
+            raise RuntimeError("مكتبة MEGA غير مثبتة")
         mega_email = self.db.get_app_setting('mega_email', MEGA_EMAIL)
         mega_password = self.db.get_app_setting('mega_password', MEGA_PASSWORD)
-        
         if not mega_email or not mega_password:
-            self.show_snack_bar("بيانات MEGA غير موجودة. أضفها في ملف .env", COLORS['danger'])
+            raise RuntimeError("بيانات MEGA غير موجودة. أضفها في ملف .env")
+        return MegaStorage(self.mega_session, mega_email, mega_password)
+    
+    def create_cloud_backup(self, e):
+        """إنشاء نسخة احتياطية سحابية"""
+        try:
+            storage = self.backup_storage()
+        except RuntimeError as ex:
+            self.show_snack_bar(str(ex), COLORS['danger'])
             return
         
         # إظهار شريط التقدم
         self.backup_progress.value = 0
-        self.backup_status.value = "جاري الاتصال بـ MEGA..."
+        self.backup_status.value = "جاري الاتصال بالمخزن السحابي..."
         self.backup_status.color = COLORS['primary']
         self.page.update()
         
+        def show_retry(message):
+            self.backup_status.value = message
+            self.backup_status.color = COLORS['warning']
+            self.page.update()
+        
         # تنفيذ في thread منفصل
         def backup_thread():
             try:
-                mega = Mega()
-                m = mega.login(mega_email, mega_password)
-                self.update_progress(20, "جاري إنشاء النسخة المحلية...")
+                uploader = ChunkedUploader(storage, on_retry=show_retry)
                 
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                backup_filename = f"backup_cloud_{timestamp}.db"
-                backup_path = os.path.join(self.backup_dir, backup_filename)
+                # إكمال أي رفع سابق انقطع قبل بدء نسخة جديدة
+                for state_path in uploader.pending(self.backup_dir):
+                    try:
+                        meta, link = uploader.resume(
+                            state_path, lambda fraction: self.update_progress(fraction * 20, "جاري استئناف رفع سابق...")
+                        )
+                    except (ValueError, FileNotFoundError) as ex:
+                        self.db.log_action(self.current_user['id'], 'backup_error',
+                                          f'تعذر استئناف الرفع {os.path.basename(state_path)}: {ex}')
+                        continue
+                    self.record_backup(BackupResult(**meta), 'cloud', link)
                 
-                shutil.copy2(DB_NAME, backup_path)
-                file_size = os.path.getsize(backup_path)
-                self.update_progress(50, "جاري الرفع إلى MEGA...")
+                self.update_progress(20, "جاري إنشاء النسخة المحلية...")
                 
-                file = m.upload(backup_path)
-                link = m.get_upload_link(file)
-                self.update_progress(80, "جاري حفظ المعلومات...")
+                result = self.write_backup_file("backup_cloud", 20, 50)
+                backup_filename = os.path.basename(result.path)
+                self.update_progress(50, "جاري الرفع...")
                 
-                self.db.execute_insert(
-                    """INSERT INTO backups 
-                       (file_name, backup_type, user_id, file_size, file_path, mega_link, status) 
-                       VALUES (?, 'cloud', ?, ?, ?, ?, 'completed')""",
-                    (backup_filename, self.current_user['id'], file_size, backup_path, link)
+                link = uploader.upload(
+                    result.path, os.path.splitext(backup_filename)[0],
+                    lambda fraction: self.update_progress(50 + fraction * 30, f"جاري الرفع... {fraction * 100:.0f}%"),
+                    meta=result._asdict()
                 )
+                self.update_progress(80, "جاري حفظ المعلومات...")
+                
+                self.record_backup(result, 'cloud', link)
                 
-                self.update_progress(100, "✅ تم الرفع إلى MEGA بنجاح", COLORS['success'])
+                self.update_progress(100, "✅ تم الرفع بنجاح", COLORS['success'])
                 
                 self.db.log_action(self.current_user['id'], 'backup_cloud',
                                   f'إنشاء نسخة احتياطية سحابية {backup_filename}')
@@ -4791,7 +7881,7 @@ class CartsManagementApp:
                 if "Invalid email or password" in error_message:
                     msg = "❌ فشل تسجيل الدخول: البريد أو كلمة المرور غير صحيحين"
                 elif "timeout" in error_message.lower():
-                    msg = "❌ فشل الاتصال: تحقق من اتصالك بالإنترنت"
+                    msg = "❌ فشل الاتصال: تحقق من اتصالك بالإنترنت، وسيُستأنف الرفع في المرة القادمة"
                 elif "disk quota" in error_message.lower():
                     msg = "❌ مساحة التخزين السحابية غير كافية"
                 else:
@@ -4809,9 +7899,39 @@ class CartsManagementApp:
         
         threading.Thread(target=backup_thread, daemon=True).start()
     
+    def save_backup_schedule(self, e, schedule_card):
+        """حفظ إعدادات النسخ التلقائي وإبلاغ المجدول بها"""
+        fields = [container.content for container in schedule_card.content.controls[2].controls]
+        enabled, schedule_field, hourly, daily, weekly = fields
+        
+        expression = schedule_field.value.strip() if schedule_field.value else ""
+        try:
+            CronSchedule(expression)
+        except ValueError as ex:
+            self.show_snack_bar(f"جدول غير صالح: {ex}", COLORS['danger'])
+            return
+        
+        counts = [field.value.strip() if field.value else "" for field in (hourly, daily, weekly)]
+        if not all(count.isdigit() for count in counts):
+            self.show_snack_bar("الرجاء إدخال أعداد صحيحة لسياسة الاحتفاظ", COLORS['danger'])
+            return
+        if not any(int(count) > 0 for count in counts):
+            self.show_snack_bar("يجب الاحتفاظ بنسخة واحدة على الأقل في أحد المستويات", COLORS['danger'])
+            return
+        
+        user_id = self.current_user['id']
+        self.db.update_app_setting('backup_schedule_enabled', '1' if enabled.value else '0', user_id)
+        self.db.update_app_setting('backup_schedule', expression, user_id)
+        for key, count in zip(('backup_keep_hourly', 'backup_keep_daily', 'backup_keep_weekly'), counts):
+            self.db.update_app_setting(key, count, user_id)
+        self.db.backup_scheduler.reload()
+        
+        self.db.log_action(user_id, 'update_settings', f'تحديث جدول النسخ التلقائي إلى {expression}')
+        self.show_snack_bar("تم حفظ إعدادات النسخ التلقائي", COLORS['success'])
+    
     def update_progress(self, value, status_text, color=COLORS['primary']):
-        """تحديث شريط التقدم"""
-        self.backup_progress.value = value
+        """تحديث شريط التقدم؛ value نسبة مئوية من 0 إلى 100، أو None لتقدم غير محدد"""
+        self.backup_progress.value = None if value is None else value / 100
         self.backup_status.value = status_text
         self.backup_status.color = color
         self.page.update()
@@ -4833,7 +7953,8 @@ class CartsManagementApp:
         
         backups = self.db.execute_query("""
             SELECT b.created_at, b.file_name, b.backup_type, b.file_size, 
-                   b.mega_link, b.status, u.username
+                   b.mega_link, b.status, u.username, b.compression_ratio,
+                   b.file_path, b.manifest_path, b.compression, b.sha256
             FROM backups b
             LEFT JOIN users u ON b.user_id = u.id
             ORDER BY b.created_at DESC 
@@ -4841,9 +7962,11 @@ class CartsManagementApp:
         """)
         
         for backup in backups:
-            created_at, filename, btype, file_size, mega_link, status, username = backup
+            created_at, filename, btype, file_size, mega_link, status, username, ratio = backup[:8]
+            restore_source = dict(zip(('file_path', 'manifest_path', 'compression', 'sha256'), backup[8:]))
+            restore_source['file_name'] = filename
             
-            type_text = "محلي" if btype == 'local' else "سحابي"
+            type_text = {'local': "محلي", 'incremental': "تزايدي", 'auto': "تلقائي"}.get(btype, "سحابي")
             status_text = "✓ مكتمل" if status == 'completed' else "✗ فشل"
             
             if file_size:
@@ -4853,6 +7976,8 @@ class CartsManagementApp:
                     size_text = f"{file_size / 1024:.1f} KB"
                 else:
                     size_text = f"{file_size / (1024*1024):.1f} MB"
+                if ratio:
+                    size_text += f" ({ratio * 100:.0f}%)"
             else:
                 size_text = "-"
             
@@ -4873,12 +7998,84 @@ class CartsManagementApp:
                             border_radius=4
                         )),
                         ft.DataCell(ft.Text(username or "", size=12)),
+                        ft.DataCell(ft.IconButton(
+                            icon=ft.icons.RESTORE,
+                            icon_color=COLORS['warning'],
+                            tooltip="استعادة هذه النسخة",
+                            on_click=lambda e, b=restore_source: self.restore_backup(b),
+                            disabled=status != 'completed'
+                        )),
                     ]
                 )
             )
         
         self.page.update()
     
+    def restore_backup(self, backup):
+        """استعادة نسخة احتياطية بعد التأكيد"""
+        def confirm_restore(e):
+            dialog.open = False
+            self.page.update()
+            threading.Thread(target=restore_thread, daemon=True).start()
+        
+        def cancel_restore(e):
+            dialog.open = False
+            self.page.update()
+        
+        def restore_thread():
+            started = time.monotonic()
+            username = self.current_user['username']
+            temp_path = os.path.join(self.backup_dir, f"restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db")
+            try:
+                # التحقق يتم على نسخة مستقلة، فلا تتأثر قاعدة البيانات الحية إذا كانت النسخة تالفة
+                self.update_progress(0, "جاري التحقق من النسخة...")
+                self.db.backup_engine.prepare_restore(
+                    backup, temp_path,
+                    lambda fraction: self.update_progress(fraction * 40, f"جاري التحقق من النسخة... {fraction * 100:.0f}%")
+                )
+                
+                self.update_progress(40, "جاري الاستعادة...")
+                self.db.restore_from(
+                    temp_path,
+                    lambda fraction: self.update_progress(40 + fraction * 55, f"جاري الاستعادة... {fraction * 100:.0f}%")
+                )
+                elapsed = time.monotonic() - started
+                
+                # المستخدم الحالي قد لا يكون موجوداً في النسخة المستعادة
+                self.db.log_action(None, 'restore_backup',
+                                  f'استعادة النسخة {backup["file_name"]} بواسطة {username}')
+                self.update_progress(100, f"✅ تمت الاستعادة خلال {elapsed:.1f} ثانية", COLORS['success'])
+                
+                time.sleep(2)
+                self.current_user = None
+                self.current_permissions = None
+                self.show_login_screen()
+                self.show_snack_bar("تمت استعادة النسخة الاحتياطية، الرجاء تسجيل الدخول من جديد", COLORS['success'])
+                
+            except Exception as ex:
+                self.update_progress(0, f"❌ فشلت الاستعادة: {str(ex)}", COLORS['danger'])
+                self.show_snack_bar(f"فشلت استعادة النسخة: {str(ex)}", COLORS['danger'])
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        
+        dialog = ft.AlertDialog(
+            title=ft.Text("تأكيد الاستعادة"),
+            content=ft.Text(
+                f"سيتم استبدال جميع البيانات الحالية بمحتوى النسخة {backup['file_name']}.\n"
+                "ستُسجل خروج الجلسة الحالية بعد الاستعادة. هل تريد المتابعة؟"
+            ),
+            actions=[
+                ft.TextButton("نعم", on_click=confirm_restore),
+                ft.TextButton("لا", on_click=cancel_restore),
+            ],
+            actions_alignment=ft.MainAxisAlignment.END,
+        )
+        
+        self.page.dialog = dialog
+        dialog.open = True
+        self.page.update()
+    
     # ================================ دوال مساعدة للنوافذ ================================
     def close_dialog(self, dialog):
         """إغلاق نافذة الحوار"""
@@ -4910,4 +8107,5 @@ def main(page: ft.Page):
     app = CartsManagementApp(page)
 
 if __name__ == "__main__":
-    ft.app(target=main)
+    # مجلد assets يُقدَّم للمتصفح حتى تُنزَّل منه ملفات التصدير
+    ft.app(target=main, assets_dir=ASSETS_DIR)
@@ -0,0 +1,257 @@
+import os
+import threading
+
+import pytest
+
+import main
+
+PART_SIZE = 1024
+
+
+class FakeRequestError(Exception):
+    pass
+
+
+class FakeMegaCloud:
+    """حساب MEGA في الذاكرة يكتشف استخدام العميل الواحد من خيطين معاً"""
+
+    def __init__(self):
+        self.folders = {}  # الاسم -> المعرف
+        self.files = {}  # (معرف المجلد، اسم الملف) -> المحتوى
+        self.failures = {}  # اسم الملف -> عدد مرات الفشل المتبقية
+        self.logins = 0
+        self.overlaps = 0  # استدعاءات متداخلة على نفس العميل
+        self.peak = 0  # أقصى عدد استدعاءات متزامنة عبر كل العملاء
+        self._active = {}
+        self._lock = threading.Lock()
+        self._ids = iter(range(1, 10 ** 6))
+
+    def call(self, client):
+        """تسجيل استدعاء يستغرق وقتاً قصيراً، وعدّه إذا تداخل مع استدعاء آخر على نفس العميل"""
+        with self._lock:
+            self._active[client] = self._active.get(client, 0) + 1
+            if self._active[client] > 1:
+                self.overlaps += 1
+            self.peak = max(self.peak, sum(self._active.values()))
+        threading.Event().wait(0.01)
+        with self._lock:
+            self._active[client] -= 1
+
+
+class FakeMegaClient:
+    def __init__(self, cloud):
+        self.cloud = cloud
+
+    def find(self, path):
+        self.cloud.call(self)
+        if '/' in path:
+            folder, name = path.split('/', 1)
+            folder_id = self.cloud.folders.get(folder)
+            if (folder_id, name) not in self.cloud.files:
+                return None
+            return (f"{folder_id}:{name}", {'folder': folder_id, 'name': name})
+        if path not in self.cloud.folders:
+            return None
+        return (self.cloud.folders[path], {'name': path})
+
+    def create_folder(self, name):
+        self.cloud.call(self)
+        self.cloud.folders[name] = next(self.cloud._ids)
+        return {name: self.cloud.folders[name]}
+
+    def upload(self, path, dest=None, dest_filename=None):
+        self.cloud.call(self)
+        if self.cloud.failures.get(dest_filename, 0) > 0:
+            self.cloud.failures[dest_filename] -= 1
+            raise FakeRequestError(f"انقطع رفع {dest_filename}")
+        with open(path, 'rb') as f:
+            self.cloud.files[(dest, dest_filename)] = f.read()
+        return {'f': [{'h': f"{dest}:{dest_filename}"}]}
+
+    def download(self, node, dest_path=None):
+        self.cloud.call(self)
+        info = node[1]
+        path = os.path.join(dest_path, info['name'])
+        with open(path, 'wb') as f:
+            f.write(self.cloud.files[(info['folder'], info['name'])])
+        return path
+
+    def export(self, name):
+        self.cloud.call(self)
+        return f"https://mega.nz/folder/{self.cloud.folders[name]}"
+
+
+class LocalBackend:
+    def __init__(self, tmp_path, monkeypatch):
+        self.storage = main.LocalDirectoryStorage(str(tmp_path / 'remote'))
+        self.failures = {}
+        self.sent = []
+        write = self.storage._write
+
+        def flaky_write(path, data):
+            name = os.path.basename(path)
+            if self.failures.get(name, 0) > 0:
+                self.failures[name] -= 1
+                raise OSError(f"انقطع رفع {name}")
+            self.sent.append(name)
+            write(path, data)
+
+        monkeypatch.setattr(self.storage, '_write', flaky_write)
+
+    def fail(self, index, times):
+        self.failures[main.BackupStorage.part_name(index)] = times
+
+    def corrupt(self, key, index):
+        path = os.path.join(self.storage.root, key, main.BackupStorage.part_name(index))
+        with open(path, 'r+b') as f:
+            first = f.read(1)
+            f.seek(0)
+            f.write(bytes([first[0] ^ 0xFF]))
+
+
+class MegaBackend:
+    def __init__(self, tmp_path, monkeypatch):
+        self.cloud = cloud = FakeMegaCloud()
+
+        class FakeMega:
+            def login(self, email, password):
+                cloud.logins += 1
+                return FakeMegaClient(cloud)
+
+        monkeypatch.setattr(main, 'Mega', FakeMega, raising=False)
+        self.storage = main.MegaStorage(main.MegaSession(), 'user@example.com', 'secret')
+        self.sent = []
+        upload = FakeMegaClient.upload
+
+        def recording_upload(client, path, dest=None, dest_filename=None):
+            result = upload(client, path, dest=dest, dest_filename=dest_filename)
+            self.sent.append(dest_filename)
+            return result
+
+        monkeypatch.setattr(FakeMegaClient, 'upload', recording_upload)
+
+    def fail(self, index, times):
+        self.cloud.failures[main.BackupStorage.part_name(index)] = times
+
+    def corrupt(self, key, index):
+        file_key = (self.cloud.folders[key], main.BackupStorage.part_name(index))
+        data = self.cloud.files[file_key]
+        self.cloud.files[file_key] = bytes([data[0] ^ 0xFF]) + data[1:]
+
+
+@pytest.fixture(params=['local', 'mega'])
+def backend(request, tmp_path, monkeypatch):
+    backend_class = {'local': LocalBackend, 'mega': MegaBackend}[request.param]
+    return backend_class(tmp_path, monkeypatch)
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """تسجيل فترات الانتظار بين المحاولات بدلاً من الانتظار فعلياً"""
+    recorded = []
+    monkeypatch.setattr(main.time, 'sleep', recorded.append)
+    return recorded
+
+
+@pytest.fixture
+def backup_file(tmp_path):
+    path = tmp_path / 'backup_test.db.gz'
+    path.write_bytes(os.urandom(PART_SIZE * 5 + 300))
+    return str(path)
+
+
+def make_uploader(backend, retries=3):
+    return main.ChunkedUploader(backend.storage, part_size=PART_SIZE, workers=3, retries=retries)
+
+
+def test_upload_and_download_roundtrip(backend, backup_file, tmp_path, sleeps):
+    uploader = make_uploader(backend)
+
+    link = uploader.upload(backup_file, 'backup_test', meta={'sha256': 'abc'})
+
+    assert link
+    assert not os.path.exists(uploader.state_path(backup_file))
+    assert sorted(name for name in backend.sent if name.startswith('part_')) == [
+        main.BackupStorage.part_name(index) for index in range(6)
+    ]
+    manifest = backend.storage.get_manifest('backup_test')
+    assert manifest['meta'] == {'sha256': 'abc'}
+    assert len(manifest['parts']) == 6
+
+    target = str(tmp_path / 'restored.db.gz')
+    uploader.download('backup_test', target)
+    with open(backup_file, 'rb') as original, open(target, 'rb') as restored:
+        assert restored.read() == original.read()
+
+
+def test_resume_after_failed_part(backend, backup_file, tmp_path, sleeps):
+    backend.fail(2, times=1)
+    with pytest.raises(Exception):
+        make_uploader(backend, retries=1).upload(backup_file, 'backup_test', meta={'name': 'backup_test'})
+
+    state_path = main.ChunkedUploader.state_path(backup_file)
+    assert os.path.exists(state_path)
+    with open(state_path, 'r', encoding='utf-8') as f:
+        confirmed = set(main.json.load(f)['done'])
+    assert '2' not in confirmed
+
+    meta, link = make_uploader(backend).resume(state_path)
+
+    assert meta == {'name': 'backup_test'}
+    assert link
+    assert not os.path.exists(state_path)
+    # الأجزاء المؤكدة قبل الانقطاع لا يُعاد رفعها
+    for index in confirmed:
+        assert backend.sent.count(main.BackupStorage.part_name(int(index))) == 1
+
+    target = str(tmp_path / 'restored.db.gz')
+    make_uploader(backend).download('backup_test', target)
+    with open(backup_file, 'rb') as original, open(target, 'rb') as restored:
+        assert restored.read() == original.read()
+
+
+def test_retry_with_backoff(backend, backup_file, sleeps):
+    backend.fail(0, times=2)
+    retries = []
+
+    uploader = make_uploader(backend, retries=3)
+    uploader.on_retry = retries.append
+    uploader.upload(backup_file, 'backup_test')
+
+    assert backend.sent.count(main.BackupStorage.part_name(0)) == 1
+    assert len(sleeps) == 2
+    assert len(retries) == 2
+    backoff = main.BACKUP_UPLOAD_BACKOFF
+    assert backoff <= sleeps[0] <= 1.5 * backoff
+    assert 2 * backoff <= sleeps[1] <= 3 * backoff
+
+
+def test_download_rejects_corrupt_part(backend, backup_file, tmp_path, sleeps):
+    uploader = make_uploader(backend)
+    uploader.upload(backup_file, 'backup_test')
+    backend.corrupt('backup_test', 3)
+
+    target = str(tmp_path / 'restored.db.gz')
+    with pytest.raises(ValueError):
+        uploader.download('backup_test', target)
+    assert not os.path.exists(target)
+    assert not os.path.exists(target + '.part')
+
+
+def test_mega_uploads_parts_in_parallel_on_separate_clients(tmp_path, monkeypatch, backup_file, sleeps):
+    backend = MegaBackend(tmp_path, monkeypatch)
+
+    main.ChunkedUploader(backend.storage, part_size=PART_SIZE, workers=3).upload(backup_file, 'backup_test')
+
+    assert backend.cloud.overlaps == 0
+    assert backend.cloud.peak > 1
+    assert backend.cloud.logins <= main.BACKUP_UPLOAD_WORKERS
+
+
+def test_mega_drops_client_after_failure(tmp_path, monkeypatch, backup_file, sleeps):
+    backend = MegaBackend(tmp_path, monkeypatch)
+    backend.fail(0, times=1)
+
+    main.ChunkedUploader(backend.storage, part_size=PART_SIZE, workers=1).upload(backup_file, 'backup_test')
+
+    assert backend.cloud.logins == 2